@@ -0,0 +1,393 @@
+"""
+Measure the identifiers client against a local stand-in for the service.
+
+Starts benchmarks/standin.py in its own process (so serving requests doesn't
+compete with the client for the interpreter), then times creating, updating
+and reading identifiers, one request at a time ("single") and through the
+batch methods ("batch"). Each reports throughput and p50/p99 latency: for
+single operations, the time of each client call; for batches, the time of
+each HTTP request as reported by the request scheduler. The cold start of
+the command line is measured too, both importing and parsing (as
+benchmarks/startup.py does) and running ``identifier-display`` against the
+stand-in from a fresh interpreter.
+
+    python benchmarks/client.py [--count N] [--concurrency N]
+                                [--latency S] [--jitter S] [--error-rate F]
+                                [--bandwidth B] [--has-part N]
+                                [--compress-min-size N]
+                                [--save FILE] [--baseline FILE]
+
+``--has-part`` gives each record's metadata that many schema.org hasPart
+entries, for measuring large payloads, and ``--bandwidth`` limits how fast
+the stand-in reads request bodies, as a slow uplink would.
+
+Nothing leaves the machine: the stand-in accepts any token, and the client
+is given one which never needs refreshing. With ``--baseline`` (results
+saved from another commit) the change in each figure is printed alongside.
+"""
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_root = os.path.dirname(_here)
+sys.path.insert(0, _root)
+sys.path.insert(0, _here)
+
+import startup  # noqa: E402
+
+# Figures where a larger value is better; for the rest smaller is
+_HIGHER_IS_BETTER = ('ops_per_sec', )
+
+_config = """[client]
+service_url = {url}
+client_id = 00000000-0000-0000-0000-000000000000
+
+[tokens]
+access_token = benchmark
+access_token_expires = 9999999999
+refresh_token = benchmark
+"""
+
+
+def _percentile(values, fraction):
+    """Nearest rank percentile of values."""
+    if not values:
+        return None
+    values = sorted(values)
+    # The smallest value with at least fraction of the values at or below it
+    rank = max(0, min(len(values) - 1,
+                      int(math.ceil(fraction * len(values))) - 1))
+    return values[rank]
+
+
+def _summary(count, elapsed, latencies, errors, sent):
+    return {
+        'count': count,
+        'errors': errors,
+        'sent_bytes': sent,
+        'seconds': round(elapsed, 4),
+        'ops_per_sec': round(count / elapsed, 2) if elapsed else None,
+        'p50_ms': _ms(_percentile(latencies, 0.5)),
+        'p99_ms': _ms(_percentile(latencies, 0.99)),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class _Requests(object):
+    """A metrics hook keeping the total time of every HTTP request, and
+    counting the request body bytes sent."""
+
+    def __init__(self):
+        self.totals = []
+        self.sent = 0
+
+    def __call__(self, event, fields):
+        if event == 'http_request':
+            self.totals.append(fields['total'])
+            self.sent += fields['sent']
+
+    def __enter__(self):
+        from identifiers_client import metrics
+        metrics.add_hook(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        from identifiers_client import metrics
+        metrics.remove_hook(self)
+
+
+def start_standin(args):
+    """Run the stand-in service; returns the process and its URL."""
+    command = [sys.executable, os.path.join(_here, 'standin.py'),
+               '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate)]
+    if args.bandwidth:
+        command += ['--bandwidth', str(args.bandwidth)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    url = process.stdout.readline().decode('utf-8').strip()
+    if not url:
+        process.wait()
+        raise RuntimeError('The stand-in service failed to start')
+    return process, url
+
+
+def make_client(url, args):
+    from globus_sdk import AccessTokenAuthorizer
+    from identifiers_client.identifiers_api import IdentifierClient
+    from identifiers_client.scheduler import RequestScheduler
+    # The default rate limit would be what was measured, so raise it
+    scheduler = RequestScheduler(rate=args.rate, burst=args.rate,
+                                 initial_concurrency=args.concurrency,
+                                 max_concurrency=args.concurrency)
+    return IdentifierClient('identifier', base_url=url,
+                            app_name='identifier_client_benchmark',
+                            authorizer=AccessTokenAuthorizer('benchmark'),
+                            scheduler=scheduler,
+                            compress_min_size=args.compress_min_size)
+
+
+def _metadata(i, has_part):
+    metadata = {'title': 'Benchmark record {}'.format(i)}
+    if has_part:
+        metadata.update({
+            '@context': 'http://schema.org',
+            '@type': 'Dataset',
+            'hasPart': [{
+                '@type': 'DataDownload',
+                'name': 'part-{:05d}.h5'.format(n),
+                'contentUrl': 'https://example.org/data/{}/part-{:05d}.h5'
+                .format(i, n),
+                'contentSize': 1048576 + n,
+                'encodingFormat': 'application/x-hdf5',
+                'identifier': 'sha256:{:064x}'.format(i * 100000 + n),
+            } for n in range(has_part)]
+        })
+    return metadata
+
+
+def _record(namespace, i, has_part):
+    return {
+        'namespace': namespace,
+        'location': ['https://example.org/data/{}'.format(i)],
+        'checksums': [{'function': 'sha256', 'value': '{:064x}'.format(i)}],
+        'metadata': _metadata(i, has_part),
+        'visible_to': ['public'],
+    }
+
+
+def run_single(operation, items):
+    """Call operation on each item in turn, timing each call."""
+    latencies = []
+    errors = 0
+    results = []
+    with _Requests() as requests:
+        started = time.time()
+        for item in items:
+            t0 = time.time()
+            try:
+                results.append(operation(item))
+            except Exception:
+                errors += 1
+            latencies.append(time.time() - t0)
+        elapsed = time.time() - started
+    return _summary(len(items), elapsed, latencies, errors,
+                    requests.sent), results
+
+
+def run_batch(batch, items):
+    """Consume the BatchResults of batch(items), timing its requests."""
+    errors = 0
+    results = []
+    with _Requests() as requests:
+        started = time.time()
+        for result in batch(items):
+            if result.error is not None:
+                errors += 1
+            else:
+                results.append(result.response)
+        elapsed = time.time() - started
+    return _summary(len(items), elapsed, requests.totals, errors,
+                    requests.sent), results
+
+
+def benchmark_client(client, args):
+    from identifiers_client.batch import BatchResult, bounded_map
+    from identifiers_client.migrate import update_identifiers
+    namespace = client.create_namespace(
+        display_name='benchmark', creators=['benchmark'],
+        admins=['benchmark']).data['id']
+    records = [_record(namespace, i, args.has_part)
+               for i in range(args.count)]
+    results = {}
+
+    results['create_single'], created = run_single(
+        lambda r: client.create_identifier(**r), records)
+    results['create_batch'], created_batch = run_batch(
+        lambda rs: client.create_identifiers(rs, args.concurrency), records)
+    ids = [r.data['identifier'] for r in created + created_batch]
+    ids = ids[:args.count] or [None]
+
+    updates = [{'identifier': i, 'metadata': _metadata(n, args.has_part)}
+               for n, i in enumerate(ids)]
+    results['update_single'], _ = run_single(
+        lambda u: client.update_identifier(
+            u['identifier'], **dict((k, v) for k, v in u.items()
+                                    if k != 'identifier')), updates)
+
+    def _update_batch(items):
+        for result in update_identifiers(client, items,
+                                         concurrency=args.concurrency):
+            yield BatchResult(result.index, result.identifier,
+                              result.changes, result.error)
+
+    results['update_batch'], _ = run_batch(_update_batch, updates)
+
+    results['get_single'], _ = run_single(client.get_identifier, ids)
+
+    def _get_batch(items):
+        for result in bounded_map(client.get_identifier, items,
+                                  args.concurrency):
+            yield BatchResult(*result)
+
+    results['get_batch'], _ = run_batch(_get_batch, ids)
+    return results, ids[0]
+
+
+def benchmark_cold_start(url, identifier, repeat):
+    """Time the command line from a fresh interpreter, median of repeat."""
+    parse = startup.measure([], repeat)
+    with tempfile.NamedTemporaryFile('w', suffix='.cfg',
+                                     delete=False) as config:
+        config.write(_config.format(url=url))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (_root, env.get('PYTHONPATH')) if p)
+    env['IDENTIFIER_CONFIG_FILE'] = config.name
+    env.pop('IDENTIFIER_DAEMON_SOCKET', None)
+    command = [sys.executable, '-c',
+               'from identifiers_client.main import main; main()',
+               'identifier-display', '--identifier', identifier]
+    runs = []
+    try:
+        for _ in range(repeat):
+            t0 = time.time()
+            subprocess.check_output(command, env=env, cwd=_root)
+            runs.append(time.time() - t0)
+    finally:
+        os.unlink(config.name)
+    t0 = time.time()
+    subprocess.check_call([sys.executable, '-c', 'pass'])
+    interpreter = time.time() - t0
+    return {
+        'import_ms': parse['import_ms'],
+        'parse_ms': parse['parse_ms'],
+        'identifier_display_ms': _ms(startup._median(runs)),
+        'interpreter_ms': _ms(interpreter),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=_root,
+            stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _change(name, before, after):
+    if not before or after is None or before.get(name) in (None, 0):
+        return ''
+    change = (after - before[name]) / float(before[name])
+    better = (change > 0) == (name in _HIGHER_IS_BETTER)
+    return '{:+.0%}{}'.format(change, '' if abs(change) < 0.05 else
+                              (' better' if better else ' worse'))
+
+
+def report(results, baseline):
+    base = baseline or {}
+    columns = ('ops_per_sec', 'p50_ms', 'p99_ms', 'sent_bytes', 'errors')
+    print('{:<16}'.format('operation') +
+          ''.join('{:>22}'.format(c) for c in columns))
+    for name in sorted(results['operations']):
+        result = results['operations'][name]
+        before = base.get('operations', {}).get(name)
+        print('{:<16}'.format(name) + ''.join('{:>22}'.format(
+            '{} {}'.format(result[c], _change(c, before, result[c])).strip())
+                                               for c in columns))
+    cold = results.get('cold_start')
+    if cold:
+        before = base.get('cold_start')
+        print()
+        for name in sorted(cold):
+            print('{:<24}{:>12} {}'.format(name, cold[name],
+                                           _change(name, before, cold[name])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=200,
+                        help='Identifiers per operation (default: 200)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Requests in flight for batches (default: 16)')
+    parser.add_argument('--rate', type=float, default=100000,
+                        help='Request scheduler rate limit (default: 100000)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds the stand-in adds to each response '
+                        '(default: 0.005)')
+    parser.add_argument('--jitter', type=float, default=0.002,
+                        help='Up to this many more seconds (default: 0.002)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests the stand-in fails')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Bytes a second at which the stand-in reads '
+                        'request bodies (default: unlimited)')
+    parser.add_argument('--has-part', type=int, default=0,
+                        help='schema.org hasPart entries in each record\'s '
+                        'metadata (default: 0)')
+    parser.add_argument('--compress-min-size', type=int,
+                        help='Compress request bodies of this many bytes or '
+                        'more (default: no compression)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per cold start measurement (default: 5)')
+    parser.add_argument('--no-cold-start', action='store_true',
+                        help='Skip the command line cold start')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='Compare with results saved by an earlier run')
+    args = parser.parse_args()
+
+    process, url = start_standin(args)
+    try:
+        client = make_client(url, args)
+        operations, identifier = benchmark_client(client, args)
+        cold_start = None
+        if not args.no_cold_start:
+            cold_start = benchmark_cold_start(url, identifier, args.repeat)
+    finally:
+        process.terminate()
+        process.wait()
+
+    results = {
+        'commit': _commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': dict((name, getattr(args, name))
+                         for name in ('count', 'concurrency', 'rate',
+                                      'latency', 'jitter', 'error_rate',
+                                      'bandwidth', 'has_part',
+                                      'compress_min_size')),
+        'operations': operations,
+    }
+    if cold_start:
+        results['cold_start'] = cold_start
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != results['settings']:
+            print('The baseline was run with different settings: {}'.format(
+                baseline.get('settings')), file=sys.stderr)
+    report({'operations': operations, 'cold_start': cold_start}, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Measure how quickly the local index of minted identifiers records and finds
+identifiers as it grows.
+
+Fills a temporary index with records of random sha256 checksums in batches,
+and after each batch times lookups of checksums which are recorded (hits)
+and of ones which are not (misses, most answered by the Bloom filter
+without reading the database), and reopening the index.
+
+    python benchmarks/index.py [--count N] [--batch N] [--lookups N]
+                               [--save FILE]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+
+from identifiers_client.index import MintedIndex  # noqa: E402
+
+
+def _digest(rng):
+    return '{:064x}'.format(rng.getrandbits(256))
+
+
+def _records(rng, start, count, digests):
+    for i in range(start, start + count):
+        digest = _digest(rng)
+        digests.append(digest)
+        yield {
+            'identifier': 'ark:/99999/fk4{}'.format(i),
+            'namespace': 'benchmark',
+            'location': ['https://example.org/data/{}'.format(i)],
+            'checksums': [{'function': 'sha256', 'value': digest}],
+            'metadata': {'contentSize': i}
+        }
+
+
+def _lookups_per_sec(index, digests):
+    t0 = time.time()
+    for digest in digests:
+        index.find('sha256', digest, namespace='benchmark')
+    return round(len(digests) / (time.time() - t0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=1000000,
+                        help='Identifiers to record (default: 1000000)')
+    parser.add_argument('--batch', type=int, default=200000,
+                        help='Identifiers recorded between measurements '
+                        '(default: 200000)')
+    parser.add_argument('--lookups', type=int, default=20000,
+                        help='Lookups timed per measurement (default: 20000)')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'index')
+    results = []
+    try:
+        index = MintedIndex(path, filter_capacity=args.count)
+        digests = []
+        print('{:>12} {:>12} {:>12} {:>12} {:>10} {:>12}'.format(
+            'entries', 'inserts/s', 'hits/s', 'misses/s', 'open_ms',
+            'db_bytes'))
+        while len(digests) < args.count:
+            t0 = time.time()
+            index.add_many(_records(rng, len(digests), args.batch, digests))
+            inserts = round(args.batch / (time.time() - t0))
+            hits = _lookups_per_sec(index, rng.sample(digests, args.lookups))
+            misses = _lookups_per_sec(
+                index, [_digest(rng) for _ in range(args.lookups)])
+            index.close()
+            t0 = time.time()
+            index = MintedIndex(path)
+            index.might_contain('sha256', digests[0])
+            open_ms = round((time.time() - t0) * 1000, 1)
+            row = {
+                'entries': len(digests),
+                'inserts_per_sec': inserts,
+                'hits_per_sec': hits,
+                'misses_per_sec': misses,
+                'open_ms': open_ms,
+                'db_bytes': os.path.getsize(path)
+            }
+            results.append(row)
+            print('{entries:>12} {inserts_per_sec:>12} {hits_per_sec:>12} '
+                  '{misses_per_sec:>12} {open_ms:>10} {db_bytes:>12}'.format(
+                      **row))
+        index.close()
+    finally:
+        shutil.rmtree(directory)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
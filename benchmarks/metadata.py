@@ -0,0 +1,156 @@
+"""
+Measure the memory held by normalized metadata records, and how quickly
+documents are converted.
+
+Generates schema.org, DataCite, Identifiers service and indexd documents
+shaped like those the resolvers return, then compares the memory taken by
+the parsed documents with that taken by MetadataRecords made from the same
+text (both measured with tracemalloc), and times ``normalize_many`` over the
+documents and over their NDJSON text.
+
+    python benchmarks/metadata.py [--count N] [--save FILE]
+"""
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+
+from identifiers_client import metadata  # noqa: E402
+
+_authors = ['TOPMed', 'Tim Clark', 'Isma Gilani', 'Francisco Ortuno']
+
+
+def _schema_org(i):
+    return {
+        '@context': 'http://schema.org',
+        '@type': 'Dataset',
+        '@id': 'https://doi.org/10.23725/{:08x}'.format(i),
+        'identifier': [
+            {'@type': 'PropertyValue', 'propertyID': 'doi',
+             'value': 'https://doi.org/10.23725/{:08x}'.format(i)},
+            {'@type': 'PropertyValue', 'propertyID': 'md5',
+             'value': '{:032x}'.format(i)},
+        ],
+        'url': 'https://ors.datacite.org/doi:/10.23725/{:08x}'.format(i),
+        'additionalType': 'CRAM file',
+        'name': 'NWD{:06d}.recab.cram'.format(i),
+        'author': {'name': _authors[i % len(_authors)]},
+        'description': 'TOPMed: NWD{:06d} <br>File:  CRAM file'.format(i),
+        'datePublished': '2017-11-30',
+        'contentSize': 1000000 + i,
+        'contentUrl': [
+            's3://cgp-commons-public/topmed/{:08x}/NWD.cram'.format(i),
+            'gs://topmed-irc-share/public/NWD{:06d}.recab.cram'.format(i),
+        ],
+        'publisher': {'@type': 'Organization', 'name': 'TOPMed'},
+        'fileFormat': ['text/plain'],
+    }
+
+
+def _datacite(i):
+    return {
+        'doi': '10.5438/{:08x}'.format(i),
+        'creators': [{'name': _authors[i % len(_authors)],
+                      'nameType': 'Personal'}],
+        'titles': [{'title': 'Dataset {}'.format(i)}],
+        'sizes': ['{} bytes'.format(1000000 + i)],
+        'contentUrl': ['https://example.org/{}.h5'.format(i)],
+        'publisher': 'DataCite',
+        'publicationYear': 2018,
+    }
+
+
+def _identifiers(i):
+    return {
+        'identifier': 'ark:/57799/b9{:010x}'.format(i),
+        'location': ['https://example.org/data/{}.zip'.format(i)],
+        'checksums': [{'function': 'sha256', 'value': '{:064x}'.format(i)}],
+        'metadata': {'title': 'file{}.vcf'.format(i),
+                     'contentSize': 1000000 + i,
+                     'author': _authors[i % len(_authors)]},
+        'visible_to': ['public'],
+    }
+
+
+def _indexd(i):
+    return {
+        'did': 'dg.4503/{:08x}-68f0-4aed-8fd2-c1f3ff169254'.format(i),
+        'file_name': 'NWD{:06d}.cram'.format(i),
+        'size': 1000000 + i,
+        'hashes': {'md5': '{:032x}'.format(i)},
+        'urls': ['s3://bucket/{}.cram'.format(i)],
+        'acl': ['*'],
+        'form': 'object',
+        'version': None,
+    }
+
+
+_makers = [_schema_org, _datacite, _identifiers, _indexd]
+
+
+def _allocated(build):
+    """The memory held by what build() returns, and the value."""
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=100000,
+                        help='Documents to convert (default: 100000)')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    lines = [json.dumps(_makers[i % len(_makers)](i))
+             for i in range(args.count)]
+    doc_bytes, docs = _allocated(lambda: [json.loads(line)
+                                          for line in lines])
+    # From the text, so that the strings records share with documents are
+    # counted too
+    record_bytes, records = _allocated(
+        lambda: list(metadata.normalize_many(lines)))
+    del records
+
+    t0 = time.time()
+    for _ in metadata.normalize_many(docs):
+        pass
+    from_dicts = time.time() - t0
+    t0 = time.time()
+    for _ in metadata.normalize_many(lines):
+        pass
+    from_text = time.time() - t0
+    t0 = time.time()
+    for doc in docs:
+        metadata.normalize(doc)
+    one_at_a_time = time.time() - t0
+
+    results = {
+        'count': args.count,
+        'document_bytes_each': round(doc_bytes / float(args.count), 1),
+        'record_bytes_each': round(record_bytes / float(args.count), 1),
+        'normalize_per_sec': round(args.count / one_at_a_time),
+        'normalize_many_per_sec': round(args.count / from_dicts),
+        'normalize_many_ndjson_per_sec': round(args.count / from_text),
+    }
+    for name, value in sorted(results.items()):
+        print('{:<32} {:>12}'.format(name, value))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Measure the cost of printing results in each --output format.
+
+Builds identifier records with large metadata and writes them, as a single
+result and as a stream of batch results, in each format: 'pretty' (as the
+command line has always printed), 'json' and 'ndjson', each with the json
+module and, when it is installed, orjson. The output goes to /dev/null
+through a text stream, so what is measured is encoding and writing.
+
+    python benchmarks/output.py [--records N] [--metadata-keys N]
+                                [--repeat N] [--save FILE]
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+
+from identifiers_client import output  # noqa: E402
+
+
+def make_records(count, metadata_keys):
+    return [{
+        'identifier': 'ark:/99999/fk4{}'.format(i),
+        'namespace': 'f2bd2fab-e3a6-4c1b-9e3b-6a8f9c5a1b2c',
+        'location': ['https://example.org/data/{}/file.h5'.format(i)],
+        'checksums': [{'function': 'sha256', 'value': '{:064x}'.format(i)}],
+        'visible_to': ['public'],
+        'metadata': dict(('property_{}'.format(k), {
+            'value': 'A metadata value for record {} ({})'.format(i, k),
+            'scores': [k * 0.5, k * 1.5, k * 2.5],
+            'flag': k % 2 == 0,
+        }) for k in range(metadata_keys)),
+    } for i in range(count)]
+
+
+def _time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        with io.open(os.devnull, 'w', encoding='utf-8') as out:
+            t0 = time.time()
+            func(out)
+            elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _size(func):
+    out = io.StringIO()
+    func(out)
+    return len(out.getvalue().encode('utf-8'))
+
+
+def _previous_stream(items, out):
+    # How batch results were printed before --output
+    for item in items:
+        out.write(json.dumps(item))
+        out.write('\n')
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--metadata-keys', type=int, default=50,
+                        help='Properties in each record\'s metadata')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per measurement; the fastest is kept')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    records = make_records(args.records, args.metadata_keys)
+    encoders = [('json', None)]
+    if output.orjson is not None:
+        encoders.append(('orjson', output.orjson))
+
+    cases = [('single', 'pretty (previous)', 'json',
+              lambda out: out.write(json.dumps(records, indent=2) + '\n')),
+             ('stream', 'ndjson (previous)', 'json',
+              lambda out: _previous_stream(records, out))]
+    for name, module in encoders:
+        for fmt in output.FORMATS:
+            cases.append(('single', fmt, name,
+                          (lambda fmt, module: lambda out: (
+                              setattr(output, 'orjson', module),
+                              output.write_result(records, out, fmt)))(
+                                  fmt, module)))
+            cases.append(('stream', fmt, name,
+                          (lambda fmt, module: lambda out: (
+                              setattr(output, 'orjson', module),
+                              output.write_stream(iter(records), out, fmt)))(
+                                  fmt, module)))
+
+    baseline = {}
+    results = []
+    print('{:<8} {:<20} {:<8} {:>10} {:>12} {:>10}'.format(
+        'shape', 'format', 'encoder', 'ms', 'MB', 'x previous'))
+    original = output.orjson
+    try:
+        for shape, fmt, encoder, func in cases:
+            seconds = _time(func, args.repeat)
+            size = _size(func)
+            baseline.setdefault(shape, seconds)
+            result = {
+                'shape': shape,
+                'format': fmt,
+                'encoder': encoder,
+                'ms': round(seconds * 1000, 2),
+                'bytes': size,
+                'relative': round(seconds / baseline[shape], 3),
+            }
+            results.append(result)
+            print('{:<8} {:<20} {:<8} {:>10.1f} {:>12.2f} {:>10.2f}'.format(
+                shape, fmt, encoder, result['ms'], size / 1e6,
+                result['relative']))
+    finally:
+        output.orjson = original
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+A local stand-in for the Identifiers service, for benchmarks and testing
+without network access.
+
+It keeps namespaces and identifiers in memory and answers the requests made
+by IdentifierClient: creating, reading, updating and deleting namespaces,
+creating identifiers in a namespace and listing them a page at a time, and
+reading and updating identifiers. Authorization headers are accepted
+without being checked. Every response can be delayed by ``latency``
+seconds (plus up to ``jitter``), and a fraction ``error_rate`` of requests
+fail with a 503, or a 429 with a Retry-After header. With ``bandwidth``,
+reading a request body takes as long as it would at that many bytes a
+second.
+
+Request bodies may be gzip compressed (unless ``gzip_requests`` is off,
+when they are refused with a 415), and responses of ``gzip_min_size``
+bytes or more are compressed for clients which accept it.
+
+    python benchmarks/standin.py [--port N] [--latency S] [--jitter S]
+                                 [--error-rate F] [--bandwidth B]
+                                 [--gzip-min-size N] [--no-gzip-requests]
+
+prints the URL it is serving on, then serves until interrupted.
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import io
+import itertools
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http import server as http_server
+from urllib.parse import parse_qs, urlparse
+
+
+_ARK_PREFIX = 'ark:/99999/fk4'
+
+
+def _gzip(content):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+class _Store(object):
+    def __init__(self):
+        self.namespaces = {}
+        self.identifiers = {}
+        # Creation order, for paging through a namespace
+        self.by_namespace = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+
+class StandInHandler(http_server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, so delayed ACKs don't add to the
+    # latency being measured
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        content = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        min_size = self.server.gzip_min_size
+        if (min_size is not None and len(content) >= min_size
+                and 'gzip' in self.headers.get('Accept-Encoding', '')):
+            content = _gzip(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _error(self, status, message):
+        self._send(status, {'code': 'Error', 'message': message})
+
+    def _body(self):
+        """The decoded JSON request body, or None if it was refused."""
+        length = int(self.headers.get('Content-Length') or 0)
+        if self.server.bandwidth:
+            time.sleep(length / float(self.server.bandwidth))
+        content = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.server.gzip_requests:
+                self._error(415, 'Compressed requests are not supported')
+                return None
+            content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+        return json.loads(content.decode('utf-8') or '{}')
+
+    def _injected(self):
+        """Delay the response, and maybe fail it; True if it failed."""
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if server.error_rate and random.random() < server.error_rate:
+            if random.random() < 0.5:
+                self._error(503, 'Injected failure')
+            else:
+                self._send(429, {'code': 'Throttled', 'message': 'Slow down'},
+                           {'Retry-After': '0.1'})
+            return True
+        return False
+
+    def _route(self):
+        parsed = urlparse(self.path)
+        parts = [p for p in parsed.path.split('/') if p]
+        return parsed, parts
+
+    def do_POST(self):  # noqa
+        body = self._body()
+        if body is None or self._injected():
+            return
+        store = self.server.store
+        _, parts = self._route()
+        if parts == ['namespace']:
+            namespace = dict(body, id=str(uuid.uuid4()))
+            with store.lock:
+                store.namespaces[namespace['id']] = namespace
+                store.by_namespace[namespace['id']] = []
+            return self._send(201, namespace)
+        if len(parts) == 3 and parts[0] == 'namespace' and parts[2] == (
+                'identifier'):
+            with store.lock:
+                if parts[1] not in store.namespaces:
+                    return self._error(404, 'No namespace ' + parts[1])
+                identifier = _ARK_PREFIX + str(next(store.ids))
+                record = dict(body, identifier=identifier,
+                              namespace=parts[1])
+                store.identifiers[identifier] = record
+                store.by_namespace[parts[1]].append(identifier)
+            return self._send(201, record)
+        self._error(404, 'Not found')
+
+    def do_GET(self):  # noqa
+        if self._injected():
+            return
+        store = self.server.store
+        parsed, parts = self._route()
+        if len(parts) == 2 and parts[0] == 'namespace':
+            namespace = store.namespaces.get(parts[1])
+            if namespace is None:
+                return self._error(404, 'No namespace ' + parts[1])
+            return self._send(200, namespace)
+        if len(parts) == 3 and parts[0] == 'namespace' and parts[2] == (
+                'identifier'):
+            query = parse_qs(parsed.query)
+            limit = int(query.get('limit', ['100'])[0])
+            start = int(query.get('marker', ['0'])[0])
+            with store.lock:
+                ids = store.by_namespace.get(parts[1])
+                if ids is None:
+                    return self._error(404, 'No namespace ' + parts[1])
+                page = [store.identifiers[i] for i in ids[start:start + limit]]
+                more = start + limit < len(ids)
+            return self._send(200, {
+                'identifiers': page,
+                'next_marker': str(start + limit) if more else None,
+                'has_next_page': more
+            })
+        record = store.identifiers.get(parsed.path.lstrip('/'))
+        if record is None:
+            return self._error(404, 'No identifier ' + parsed.path)
+        self._send(200, record)
+
+    def do_PUT(self):  # noqa
+        body = self._body()
+        if body is None or self._injected():
+            return
+        store = self.server.store
+        parsed, parts = self._route()
+        with store.lock:
+            if len(parts) == 2 and parts[0] == 'namespace':
+                target = store.namespaces.get(parts[1])
+            else:
+                target = store.identifiers.get(parsed.path.lstrip('/'))
+            if target is None:
+                return self._error(404, 'Not found')
+            target.update(body)
+            record = dict(target)
+        self._send(200, record)
+
+    def do_DELETE(self):  # noqa
+        if self._injected():
+            return
+        store = self.server.store
+        _, parts = self._route()
+        with store.lock:
+            if len(parts) == 2 and parts[0] == 'namespace':
+                namespace = store.namespaces.pop(parts[1], None)
+                for identifier in store.by_namespace.pop(parts[1], []):
+                    store.identifiers.pop(identifier, None)
+                if namespace is not None:
+                    return self._send(200, namespace)
+        self._error(404, 'Not found')
+
+
+class StandInServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, jitter=0,
+                 error_rate=0, bandwidth=None, gzip_min_size=1024,
+                 gzip_requests=True):
+        http_server.HTTPServer.__init__(self, address, StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth
+        self.gzip_min_size = gzip_min_size
+        self.gzip_requests = gzip_requests
+        self.store = _Store()
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+
+def start(**kwargs):
+    """Start a StandInServer on a background thread and return it."""
+    server = StandInServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Up to this many more seconds, at random')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of requests which fail')
+    parser.add_argument('--bandwidth', type=float,
+                        help='Bytes a second at which request bodies arrive')
+    parser.add_argument('--gzip-min-size', type=int, default=1024,
+                        help='Smallest response to compress; -1 for none')
+    parser.add_argument('--no-gzip-requests', action='store_true',
+                        help='Refuse compressed request bodies with a 415')
+    args = parser.parse_args()
+    server = StandInServer(('127.0.0.1', args.port), args.latency,
+                           args.jitter, args.error_rate, args.bandwidth,
+                           None if args.gzip_min_size < 0 else
+                           args.gzip_min_size, not args.no_gzip_requests)
+    print(server.url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
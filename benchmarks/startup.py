@@ -0,0 +1,145 @@
+"""
+Measure how quickly the identifier command line starts.
+
+For the command line as a whole and for each subcommand, a fresh
+interpreter imports ``identifiers_client.main`` and parses ``--help``,
+recording the import and parse times and which slow modules were loaded.
+Each measurement is repeated and the median kept.
+
+    python benchmarks/startup.py [--repeat N] [--save FILE]
+    python benchmarks/startup.py --baseline FILE [--tolerance 0.25]
+
+With ``--baseline`` (results from an earlier ``--save``) the run fails if any
+time grew by more than the tolerance. It always fails if parsing loads one
+of the slow modules, which should only be imported by the subcommands using
+them when they run.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules the command line must not import just to parse its arguments
+SLOW_MODULES = ('globus_sdk', 'requests', 'aiohttp', 'http.server',
+                'webbrowser', 'concurrent.futures')
+
+# Times within this many milliseconds of the baseline are never regressions,
+# however small the baseline
+_SLACK_MS = 10.0
+
+_probe = """
+import importlib, io, json, sys, time
+t0 = time.perf_counter()
+m = importlib.import_module('identifiers_client.main')
+t1 = time.perf_counter()
+out, sys.stdout = sys.stdout, io.StringIO()
+try:
+    m.cli.parse_args(sys.argv[1:] + ['--help'])
+except SystemExit:
+    pass
+sys.stdout = out
+t2 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'parse_ms': (t2 - t1) * 1000,
+    'slow_modules': sorted(name for name in %r if name in sys.modules),
+}))
+""" % (SLOW_MODULES, )
+
+
+def _subcommands():
+    sys.path.insert(0, _root)
+    import importlib
+    main = importlib.import_module('identifiers_client.main')
+    return sorted(main.subparsers.choices)
+
+
+def _measure_once(argv):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (_root, env.get('PYTHONPATH')) if p)
+    # Keep a developer's own config out of the measurement
+    env['IDENTIFIER_CONFIG_FILE'] = os.devnull
+    out = subprocess.check_output(
+        [sys.executable, '-c', _probe] + argv, env=env, cwd=_root)
+    return json.loads(out.decode('utf-8'))
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(argv, repeat):
+    runs = [_measure_once(argv) for _ in range(repeat)]
+    return {
+        'import_ms': round(_median([r['import_ms'] for r in runs]), 2),
+        'parse_ms': round(_median([r['parse_ms'] for r in runs]), 2),
+        'slow_modules': sorted(set(m for r in runs for m in r['slow_modules']))
+    }
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in sorted(results.items()):
+        if result['slow_modules']:
+            found.append('{}: parsing imports {}'.format(
+                name, ', '.join(result['slow_modules'])))
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in ('import_ms', 'parse_ms'):
+            limit = max(before[key] * (1 + tolerance), before[key] + _SLACK_MS)
+            if result[key] > limit:
+                found.append('{}: {} {:.1f} is over {:.1f} (baseline {:.1f})'
+                             .format(name, key, result[key], limit,
+                                     before[key]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per measurement (default: 5)')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--baseline',
+                        help='Compare with results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed growth over the baseline, as a fraction '
+                        '(default: 0.25)')
+    args = parser.parse_args()
+
+    results = {'(none)': measure([], args.repeat)}
+    for name in _subcommands():
+        results[name] = measure([name], args.repeat)
+
+    print('{:<28} {:>10} {:>10}  {}'.format('subcommand', 'import ms',
+                                            'parse ms', 'slow modules'))
+    for name, result in sorted(results.items()):
+        print('{:<28} {:>10.1f} {:>10.1f}  {}'.format(
+            name, result['import_ms'], result['parse_ms'],
+            ', '.join(result['slow_modules'])))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    found = regressions(results, baseline, args.tolerance)
+    for problem in found:
+        print('REGRESSION ' + problem, file=sys.stderr)
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+import asyncio
+import logging
+import time
+from urllib.parse import quote, urlparse
+
+from globus_sdk.base import BaseClient, safe_stringify, slash_join
+from globus_sdk.exc import (GlobusConnectionError, GlobusTimeoutError,
+                            NetworkError)
+from globus_sdk.response import GlobusHTTPResponse
+
+from identifiers_client import compression, metrics
+from identifiers_client.batch import DEFAULT_CONCURRENCY
+from identifiers_client.identifiers_api import (
+    IdentifierClientError, _app_name, _identifier_json_props,
+    _identifier_properties, _json_parse_args, _namespace_json_props,
+    _namespace_properties, _split_dict, config_authorizer)
+from identifiers_client.response import BufferedResponse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+
+def async_identifiers_client(config, **kwargs):
+    base_url = config.get('client', 'service_url')
+    if 'compress_min_size' not in kwargs:
+        kwargs['compress_min_size'] = compression.min_size_from_config(config)
+    return AsyncIdentifierClient(
+        base_url,
+        app_name=_app_name,
+        authorizer=AsyncAuthorizer(config_authorizer(config)),
+        **kwargs)
+
+
+class AsyncAuthorizer(object):
+    """
+    Wraps a globus_sdk authorizer for use from coroutines. When the access
+    token of a RefreshTokenAuthorizer needs renewing, the first coroutine to
+    notice performs the refresh (in an executor, as the auth client is
+    blocking) while any others wait for it, so concurrent requests result in
+    a single refresh.
+    """
+
+    def __init__(self, authorizer):
+        self.authorizer = authorizer
+        self._lock = None
+
+    def _needs_refresh(self):
+        if not hasattr(self.authorizer, 'check_expiration_time'):
+            return False
+        return (self.authorizer.access_token is None
+                or self.authorizer.expires_at is None
+                or time.time() > self.authorizer.expires_at)
+
+    async def set_authorization_header(self, header_dict):
+        if self._needs_refresh():
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                # Re-check: another coroutine may have refreshed while we
+                # waited for the lock
+                if self._needs_refresh():
+                    log.debug('AsyncAuthorizer refreshing access token')
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(
+                        None, self.authorizer.check_expiration_time)
+        self.authorizer.set_authorization_header(header_dict)
+
+    def handle_missing_authorization(self, used_header):
+        """
+        Invalidate the current access token after a 401, unless the request
+        was made with an older token which has since been replaced.
+        """
+        current = {}
+        if getattr(self.authorizer, 'access_token', None) is not None:
+            current['Authorization'] = 'Bearer {}'.format(
+                self.authorizer.access_token)
+        if current.get('Authorization') != used_header:
+            return True
+        return self.authorizer.handle_missing_authorization()
+
+
+class AsyncIdentifierClient(object):
+    """
+    An asyncio counterpart to IdentifierClient offering the same namespace
+    and identifier operations as coroutines. Requests share a single aiohttp
+    session whose connection pool holds at most ``max_connections``
+    connections. JSON request bodies of at least ``compress_min_size``
+    bytes are sent gzip compressed, as by IdentifierClient. Its requests
+    are reported to metrics hooks as IdentifierClient's are. Requires the
+    ``aiohttp`` package.
+
+    Use as ``async with AsyncIdentifierClient(...) as client:`` or call
+    ``close()`` when done.
+    """
+
+    error_class = IdentifierClientError
+
+    def __init__(self, base_url, authorizer=None, app_name=None,
+                 http_timeout=60, max_connections=DEFAULT_CONCURRENCY * 4,
+                 compress_min_size=None):
+        if aiohttp is None:
+            raise ImportError(
+                'AsyncIdentifierClient requires the aiohttp package')
+        if authorizer is not None and not isinstance(authorizer,
+                                                     AsyncAuthorizer):
+            authorizer = AsyncAuthorizer(authorizer)
+        self.base_url = base_url
+        self.authorizer = authorizer
+        self.http_timeout = http_timeout
+        self.max_connections = max_connections
+        self.compress_min_size = compress_min_size
+        self.compression_stats = compression.CompressionStats()
+        self._headers = {
+            'Accept': 'application/json',
+            'User-Agent': BaseClient.BASE_USER_AGENT,
+        }
+        if app_name is not None:
+            self._headers['User-Agent'] = '{}/{}'.format(
+                BaseClient.BASE_USER_AGENT, app_name)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # The session must be created from within the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.http_timeout))
+        return self._session
+
+    def qjoin_path(self, *parts):
+        return "/" + "/".join(quote(part) for part in parts)
+
+    async def _request(self, method, path, params=None, json_body=None):
+        rheaders = dict(self._headers)
+        data = None
+        if json_body is not None:
+            data, body_headers, size = compression.encode_json_body(
+                json_body, self.compress_min_size)
+            rheaders.update(body_headers)
+        url = slash_join(self.base_url, path)
+
+        async def send_request(attempt):
+            if self.authorizer is not None:
+                await self.authorizer.set_authorization_header(rheaders)
+            started = time.time()
+            headers_at = response = error = None
+            try:
+                async with self._get_session().request(
+                        method, url, params=params, data=data,
+                        headers=rheaders) as r:
+                    headers_at = time.time()
+                    content = await r.read()
+                    response = BufferedResponse(r.status, r.headers, content,
+                                                str(r.url))
+                    return response
+            except asyncio.TimeoutError as e:
+                error = e
+                raise GlobusTimeoutError('TimeoutError on request', e)
+            except aiohttp.ClientConnectionError as e:
+                error = e
+                raise GlobusConnectionError('ConnectionError on request', e)
+            except aiohttp.ClientError as e:
+                error = e
+                raise NetworkError('NetworkError on request', e)
+            finally:
+                if metrics.enabled():
+                    self._emit_request(method, url, data, attempt, started,
+                                       headers_at, response, error)
+
+        def retrying(attempt, reason):
+            log.debug('retrying %s %s (HTTP status %s), attempt %s', method,
+                      url, reason, attempt)
+            if metrics.enabled():
+                metrics.emit('retry', method=method, url=url,
+                             endpoint=metrics.endpoint_for(
+                                 urlparse(url).path),
+                             attempt=attempt, reason=reason, delay=0)
+
+        r = await send_request(0)
+        attempt = 0
+        if r.status_code == 401 and self.authorizer is not None:
+            if self.authorizer.handle_missing_authorization(
+                    rheaders.get('Authorization')):
+                attempt += 1
+                retrying(attempt, '401')
+                r = await send_request(attempt)
+        if 'Content-Encoding' in rheaders:
+            if r.status_code == 415:
+                log.warning('The service does not accept compressed '
+                            'requests; sending them uncompressed from now on')
+                self.compress_min_size = None
+                data, body_headers, _ = compression.encode_json_body(
+                    json_body, None)
+                del rheaders['Content-Encoding']
+                rheaders.update(body_headers)
+                attempt += 1
+                retrying(attempt, '415')
+                r = await send_request(attempt)
+            else:
+                self.compression_stats.add(size, len(data))
+
+        if 200 <= r.status_code < 400:
+            return GlobusHTTPResponse(r, client=self)
+        raise self.error_class(r)
+
+    def _emit_request(self, method, url, data, attempt, started, headers_at,
+                      response, error):
+        # The same http_request event as the RequestScheduler's, but there
+        # is no queue to wait in, and the body is always read
+        finished = time.time()
+        metrics.emit(
+            'http_request',
+            method=method,
+            url=url if response is None else response.url,
+            endpoint=metrics.endpoint_for(urlparse(url).path),
+            status=None if response is None else response.status_code,
+            error=None if error is None else type(error).__name__,
+            attempt=attempt,
+            queue=0.0,
+            ttfb=None if headers_at is None else headers_at - started,
+            transfer=(None if response is None else finished - headers_at),
+            total=finished - started,
+            sent=len(data) if data else 0,
+            received=None if response is None else len(response.content))
+
+    async def get(self, path, params=None):
+        return await self._request('GET', path, params=params)
+
+    async def post(self, path, json_body=None, params=None):
+        return await self._request(
+            'POST', path, params=params, json_body=json_body)
+
+    async def put(self, path, json_body=None, params=None):
+        return await self._request(
+            'PUT', path, params=params, json_body=json_body)
+
+    async def delete(self, path, params=None):
+        return await self._request('DELETE', path, params=params)
+
+    async def create_namespace(self, **kwargs):
+        """
+        ``POST /namespace``
+
+        Takes the same parameters as ``IdentifierClient.create_namespace``
+        """
+        kwargs = _json_parse_args(kwargs, _namespace_json_props)
+        kwargs, body = _split_dict(kwargs, _namespace_properties)
+        log.info("AsyncIdentifierClient.create_namespace(%s, ...)",
+                 body.get('display_name'))
+        path = self.qjoin_path("namespace")
+        return await self.post(path, body, params=kwargs)
+
+    async def update_namespace(self, namespace_id, **kwargs):
+        """
+        ``PUT /namespace/<id>``
+
+        Takes the same parameters as ``IdentifierClient.update_namespace``
+        """
+        kwargs = _json_parse_args(kwargs, _namespace_json_props)
+        kwargs, body = _split_dict(kwargs, _namespace_properties)
+        log.info("AsyncIdentifierClient.update_namespace(%s, ...)",
+                 namespace_id)
+        path = self.qjoin_path("namespace", safe_stringify(namespace_id))
+        return await self.put(path, body, params=kwargs)
+
+    async def get_namespace(self, namespace_id, **params):
+        """
+        ``GET /namespace/<namespace_id>``
+        """
+        path = self.qjoin_path("namespace", safe_stringify(namespace_id))
+        log.info("AsyncIdentifierClient.get_namespace(%s)",
+                 namespace_id)
+        return await self.get(path, params=params)
+
+    async def delete_namespace(self, namespace_id, **params):
+        """
+        ``DELETE /namespace/<namespace_id>``
+        """
+        path = self.qjoin_path("namespace", safe_stringify(namespace_id))
+        log.info("AsyncIdentifierClient.delete_namespace(%s)",
+                 namespace_id)
+        return await self.delete(path, params=params)
+
+    async def create_identifier(self, **kwargs):
+        """
+        ``POST /namespace/<namespace_id>/identifier``
+
+        Takes the same parameters as ``IdentifierClient.create_identifier``
+        """
+        kwargs = _json_parse_args(kwargs, _identifier_json_props)
+        kwargs, body = _split_dict(kwargs, _identifier_properties)
+        log.info('AsyncIdentifierClient.create_identifier(%s, ...)',
+                 kwargs.get('namespace'))
+        path = self.qjoin_path('namespace/{}/identifier'.format(
+            kwargs['namespace']))
+        return await self.post(path, body, params=kwargs)
+
+    async def get_identifier(self, identifier_id, **params):
+        """
+        ``GET /<identifier_id>``
+        """
+        path = safe_stringify(identifier_id)
+        log.info('AsyncIdentifierClient.get_identifier(%s)',
+                 identifier_id)
+        return await self.get(path, params=params)
+
+    async def update_identifier(self, identifier_id, **kwargs):
+        """
+        ``PUT /<identifier_id>``
+
+        Takes the same parameters as ``IdentifierClient.update_identifier``
+        """
+        kwargs = _json_parse_args(kwargs, _identifier_json_props)
+        kwargs, body = _split_dict(kwargs, _identifier_properties)
+        log.info('AsyncIdentifierClient.update_identifier(%s, ...)',
+                 identifier_id)
+        return await self.put(identifier_id, body, params=kwargs)
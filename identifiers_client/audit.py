@@ -0,0 +1,360 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from identifiers_client import metadata
+from identifiers_client.batch import (DEFAULT_CONCURRENCY, bounded_map,
+                                      size_connection_pool)
+from identifiers_client.download import STREAM_CHUNK_SIZE
+from identifiers_client.identifiers_api import _json_parse_args
+
+log = logging.getLogger(__name__)
+
+# Results of auditing an identifier, or one of its locations
+PASS = 'pass'
+FAIL = 'fail'
+UNREACHABLE = 'unreachable'
+# The identifier has no location, or no checksum which can be computed
+UNVERIFIABLE = 'unverifiable'
+# The identifier's record couldn't be retrieved
+ERROR = 'error'
+# Already audited by the run being resumed
+DONE = 'done'
+
+# Errors getting a record which running the audit again won't fix
+_permanent_statuses = (404, 410)
+
+LocationResult = namedtuple('LocationResult',
+                            ['url', 'status', 'size', 'error'])
+
+AuditResult = namedtuple('AuditResult',
+                         ['index', 'identifier', 'status', 'locations',
+                          'error'])
+
+AuditRun = namedtuple('AuditRun',
+                      ['id', 'sample_start', 'sample_percent', 'started_at'])
+
+
+class BandwidthLimit(object):
+    """
+    Limits the rate at which any number of threads read data, together, to
+    ``rate`` bytes a second. A thread reading ahead of the limit is made to
+    wait until the bytes it read are paid for, so no more than about one
+    chunk per thread is ever read early.
+    """
+
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError('The bandwidth limit must be positive')
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._available = 0.0
+        self._updated = time.time()
+
+    def consume(self, size):
+        """Account for size bytes read, waiting if they exceed the rate."""
+        with self._lock:
+            now = time.time()
+            # Up to a second of unused bandwidth may be spent in a burst
+            self._available = min(
+                self.rate, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            self._available -= size
+            wait = -self._available / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def in_sample(identifier, start, percent):
+    """
+    Whether identifier is in the sample of ``percent`` percent of
+    identifiers starting at ``start`` percent. Each identifier has a fixed
+    place in [0, 100) given by its hash, so consecutive samples, each
+    starting where the last ended, cover every identifier exactly once.
+    """
+    if percent >= 100:
+        return True
+    digest = hashlib.sha256(identifier.encode('utf-8')).digest()
+    place = struct.unpack('>I', digest[:4])[0] * 100.0 / 2**32
+    return (place - start) % 100 < percent
+
+
+class AuditStore(object):
+    """
+    The latest audit result for each identifier, and the runs which made
+    them, kept in a SQLite database at path.
+
+    A run covers a sample of identifiers (see ``in_sample``) and finishes
+    once every one of them has a result. An unfinished run is resumed by the
+    next audit with the same sample size, skipping the identifiers it has
+    already audited, and each new run samples where the last finished one
+    stopped, so that a series of runs works through every identifier.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, sample_start REAL, '
+            'sample_percent REAL, started_at REAL, finished_at REAL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'identifier TEXT PRIMARY KEY, status TEXT, checked_at REAL, '
+            'run INTEGER, locations TEXT)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS results_run ON results (run)')
+        self._db.commit()
+
+    def start_run(self, sample_percent=100):
+        """
+        Resume the last run, if it is unfinished and samples the same
+        percentage of identifiers, or else start a new one. Returns an
+        AuditRun.
+        """
+        sample_percent = min(100.0, float(sample_percent))
+        if sample_percent <= 0:
+            raise ValueError('The sample must be more than 0 percent')
+        with self._lock:
+            row = self._db.execute(
+                'SELECT id, sample_start, sample_percent, started_at, '
+                'finished_at FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+            if (row is not None and row[4] is None
+                    and row[2] == sample_percent):
+                log.info('resuming audit run %s', row[0])
+                return AuditRun(*row[:4])
+            finished = self._db.execute(
+                'SELECT sample_start, sample_percent FROM runs WHERE '
+                'finished_at IS NOT NULL ORDER BY id DESC LIMIT 1').fetchone()
+            start = 0.0
+            if finished is not None and sample_percent < 100:
+                start = (finished[0] + finished[1]) % 100
+            started_at = time.time()
+            cursor = self._db.execute(
+                'INSERT INTO runs (sample_start, sample_percent, started_at) '
+                'VALUES (?, ?, ?)', (start, sample_percent, started_at))
+            self._db.commit()
+            return AuditRun(cursor.lastrowid, start, sample_percent,
+                            started_at)
+
+    def finish_run(self, run):
+        with self._lock:
+            self._db.execute('UPDATE runs SET finished_at = ? WHERE id = ?',
+                             (time.time(), run.id))
+            self._db.commit()
+
+    def audited(self, run, identifier):
+        """Whether run has already audited identifier."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM results WHERE identifier = ? AND run = ?',
+                (identifier, run.id)).fetchone() is not None
+
+    def record(self, run, identifier, status, locations):
+        """Save the result of auditing identifier, replacing any earlier
+        one."""
+        locations = json.dumps([loc._asdict() for loc in locations or []])
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                (identifier, status, time.time(), run.id, locations))
+            self._db.commit()
+
+    def summary(self):
+        """The number of identifiers with each latest result, and the most
+        recent run."""
+        with self._lock:
+            counts = dict(self._db.execute(
+                'SELECT status, COUNT(*) FROM results GROUP BY status'))
+            row = self._db.execute(
+                'SELECT id, sample_start, sample_percent, started_at, '
+                'finished_at FROM runs ORDER BY id DESC LIMIT 1').fetchone()
+        last_run = None
+        if row is not None:
+            last_run = dict(zip(('id', 'sample_start', 'sample_percent',
+                                 'started_at', 'finished_at'), row))
+        return {'results': counts, 'last_run': last_run}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Auditor(object):
+    """
+    Checks the data at an identifier's locations against its checksums,
+    hashing each response as it streams in without writing it anywhere.
+    Reads by every thread using the Auditor share an optional
+    BandwidthLimit.
+    """
+
+    def __init__(self, connections=DEFAULT_CONCURRENCY, limit=None,
+                 timeout=60, chunk_size=STREAM_CHUNK_SIZE, session=None):
+        self.limit = limit
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max(1, connections))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def check_location(self, url, checksums, size=None):
+        """
+        Stream url, comparing its data with checksums (a dict of hashlib
+        algorithm name to hex digest) and size, if known. Returns a
+        LocationResult.
+        """
+        hashers = dict((name, hashlib.new(name)) for name in checksums)
+        received = 0
+        try:
+            # Compressed responses would be hashed as decompressed, but
+            # their size would count the compressed bytes
+            r = self.session.get(url, stream=True, timeout=self.timeout,
+                                 headers={'Accept-Encoding': 'identity'})
+            with r:
+                if r.status_code != 200:
+                    return LocationResult(url, UNREACHABLE, None,
+                                          'HTTP status {}'.format(
+                                              r.status_code))
+                for chunk in r.iter_content(self.chunk_size):
+                    if self.limit is not None:
+                        self.limit.consume(len(chunk))
+                    received += len(chunk)
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+        except requests.RequestException as e:
+            return LocationResult(url, UNREACHABLE, None, str(e))
+        mismatched = sorted(
+            name for name, hasher in hashers.items()
+            if hasher.hexdigest() != checksums[name].lower())
+        if mismatched:
+            return LocationResult(url, FAIL, received,
+                                  '{} checksum mismatch'.format(
+                                      ', '.join(mismatched)))
+        if size is not None and received != size:
+            return LocationResult(url, FAIL, received,
+                                  'expected {} bytes'.format(size))
+        return LocationResult(url, PASS, received, None)
+
+    def check(self, record):
+        """
+        Check every location of an Identifiers service record (or other
+        metadata ``metadata.normalize`` understands). Returns ``(status,
+        [LocationResult])``: 'fail' if any location's data doesn't match,
+        'unreachable' if any couldn't be read, otherwise 'pass', or
+        'unverifiable' when there is nothing to check.
+        """
+        normalized = metadata.normalize(record)
+        checksums = {}
+        for name, value in normalized.checksums:
+            try:
+                hashlib.new(name)
+            except ValueError:
+                continue
+            checksums[name] = value
+        if not normalized.content_urls or not checksums:
+            return UNVERIFIABLE, []
+        results = [self.check_location(url, checksums, normalized.size)
+                   for url in normalized.content_urls]
+        statuses = set(result.status for result in results)
+        for status in (FAIL, UNREACHABLE):
+            if status in statuses:
+                return status, results
+        return PASS, results
+
+
+def _permanent(error):
+    return getattr(error, 'http_status', None) in _permanent_statuses
+
+
+def audit(client, records, store, sample_percent=100,
+          concurrency=DEFAULT_CONCURRENCY, bandwidth=None, timeout=60):
+    """
+    Audit the identifiers given by records, checking the data at each of
+    their locations against their checksums, up to ``concurrency``
+    identifiers at once, and yield an AuditResult for each in input order.
+
+    Records name an ``identifier``. Those which also have ``location`` and
+    ``checksums`` (such as the output of ``namespace-export``) are checked
+    as given; others are first retrieved from the service.
+
+    Only the identifiers in the sample of the run started or resumed in the
+    AuditStore (see ``AuditStore.start_run``) are audited, and those the run
+    has already audited are yielded as 'done'. Each result is saved in the
+    store as it arrives. The run is finished once every identifier in its
+    sample has a result; identifiers whose record couldn't be retrieved,
+    other than because it doesn't exist, are left to be retried when the
+    run is resumed. ``bandwidth`` limits the bytes a second read from all
+    locations together.
+    """
+    run = store.start_run(sample_percent)
+    size_connection_pool(client, concurrency)
+    limit = BandwidthLimit(bandwidth) if bandwidth else None
+    auditor = Auditor(concurrency, limit, timeout)
+    log.info('audit run %s: %s%% of identifiers from %s%%', run.id,
+             run.sample_percent, run.sample_start)
+
+    def _sampled():
+        for record in records:
+            identifier = (record.get('identifier')
+                          if isinstance(record, dict) else None)
+            if identifier is None or in_sample(
+                    identifier, run.sample_start, run.sample_percent):
+                yield record
+
+    def _audit(record):
+        identifier = record.get('identifier')
+        if not identifier:
+            raise ValueError('Record has no identifier')
+        if store.audited(run, identifier):
+            return DONE, None
+        # Values read from CSV are JSON encoded
+        record = _json_parse_args(dict(record),
+                                  ['location', 'checksums', 'metadata'])
+        if record.get('location') is None or record.get('checksums') is None:
+            record = client.get_identifier(identifier).data
+        return auditor.check(record)
+
+    complete = True
+    counts = {}
+    for index, record, result, error in bounded_map(_audit, _sampled(),
+                                                    concurrency):
+        identifier = record.get('identifier') if isinstance(record,
+                                                            dict) else None
+        if error is not None:
+            if identifier is not None:
+                if _permanent(error):
+                    store.record(run, identifier, ERROR, None)
+                else:
+                    complete = False
+            counts[ERROR] = counts.get(ERROR, 0) + 1
+            yield AuditResult(index, identifier, ERROR, None, error)
+            continue
+        status, locations = result
+        if status != DONE:
+            store.record(run, identifier, status, locations)
+        counts[status] = counts.get(status, 0) + 1
+        yield AuditResult(index, identifier, status, locations, None)
+    if complete:
+        store.finish_run(run)
+    log.info('audit run %s %s: %s', run.id,
+             'finished' if complete else 'left unfinished', counts)
@@ -0,0 +1,267 @@
+import hashlib
+import io
+import logging
+import os
+import re
+from collections import OrderedDict, namedtuple
+from urllib.parse import quote
+
+from identifiers_client.batch import (DEFAULT_CONCURRENCY, bounded_map,
+                                      size_connection_pool)
+
+log = logging.getLogger(__name__)
+
+# Where the identifiers minted for a bag's files are written, one
+# "<identifier> <path>" line per file in the manner of a manifest
+IDENTIFIERS_FILE = 'metadata/identifiers.txt'
+
+# Manifests are read in this order, so the strongest checksum comes first
+_algorithms = ('sha512', 'sha256', 'sha1', 'md5')
+
+_manifest_name = re.compile(r'^(tag)?manifest-(\w+)\.txt$')
+
+# The identifiers file is synced to disk after this many identifiers
+_SYNC_EVERY = 1000
+
+BagFile = namedtuple('BagFile', ['path', 'size', 'checksums', 'urls'])
+
+MintResult = namedtuple('MintResult',
+                        ['index', 'path', 'identifier', 'status', 'error'])
+
+
+def _decode_path(path):
+    # BagIt percent-encodes only these characters in manifest paths
+    return (path.replace('%0A', '\n').replace('%0D', '\r')
+            .replace('%25', '%'))
+
+
+def _encode_path(path):
+    return (path.replace('%', '%25').replace('\n', '%0A')
+            .replace('\r', '%0D'))
+
+
+def _lines(path):
+    with io.open(path, encoding='utf-8-sig', newline='') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.strip():
+                yield line
+
+
+def _manifests(bag_dir, tag=False):
+    """``(algorithm, path)`` of each of the bag's payload (or tag)
+    manifests, strongest algorithm first."""
+    found = {}
+    for name in os.listdir(bag_dir):
+        match = _manifest_name.match(name)
+        if match and bool(match.group(1)) == tag:
+            found[match.group(2).lower()] = os.path.join(bag_dir, name)
+    return sorted(found.items(),
+                  key=lambda item: (_algorithms.index(item[0])
+                                    if item[0] in _algorithms else
+                                    len(_algorithms), item[0]))
+
+
+def read_manifest(path):
+    """Yield ``(path, digest)`` for each line of a manifest."""
+    for line in _lines(path):
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            raise ValueError('{}: malformed line: {}'.format(path, line))
+        yield _decode_path(parts[1].lstrip()), parts[0]
+
+
+def read_fetch(path):
+    """
+    Read a fetch.txt, returning a dict of payload path to ``(urls, size)``
+    where size is None if the fetch file gives none.
+    """
+    fetch = {}
+    for line in _lines(path):
+        parts = line.split(None, 2)
+        if len(parts) != 3:
+            raise ValueError('{}: malformed line: {}'.format(path, line))
+        url, length, file_path = parts
+        file_path = _decode_path(file_path)
+        size = int(length) if length.isdigit() else None
+        urls, known = fetch.get(file_path, ([], None))
+        urls.append(url)
+        fetch[file_path] = (urls, known if size is None else size)
+    return fetch
+
+
+def read_bag(bag_dir):
+    """
+    Return a BagFile for each file of the bag in directory bag_dir, in the
+    order of its strongest manifest, with the checksums given by every
+    manifest, the remote URLs given by fetch.txt and the size from
+    fetch.txt or, for a file present in the bag, from the file system.
+    Nothing is hashed: a bag validated with ``bdbag --validate full``
+    already has correct manifests.
+    """
+    if not os.path.isdir(bag_dir):
+        raise ValueError('{} is not a bag directory (extract an archived '
+                         'bag first)'.format(bag_dir))
+    manifests = _manifests(bag_dir)
+    if not manifests:
+        raise ValueError('{} has no payload manifest'.format(bag_dir))
+    files = OrderedDict()
+    for algorithm, manifest in manifests:
+        for path, digest in read_manifest(manifest):
+            files.setdefault(path, {})[algorithm] = digest.lower()
+    fetch_path = os.path.join(bag_dir, 'fetch.txt')
+    fetch = read_fetch(fetch_path) if os.path.exists(fetch_path) else {}
+    bag_files = []
+    for path, checksums in files.items():
+        urls, size = fetch.get(path, ([], None))
+        if size is None:
+            try:
+                size = os.path.getsize(os.path.join(bag_dir, path))
+            except OSError:
+                pass
+        bag_files.append(BagFile(path, size, checksums, urls))
+    return bag_files
+
+
+def file_record(bag_file, base_url=None):
+    """
+    The ``create_identifier`` arguments (less namespace and visible_to) for
+    bag_file. Its location is the URLs from fetch.txt or, for a file with
+    none, its path within the payload appended to base_url, if given.
+    """
+    urls = list(bag_file.urls)
+    if not urls and base_url:
+        payload_path = bag_file.path.split('/', 1)[-1]
+        urls.append(base_url.rstrip('/') + '/' + quote(payload_path))
+    metadata = {'name': os.path.basename(bag_file.path)}
+    if bag_file.size is not None:
+        metadata['contentSize'] = bag_file.size
+    record = {
+        'checksums': [{
+            'function': function,
+            'value': value
+        } for function, value in sorted(bag_file.checksums.items())],
+        'metadata': metadata
+    }
+    if urls:
+        record['location'] = urls
+    return record
+
+
+def read_identifiers(bag_dir):
+    """The identifiers already written to the bag, by payload path."""
+    path = os.path.join(bag_dir, IDENTIFIERS_FILE)
+    if not os.path.exists(path):
+        return {}
+    return dict((file_path, identifier)
+                for file_path, identifier in read_manifest(path))
+
+
+class IdentifiersWriter(object):
+    """
+    Appends minted identifiers to the bag's identifiers file as they
+    arrive, so that a run which is interrupted keeps what it minted, and
+    on close brings the bag's tag manifests up to date with the file.
+    """
+
+    def __init__(self, bag_dir):
+        self.bag_dir = bag_dir
+        self.path = os.path.join(bag_dir, IDENTIFIERS_FILE)
+        self._file = None
+        self._unsynced = 0
+
+    def write(self, path, identifier):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._file = io.open(self.path, 'a', encoding='utf-8',
+                                 newline='\n')
+        self._file.write(u'{} {}\n'.format(identifier, _encode_path(path)))
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= _SYNC_EVERY:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+        update_tag_manifests(self.bag_dir, IDENTIFIERS_FILE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def update_tag_manifests(bag_dir, tag_path):
+    """Set the checksum of the tag file tag_path in each of the bag's tag
+    manifests, so the bag still validates."""
+    for algorithm, manifest in _manifests(bag_dir, tag=True):
+        digest = hashlib.new(algorithm)
+        with open(os.path.join(bag_dir, tag_path), 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        lines = [line for line in _lines(manifest)
+                 if _decode_path(line.split(None, 1)[-1].lstrip()) != tag_path]
+        lines.append(u'{} {}'.format(digest.hexdigest(),
+                                     _encode_path(tag_path)))
+        tmp = manifest + '.tmp'
+        with io.open(tmp, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(u'\n'.join(lines) + u'\n')
+        os.rename(tmp, manifest)
+
+
+def mint_bag(client, bag_dir, namespace, visible_to, base_url=None,
+             concurrency=DEFAULT_CONCURRENCY, dedupe=False):
+    """
+    Mint an identifier for every file of the bag in directory bag_dir,
+    running up to ``concurrency`` requests at once, and yield a MintResult
+    for each in manifest order.
+
+    Records are built from the bag's manifests and fetch.txt (see
+    ``read_bag`` and ``file_record``) and created in namespace, visible to
+    visible_to. Each identifier minted is written to the bag's identifiers
+    file (IDENTIFIERS_FILE), and files already listed there are skipped, so
+    an interrupted run can simply be repeated. ``dedupe`` is passed to
+    ``create_identifier``.
+
+    The status of a result is 'minted', 'deduplicated' (an identifier
+    already minted for the same data, see ``create_identifier``),
+    'existing' (already in the identifiers file) or 'error'.
+    """
+    files = read_bag(bag_dir)
+    existing = read_identifiers(bag_dir)
+    log.info('minting identifiers for %s files of %s (%s already minted)',
+             len(files), bag_dir, len(existing))
+    size_connection_pool(client, concurrency)
+
+    def _mint(bag_file):
+        if bag_file.path in existing:
+            return existing[bag_file.path], 'existing'
+        record = file_record(bag_file, base_url)
+        response = client.create_identifier(
+            namespace=namespace, visible_to=visible_to, dedupe=dedupe,
+            **record)
+        status = 'deduplicated' if response.get('deduplicated') else 'minted'
+        return response['identifier'], status
+
+    with IdentifiersWriter(bag_dir) as writer:
+        for index, bag_file, result, error in bounded_map(
+                _mint, files, concurrency):
+            if error is not None:
+                log.debug('minting for %s failed: %s', bag_file.path, error)
+                yield MintResult(index, bag_file.path, None, 'error', error)
+                continue
+            identifier, status = result
+            if status != 'existing':
+                writer.write(bag_file.path, identifier)
+            yield MintResult(index, bag_file.path, identifier, status, None)
@@ -0,0 +1,232 @@
+import csv
+import json
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                as_completed, wait)
+
+from requests.adapters import HTTPAdapter
+
+from identifiers_client import defaults
+from identifiers_client.output import dumps
+from identifiers_client.scheduler import mount
+
+DEFAULT_CONCURRENCY = defaults.BATCH_CONCURRENCY
+
+# Columns accepted in a batch input file. Values for the JSON properties may
+# be either JSON encoded strings (as on the command line) or, for NDJSON
+# input, already decoded lists / dicts.
+_record_fields = ['namespace', 'location', 'checksums', 'metadata',
+                  'visible_to']
+
+# Columns written when exporting records as CSV
+_export_fields = ['identifier'] + _record_fields
+
+BatchResult = namedtuple('BatchResult', ['index', 'record', 'response',
+                                         'error'])
+
+
+def _guess_format(first, fields):
+    if first.lstrip().startswith('{'):
+        return 'ndjson'
+    header = [name.strip() for name in first.split(',')]
+    if 'identifier' in fields and not any(name in fields for name in header):
+        return 'ids'
+    return 'csv'
+
+
+def read_records(stream, fmt=None, fields=_record_fields):
+    """
+    Yield identifier records from a file-like object containing either
+    newline delimited JSON (one object per line), CSV with a header row
+    naming the record fields, or (when ``fields`` includes 'identifier')
+    one identifier per line, read as ``{'identifier': id}``. ``fmt`` may be
+    'ndjson', 'csv' or 'ids'; when not given it is guessed from the first
+    non-blank line of the stream. CSV columns not in ``fields`` are ignored.
+    """
+    # Blank lines skipped while guessing still count in line numbers
+    first_line_no = 1
+    if fmt is None:
+        first = stream.readline()
+        while first and not first.strip():
+            first = stream.readline()
+            first_line_no += 1
+        fmt = _guess_format(first, fields)
+        lines = _chain_first(first, stream)
+    else:
+        lines = stream
+
+    if fmt == 'ndjson':
+        for line_no, line in enumerate(lines, first_line_no):
+            line = line.strip()
+            if not line:
+                continue
+            # A malformed line is handed on as an error for that record so
+            # that it does not end the whole run
+            try:
+                record = json.loads(line)
+            except ValueError as err:
+                record = ValueError('line {}: {}'.format(line_no, err))
+            yield record
+    elif fmt == 'csv':
+        for row in csv.DictReader(lines):
+            yield dict((k, v) for k, v in row.items()
+                       if k in fields and v not in (None, ''))
+    elif fmt == 'ids':
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield {'identifier': line}
+    else:
+        raise ValueError('unknown record format: {}'.format(fmt))
+
+
+def write_records(records, stream, fmt='ndjson'):
+    """
+    Write identifier records to a text stream in either of the formats read
+    by ``read_records``: 'ndjson', or 'csv' with a column for each of
+    identifier, namespace, location, checksums, metadata and visible_to
+    (other properties are left out, and lists and dicts are JSON encoded).
+    Records are written as they are iterated. Returns the number written.
+    """
+    count = 0
+    if fmt == 'ndjson':
+        for record in records:
+            stream.write(dumps(record))
+            stream.write('\n')
+            count += 1
+    elif fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(_export_fields)
+        for record in records:
+            writer.writerow([
+                dumps(v) if isinstance(v, (list, dict)) else v
+                for v in (record.get(name, '') for name in _export_fields)
+            ])
+            count += 1
+    else:
+        raise ValueError('unknown record format: {}'.format(fmt))
+    return count
+
+
+def _chain_first(first, stream):
+    if first:
+        yield first
+    for line in stream:
+        yield line
+
+
+def bounded_map(func, items, concurrency=DEFAULT_CONCURRENCY, ordered=True):
+    """
+    Apply func to each of items on a pool of ``concurrency`` threads and
+    yield ``(index, item, result, error)`` in input order, or with
+    ``ordered`` False as each call completes. At most 2 * concurrency items
+    are in flight at once, so items may be a lazy iterator of any length.
+    An exception raised by func is returned as the error for that item
+    rather than propagated, as is an item which is itself an exception
+    (e.g. a record that could not be read).
+    """
+    concurrency = max(1, int(concurrency))
+
+    def _call(item):
+        try:
+            if isinstance(item, Exception):
+                raise item
+            return func(item), None
+        except Exception as err:
+            return None, err
+
+    if not ordered:
+        for result in _unordered_map(_call, items, concurrency):
+            yield result
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, item in enumerate(items):
+            pending.append((index, item, pool.submit(_call, item)))
+            if len(pending) >= concurrency * 2:
+                index, item, future = pending.popleft()
+                yield (index, item) + future.result()
+        while pending:
+            index, item, future = pending.popleft()
+            yield (index, item) + future.result()
+
+
+def _unordered_map(call, items, concurrency):
+    pending = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, item in enumerate(items):
+            pending[pool.submit(call, item)] = (index, item)
+            if len(pending) >= concurrency * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future) + future.result()
+        for future in as_completed(list(pending)):
+            yield pending.pop(future) + future.result()
+
+
+def prefetch(items, size):
+    """
+    Iterate over items in a background thread, keeping up to ``size`` of them
+    ready, so that producing the next items (e.g. fetching the next page of
+    results) overlaps with consuming the current ones. An exception raised
+    by items is raised to the consumer in its place.
+    """
+    ready = queue.Queue(maxsize=max(1, size))
+    stop = threading.Event()
+    end = object()
+
+    def _put(entry):
+        while not stop.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in items:
+                if not _put((item, None)):
+                    break
+            else:
+                _put((end, None))
+        except Exception as err:
+            _put((None, err))
+        finally:
+            if stop.is_set() and hasattr(items, 'close'):
+                items.close()
+
+    producer = threading.Thread(target=_produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        # The consumer has stopped, perhaps early: let the producer go
+        stop.set()
+
+
+def size_connection_pool(client, concurrency):
+    """
+    Make sure the client's session keeps enough pooled connections open for
+    ``concurrency`` simultaneous requests against its service.
+    """
+    pool_maxsize = max(concurrency, DEFAULT_CONCURRENCY)
+    scheduler = getattr(client, 'scheduler', None)
+    if scheduler is not None:
+        # Keep sending requests through the client's scheduler
+        mount(client._session, scheduler, pool_connections=1,
+              pool_maxsize=pool_maxsize)
+        return
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    client._session.mount('https://', adapter)
+    client._session.mount('http://', adapter)
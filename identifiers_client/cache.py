@@ -0,0 +1,211 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlencode
+
+from identifiers_client.response import BufferedResponse
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+DEFAULT_MEMORY_ENTRIES = 4096
+
+# Response headers kept with a cached body; the validators are sent back
+# when revalidating a stale entry
+_kept_headers = ('Content-Type', 'ETag', 'Last-Modified')
+
+CacheEntry = namedtuple('CacheEntry', ['stored_at', 'headers', 'content'])
+
+
+def cache_key(base_url, path, params=None):
+    key = base_url.rstrip('/') + '/' + path.lstrip('/')
+    if params:
+        key += '?' + urlencode(sorted(params.items()))
+    return key
+
+
+class MemoryStore(object):
+    """An in-memory LRU map of cache keys to CacheEntry."""
+
+    def __init__(self, max_entries=DEFAULT_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_prefix(self, key):
+        with self._lock:
+            for k in [k for k in self._entries
+                      if k == key or k.startswith(key + '?')]:
+                del self._entries[k]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore(object):
+    """A CacheEntry store kept in a SQLite database at path."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, stored_at REAL, headers TEXT, '
+            'content BLOB)')
+        self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT stored_at, headers, content FROM responses '
+                'WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            return None
+        return CacheEntry(row[0], json.loads(row[1]), bytes(row[2]))
+
+    def set(self, key, entry):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, entry.stored_at, json.dumps(entry.headers),
+                 sqlite3.Binary(entry.content)))
+            self._db.commit()
+
+    def delete_prefix(self, key):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM responses WHERE key = ? OR '
+                'substr(key, 1, ?) = ?', (key, len(key) + 1, key + '?'))
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ResponseCache(object):
+    """
+    Cache of GET responses, checked in each of ``stores`` in turn (fastest
+    first) and filled into all of them. Entries younger than ``ttl``
+    seconds are served without a request; older entries are revalidated
+    with If-None-Match / If-Modified-Since when the service sent an ETag or
+    Last-Modified, and otherwise fetched again.
+
+    ``stats`` counts hits (served fresh), revalidations (a 304 confirmed a
+    stale entry), misses (full responses fetched), and invalidations.
+    """
+
+    def __init__(self, stores, ttl=DEFAULT_TTL):
+        self.stores = list(stores)
+        self.ttl = ttl
+        self.stats = dict(hits=0, revalidated=0, misses=0, invalidated=0)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the cache described by the optional ``[cache]`` section of
+        config (options ``path``, ``ttl`` and ``memory_entries``), or return
+        None when there is no such section.
+        """
+        if not config.has_section('cache'):
+            return None
+
+        def _option(name, default):
+            if config.has_option('cache', name):
+                return config.get('cache', name)
+            return default
+
+        stores = [MemoryStore(int(_option('memory_entries',
+                                          DEFAULT_MEMORY_ENTRIES)))]
+        path = _option('path', None)
+        if path:
+            stores.append(SQLiteStore(path))
+        return cls(stores, ttl=float(_option('ttl', DEFAULT_TTL)))
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def lookup(self, key):
+        """
+        Return ``(entry, fresh)`` for key, where entry is None if nothing is
+        cached.
+        """
+        for i, store in enumerate(self.stores):
+            entry = store.get(key)
+            if entry is not None:
+                # Promote to the faster stores in front of this one
+                for faster in self.stores[:i]:
+                    faster.set(key, entry)
+                return entry, time.time() - entry.stored_at < self.ttl
+        return None, False
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry.headers.get('ETag'):
+            headers['If-None-Match'] = entry.headers['ETag']
+        if entry.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = entry.headers['Last-Modified']
+        return headers
+
+    def hit(self, entry):
+        self._count('hits')
+        return BufferedResponse(200, dict(entry.headers), entry.content)
+
+    def revalidated(self, key, entry):
+        self._count('revalidated')
+        entry = entry._replace(stored_at=time.time())
+        for store in self.stores:
+            store.set(key, entry)
+        return BufferedResponse(200, dict(entry.headers), entry.content)
+
+    def store(self, key, http_response):
+        """Record a response fetched from the service for key."""
+        self._count('misses')
+        cache_control = http_response.headers.get('Cache-Control', '')
+        if http_response.status_code != 200 or 'no-store' in cache_control:
+            return
+        headers = dict((name, http_response.headers[name])
+                       for name in _kept_headers
+                       if name in http_response.headers)
+        entry = CacheEntry(time.time(), headers, http_response.content)
+        for store in self.stores:
+            store.set(key, entry)
+
+    def invalidate(self, key):
+        """Drop the entry for key, and for key with any query string."""
+        self._count('invalidated')
+        for store in self.stores:
+            store.delete_prefix(key)
+
+    def summary(self):
+        summary = dict(self.stats)
+        summary['ttl'] = self.ttl
+        summary['entries'] = [len(store) for store in self.stores]
+        return summary
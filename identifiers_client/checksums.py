@@ -0,0 +1,91 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import namedtuple
+
+DEFAULT_ALGORITHMS = ('sha256', 'md5', 'sha512')
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files at least this large are hashed with a thread per algorithm. hashlib
+# releases the GIL while hashing large buffers, so the algorithms run on
+# separate cores while the next chunk is read.
+THREADED_MIN_SIZE = 4 * CHUNK_SIZE
+
+_QUEUE_CHUNKS = 4
+
+
+class FileChecksums(namedtuple('FileChecksums', ['size', 'checksums'])):
+    """The size of a file and a dict of algorithm name to hex digest."""
+
+    __slots__ = ()
+
+    def as_identifier_checksums(self):
+        """The checksums in the form taken by ``create_identifier``."""
+        return [{
+            'function': function,
+            'value': value
+        } for function, value in sorted(self.checksums.items())]
+
+
+def _hash_worker(hasher, chunks):
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        hasher.update(chunk)
+
+
+def hash_stream(stream, algorithms=DEFAULT_ALGORITHMS, threaded=False,
+                chunk_size=CHUNK_SIZE):
+    """
+    Compute the checksums for ``algorithms`` of everything read from stream
+    in a single pass, returning a FileChecksums.
+    """
+    hashers = [(name, hashlib.new(name)) for name in algorithms]
+    size = 0
+    if not threaded or len(hashers) < 2:
+        chunk = stream.read(chunk_size)
+        while chunk:
+            size += len(chunk)
+            for _, hasher in hashers:
+                hasher.update(chunk)
+            chunk = stream.read(chunk_size)
+    else:
+        workers = []
+        for _, hasher in hashers:
+            chunks = queue.Queue(maxsize=_QUEUE_CHUNKS)
+            worker = threading.Thread(
+                target=_hash_worker, args=(hasher, chunks))
+            worker.daemon = True
+            worker.start()
+            workers.append((worker, chunks))
+        try:
+            # Chunks are immutable bytes, so every worker can share each one
+            chunk = stream.read(chunk_size)
+            while chunk:
+                size += len(chunk)
+                for _, chunks in workers:
+                    chunks.put(chunk)
+                chunk = stream.read(chunk_size)
+        finally:
+            for worker, chunks in workers:
+                chunks.put(None)
+            for worker, chunks in workers:
+                worker.join()
+    return FileChecksums(
+        size, dict((name, hasher.hexdigest()) for name, hasher in hashers))
+
+
+def compute_checksums(path, algorithms=DEFAULT_ALGORITHMS,
+                      chunk_size=CHUNK_SIZE):
+    """
+    Compute the checksums for ``algorithms`` (by default sha256, md5 and
+    sha512) of the file at path, reading it once in large chunks without
+    holding it in memory.
+    """
+    threaded = (os.path.getsize(path) >= THREADED_MIN_SIZE
+                and (os.cpu_count() or 1) > 1)
+    with open(path, 'rb') as stream:
+        return hash_stream(stream, algorithms, threaded, chunk_size)
@@ -0,0 +1,98 @@
+import gzip
+import io
+import logging
+import threading
+
+from identifiers_client import defaults
+from identifiers_client.output import dumps
+
+log = logging.getLogger(__name__)
+
+GZIP_LEVEL = 6
+
+
+def min_size_from_config(config):
+    """
+    The smallest request body to compress, from the optional
+    ``compress_requests`` and ``compress_min_size`` options of the
+    ``[client]`` section of config, or None when compression is off (the
+    default: not every service accepts compressed requests).
+    """
+    if not (config.has_option('client', 'compress_requests')
+            and config.getboolean('client', 'compress_requests')):
+        return None
+    if config.has_option('client', 'compress_min_size'):
+        return int(config.get('client', 'compress_min_size'))
+    return defaults.COMPRESS_MIN_SIZE
+
+
+def gzip_bytes(data, level=GZIP_LEVEL):
+    buf = io.BytesIO()
+    # A fixed mtime, so the same body always compresses the same way
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class CompressionStats(object):
+    """Counts the request bodies compressed and the bytes it saved."""
+
+    def __init__(self):
+        self.requests = 0
+        self.original_bytes = 0
+        self.compressed_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, original, compressed):
+        with self._lock:
+            self.requests += 1
+            self.original_bytes += original
+            self.compressed_bytes += compressed
+
+    @property
+    def saved_bytes(self):
+        return self.original_bytes - self.compressed_bytes
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'original_bytes': self.original_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'saved_bytes': self.original_bytes - self.compressed_bytes
+            }
+
+
+def encode_json_body(json_body, min_size):
+    """
+    Encode json_body for a request, gzip compressing it if it is at least
+    min_size bytes (never, if min_size is None). Returns the body, the
+    headers describing it and its size before compression.
+    """
+    body = dumps(json_body).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if min_size is None or len(body) < min_size:
+        return body, headers, len(body)
+    compressed = gzip_bytes(body)
+    if len(compressed) >= len(body):
+        return body, headers, len(body)
+    log.debug('compressed request body from %s to %s bytes', len(body),
+              len(compressed))
+    headers['Content-Encoding'] = 'gzip'
+    return compressed, headers, len(body)
+
+
+def log_saved(logger, stats, before):
+    """Log the bytes compression saved since the snapshot ``before``
+    (from ``stats.as_dict()``)."""
+    after = stats.as_dict()
+    requests = after['requests'] - before['requests']
+    if not requests:
+        return
+    original = after['original_bytes'] - before['original_bytes']
+    compressed = after['compressed_bytes'] - before['compressed_bytes']
+    logger.info(
+        'compressed %s request bodies from %s to %s bytes (%.0f%% saved)',
+        requests, original, compressed,
+        100.0 * (original - compressed) / original)
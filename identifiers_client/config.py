@@ -1,10 +1,22 @@
+import threading
 from os import path, environ
-from six.moves.configparser import ConfigParser
 
 _default = path.join(path.expanduser('~'), '.globus_identifier')
 IDENTIFIER_CONFIG_FILE = path.abspath(
     environ.get('IDENTIFIER_CONFIG_FILE', _default))
 IDENTIFIER_ENVIRONMENT = environ.get('IDENTIFIER_ENVIRONMENT', 'production')
+IDENTIFIER_DAEMON_SOCKET = path.abspath(
+    environ.get('IDENTIFIER_DAEMON_SOCKET', IDENTIFIER_CONFIG_FILE + '.sock'))
+IDENTIFIER_INDEX_FILE = path.abspath(
+    environ.get('IDENTIFIER_INDEX_FILE', IDENTIFIER_CONFIG_FILE + '.index'))
+IDENTIFIER_HASH_CACHE = path.abspath(
+    environ.get('IDENTIFIER_HASH_CACHE', IDENTIFIER_CONFIG_FILE + '.hashes'))
+IDENTIFIER_JOURNAL_FILE = path.abspath(
+    environ.get('IDENTIFIER_JOURNAL_FILE', IDENTIFIER_CONFIG_FILE + '.journal'))
+IDENTIFIER_AUDIT_FILE = path.abspath(
+    environ.get('IDENTIFIER_AUDIT_FILE', IDENTIFIER_CONFIG_FILE + '.audit'))
+IDENTIFIER_HOST_HISTORY = path.abspath(
+    environ.get('IDENTIFIER_HOST_HISTORY', IDENTIFIER_CONFIG_FILE + '.hosts'))
 
 _identifier_environments = {
     'dev': {
@@ -28,30 +40,46 @@ _identifier_environments = {
 
 def _set_defaults(cfg):
     env = _identifier_environments[IDENTIFIER_ENVIRONMENT]
-    config.add_section('client')
+    cfg.add_section('client')
     cfg.set('client', "service_url", env["service_url"])
     cfg.set('client', "client_id", env["client_id"])
     cfg.set('client', "scope", env["scope"])
-    config.add_section('tokens')
+    cfg.add_section('tokens')
     cfg.set('tokens', 'access_token', '')
     cfg.set('tokens', 'access_token_expires', '0')
     cfg.set('tokens', 'refresh_token', '')
 
 
-config = ConfigParser()
+class _LazyConfig(object):
+    """
+    The client configuration, a ConfigParser which is only read from
+    IDENTIFIER_CONFIG_FILE when first used, so commands which never look at
+    it don't pay for loading it. ``save()`` writes it back to the file.
+    """
 
+    def __init__(self):
+        self._parser = None
+        self._lock = threading.Lock()
 
-def _save():
-    with open(IDENTIFIER_CONFIG_FILE, 'w') as configfile:
-        config.write(configfile)
+    def _load(self):
+        if self._parser is None:
+            with self._lock:
+                if self._parser is None:
+                    from six.moves.configparser import ConfigParser
+                    parser = ConfigParser()
+                    if path.exists(IDENTIFIER_CONFIG_FILE):
+                        parser.read(IDENTIFIER_CONFIG_FILE)
+                    else:
+                        _set_defaults(parser)
+                    self._parser = parser
+        return self._parser
 
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
 
-# Monkey-patch config so other things can call
-# config.save() without having to care about file
-# location.
-config.save = _save
+    def save(self):
+        with open(IDENTIFIER_CONFIG_FILE, 'w') as configfile:
+            self._load().write(configfile)
 
-if path.exists(IDENTIFIER_CONFIG_FILE):
-    config.read(IDENTIFIER_CONFIG_FILE)
-else:
-    _set_defaults(config)
+
+config = _LazyConfig()
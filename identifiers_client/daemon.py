@@ -0,0 +1,276 @@
+from __future__ import print_function
+import importlib
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from identifiers_client.config import (config, IDENTIFIER_CONFIG_FILE,
+                                       IDENTIFIER_DAEMON_SOCKET)
+
+log = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TIMEOUT = 3600
+
+# Subcommands which only talk to the Identifiers service and so may be run
+# by the daemon on behalf of the command line. Others (login, commands
+# reading standard input) always run in-process.
+_forwarded_commands = frozenset([
+    'namespace-create', 'namespace-update', 'namespace-display',
+    'namespace-delete', 'identifier-create', 'identifier-update',
+    'identifier-display', 'identifier-resolve', 'cache-stats'
+])
+
+# Options naming input which the command reads itself, so that a command
+# given one runs in-process, where relative paths and standard input are
+# the caller's rather than the daemon's
+_input_options = ('--input', '--file')
+
+_CONNECT_TIMEOUT = 1.0
+
+# Set in the session daemon's process
+serving = False
+
+
+class DaemonError(Exception):
+    pass
+
+
+def _connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_CONNECT_TIMEOUT)
+    try:
+        sock.connect(IDENTIFIER_DAEMON_SOCKET)
+    except (OSError, socket.error):
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def _exchange(sock, request):
+    try:
+        with sock:
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            reply = sock.makefile('rb').readline()
+        return json.loads(reply.decode('utf-8'))
+    except (OSError, socket.error, ValueError) as err:
+        raise DaemonError('No reply from session daemon: {}'.format(err))
+
+
+def _ping():
+    sock = _connect()
+    if sock is None:
+        return None
+    try:
+        return _exchange(sock, {'command': 'ping'})
+    except DaemonError:
+        return None
+
+
+def forward(argv):
+    """
+    Run the command line argv in the session daemon, if one is running and
+    the subcommand may be forwarded, writing its output to stdout/stderr as
+    the command would have in-process. Returns False if the command should
+    instead be run in-process.
+    """
+    if not argv or argv[0] not in _forwarded_commands:
+        return False
+    if '-h' in argv or '--help' in argv:
+        return False
+    if any(arg == option or arg.startswith(option + '=')
+           for arg in argv for option in _input_options):
+        return False
+    if not os.path.exists(IDENTIFIER_DAEMON_SOCKET):
+        return False
+    sock = _connect()
+    if sock is None:
+        return False
+    # Once the request has been sent the command may have reached the
+    # service, so it is not retried in-process if the reply is lost
+    try:
+        reply = _exchange(sock, {'argv': list(argv)})
+    except DaemonError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    if reply.get('fallback'):
+        return False
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    if reply.get('status'):
+        sys.exit(reply['status'])
+    return True
+
+
+def _cli():
+    # The package exports the main() function under the module's name, so
+    # the module itself is looked up by its full name
+    return importlib.import_module('identifiers_client.main')
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        self.server.last_request = time.time()
+        command = request.get('command')
+        if command == 'ping':
+            reply = {'pid': os.getpid()}
+        elif command == 'stop':
+            reply = {'pid': os.getpid()}
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            reply = self.server.run_command(request['argv'])
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class DaemonServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer, object):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        # Only the owner may connect; the daemon acts with their tokens
+        old_umask = os.umask(0o077)
+        try:
+            super(DaemonServer, self).__init__(socket_path, _Handler)
+        finally:
+            os.umask(old_umask)
+        self.last_request = time.time()
+        self._config_mtime = self._get_config_mtime()
+
+    def _get_config_mtime(self):
+        try:
+            return os.path.getmtime(IDENTIFIER_CONFIG_FILE)
+        except OSError:
+            return None
+
+    def _check_config(self, cli):
+        # Pick up a login or logout made by another process
+        mtime = self._get_config_mtime()
+        if mtime != self._config_mtime:
+            self._config_mtime = mtime
+            if mtime is not None:
+                config.read(IDENTIFIER_CONFIG_FILE)
+            cli.reset_client()
+
+    def run_command(self, argv):
+        cli = _cli()
+        self._check_config(cli)
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            cli.run(argv, out, err)
+        except SystemExit:
+            # Usage errors: let the caller run the command itself so that
+            # argparse writes its messages to the right terminal
+            return {'fallback': True}
+        except Exception:
+            log.exception('Command %s failed', argv)
+            err.write(traceback.format_exc())
+            return {'stdout': out.getvalue(), 'stderr': err.getvalue(),
+                    'status': 1}
+        return {'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+    def watch_idle(self, idle_timeout):
+        while True:
+            time.sleep(min(idle_timeout, 30))
+            if time.time() - self.last_request > idle_timeout:
+                log.info('Session daemon idle, exiting')
+                self.shutdown()
+                return
+
+
+def serve(idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Run the session daemon in the current process until stopped."""
+    if os.path.exists(IDENTIFIER_DAEMON_SOCKET):
+        os.unlink(IDENTIFIER_DAEMON_SOCKET)
+    server = DaemonServer(IDENTIFIER_DAEMON_SOCKET)
+
+    def _on_term(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _on_term)
+
+    global serving
+    serving = True
+    # Build the client up front so the first command finds it ready, and
+    # send anything left in the write-behind journal
+    from identifiers_client.identifiers_api import IdentifierNotLoggedIn
+    try:
+        _cli().get_client()
+        from identifiers_client.journal import path_from_config
+        if os.path.exists(path_from_config(config)):
+            _cli().start_journal_flusher()
+    except IdentifierNotLoggedIn:
+        pass
+
+    watcher = threading.Thread(target=server.watch_idle, args=(idle_timeout, ))
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(IDENTIFIER_DAEMON_SOCKET):
+            os.unlink(IDENTIFIER_DAEMON_SOCKET)
+
+
+def start(idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    running = _ping()
+    if running is not None:
+        print('Session daemon already running (pid {})'.format(
+            running['pid']))
+        return
+    code = ('from identifiers_client.daemon import serve; '
+            'serve({:d})'.format(idle_timeout))
+    # Make sure the daemon imports this same copy of the package
+    package_root = os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (package_root, env.get('PYTHONPATH')) if p)
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen(
+            [sys.executable, '-c', code],
+            env=env,
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            start_new_session=True)
+    for _ in range(100):
+        running = _ping()
+        if running is not None:
+            print('Session daemon started (pid {})'.format(running['pid']))
+            return
+        time.sleep(0.1)
+    print('Session daemon failed to start', file=sys.stderr)
+    sys.exit(1)
+
+
+def stop():
+    sock = _connect()
+    if sock is None:
+        print('Session daemon is not running')
+        return
+    reply = _exchange(sock, {'command': 'stop'})
+    print('Session daemon stopped (pid {})'.format(reply['pid']))
+
+
+def status():
+    running = _ping()
+    if running is None:
+        print('Session daemon is not running')
+    else:
+        print('Session daemon running (pid {}) on {}'.format(
+            running['pid'], IDENTIFIER_DAEMON_SOCKET))
@@ -0,0 +1,22 @@
+# Default settings shared by the library and the command line. This module
+# imports nothing, so the command line can show them in its help without
+# loading the modules (and HTTP libraries) which use them.
+
+# Most requests made at once by the batch commands. The request scheduler
+# keeps fewer in flight while the service shows signs of overload.
+BATCH_CONCURRENCY = 32
+
+# Seconds to wait for a resolver before also asking the next one, and for
+# any answer at all
+RESOLVER_HEDGE_AFTER = 0.5
+RESOLVER_TIMEOUT = 30
+
+# Concurrent range requests per download
+DOWNLOAD_CONNECTIONS = 4
+
+# Identifiers requested per page when listing a namespace
+EXPORT_PAGE_SIZE = 1000
+
+# Request bodies at least this many bytes are gzip compressed, when request
+# compression is turned on. Smaller ones fit in a packet or two anyway.
+COMPRESS_MIN_SIZE = 1024
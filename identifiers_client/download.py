@@ -0,0 +1,278 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from identifiers_client import defaults, metadata
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONNECTIONS = defaults.DOWNLOAD_CONNECTIONS
+PART_SIZE = 16 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+_PART_RETRIES = 3
+# Seconds to back off before retrying a part, doubling with each attempt
+PART_BACKOFF_BASE = 0.5
+PART_BACKOFF_MAX = 10
+
+FetchResult = namedtuple('FetchResult',
+                         ['path', 'url', 'size', 'checksums', 'verified'])
+
+
+class DownloadError(ValueError):
+    pass
+
+
+class ChecksumMismatch(DownloadError):
+    pass
+
+
+def checksums_from_record(record):
+    """
+    Return ``(locations, checksums)`` from an Identifiers service record or
+    a schema.org, DataCite or indexd metadata document, with checksums as a
+    dict of hashlib algorithm name to expected hex digest.
+    """
+    record = metadata.normalize(record)
+    return list(record.content_urls), record.checksums_dict()
+
+
+def filename_for(url):
+    name = os.path.basename(unquote(urlparse(url).path.rstrip('/')))
+    return name or 'download'
+
+
+class _PartState(object):
+    """
+    Records which parts of a ranged download are on disk, in a file next to
+    the partial download, so an interrupted fetch can resume.
+    """
+
+    def __init__(self, path, size, part_size):
+        self.path = path
+        self.size = size
+        self.part_size = part_size
+        self.completed = set()
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+            if (saved['size'], saved['part_size']) == (size, part_size):
+                self.completed = set(saved['completed'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def mark(self, index):
+        self.completed.add(index)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'size': self.size,
+                'part_size': self.part_size,
+                'completed': sorted(self.completed)
+            }, f)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Downloader(object):
+    """
+    Downloads a URL with ``connections`` concurrent HTTP Range requests into
+    a preallocated file. Parts are hashed in file order as they arrive, so
+    checksums are verified without reading the file again, and a record of
+    finished parts lets an interrupted download resume. Servers which do not
+    support ranges are read as a single stream.
+    """
+
+    def __init__(self, connections=DEFAULT_CONNECTIONS, part_size=PART_SIZE,
+                 session=None, timeout=60):
+        self.connections = max(1, connections)
+        self.part_size = part_size
+        self.timeout = timeout
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.connections)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def _probe(self, url):
+        """Return ``(size, supports_ranges)`` for url."""
+        r = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        if r.status_code >= 400:
+            return None, False
+        size = r.headers.get('Content-Length')
+        ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return (int(size) if size is not None else None), ranges
+
+    def _backoff(self, attempt):
+        # "Full jitter", so parts failing together aren't retried together
+        return random.uniform(
+            0, min(PART_BACKOFF_MAX, PART_BACKOFF_BASE * 2**attempt))
+
+    def _fetch_part(self, url, fd, offset, length):
+        """
+        Fetch and write one part, returning its data. Network errors, short
+        parts and server errors (5xx and 429) are retried after a backoff;
+        any other status fails at once, as asking again won't help.
+        """
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + length - 1)}
+        for attempt in range(_PART_RETRIES):
+            if attempt:
+                time.sleep(self._backoff(attempt - 1))
+            try:
+                r = self.session.get(url, headers=headers,
+                                     timeout=self.timeout)
+            except requests.RequestException as e:
+                err = str(e)
+            else:
+                if r.status_code == 206 and len(r.content) == length:
+                    os.pwrite(fd, r.content, offset)
+                    return r.content
+                err = 'HTTP status {}, {} bytes'.format(
+                    r.status_code, len(r.content))
+                if not (r.status_code == 206 or r.status_code == 429
+                        or r.status_code >= 500):
+                    break
+            log.debug('range %s of %s failed (attempt %s): %s',
+                      headers['Range'], url, attempt + 1, err)
+        raise DownloadError('Failed to fetch {} of {}: {}'.format(
+            headers['Range'], url, err))
+
+    def _fetch_ranges(self, url, fd, size, hashers, state):
+        parts = [(offset, min(self.part_size, size - offset))
+                 for offset in range(0, size, self.part_size)]
+        # Parts are only fetched this far ahead of the next one to hash,
+        # which bounds the memory held for out of order parts
+        window = self.connections * 2
+        futures = {}
+        next_submit = 0
+        with ThreadPoolExecutor(max_workers=self.connections) as pool:
+            for index, (offset, length) in enumerate(parts):
+                while (next_submit < len(parts)
+                       and next_submit < index + window):
+                    if next_submit not in state.completed:
+                        futures[next_submit] = pool.submit(
+                            self._fetch_part, url, fd, *parts[next_submit])
+                    next_submit += 1
+                future = futures.pop(index, None)
+                if future is None:
+                    # Fetched by an earlier, interrupted run
+                    data = os.pread(fd, length, offset)
+                else:
+                    try:
+                        data = future.result()
+                    except Exception:
+                        for f in futures.values():
+                            f.cancel()
+                        raise
+                    state.mark(index)
+                for hasher in hashers:
+                    hasher.update(data)
+
+    def _fetch_stream(self, url, fd, hashers):
+        try:
+            r = self.session.get(url, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise DownloadError('Failed to fetch {}: {}'.format(url, e))
+        with r:
+            if r.status_code != 200:
+                raise DownloadError('Failed to fetch {}: HTTP status {}'.format(
+                    url, r.status_code))
+            os.ftruncate(fd, 0)
+            size = 0
+            for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+                os.write(fd, chunk)
+                size += len(chunk)
+                for hasher in hashers:
+                    hasher.update(chunk)
+        return size
+
+    def fetch(self, url, dest, checksums=None):
+        """
+        Download url to the file dest, verifying it against checksums (a
+        dict of algorithm name to hex digest) if given. Returns a
+        FetchResult. Raises ChecksumMismatch, leaving nothing at dest, if
+        the data does not match.
+        """
+        checksums = checksums or {}
+        algorithms = sorted(checksums) or ['sha256']
+        hashers = [hashlib.new(name) for name in algorithms]
+        partial = dest + '.part'
+        try:
+            size, ranges = self._probe(url)
+        except requests.RequestException as e:
+            raise DownloadError('Failed to reach {}: {}'.format(url, e))
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if size is not None and ranges and size > 0:
+                state = _PartState(partial + '.state', size, self.part_size)
+                if not state.completed:
+                    os.ftruncate(fd, size)
+                self._fetch_ranges(url, fd, size, hashers, state)
+            else:
+                state = None
+                size = self._fetch_stream(url, fd, hashers)
+        finally:
+            os.close(fd)
+
+        digests = dict(zip(algorithms, (h.hexdigest() for h in hashers)))
+        mismatched = [
+            name for name, value in checksums.items()
+            if digests[name].lower() != value.lower()
+        ]
+        if state is not None:
+            state.remove()
+        if mismatched:
+            os.unlink(partial)
+            raise ChecksumMismatch('{} checksum mismatch for {}'.format(
+                ', '.join(mismatched), url))
+        os.rename(partial, dest)
+        return FetchResult(dest, url, size, digests, bool(checksums) or None)
+
+
+def fetch(locations, dest=None, checksums=None, ranker=None, size=None,
+          **kwargs):
+    """
+    Download the data at the first of locations which succeeds, into dest
+    (by default the file name from the URL in the current directory),
+    verifying checksums. With a LocationRanker, locations are tried
+    fastest expected first for data of size bytes, and how each attempt
+    went is added to the ranker's history. Other keyword arguments are
+    passed to Downloader.
+    """
+    if not locations:
+        raise DownloadError('No locations to fetch from')
+    if ranker is not None:
+        locations = ranker.order(locations, size)
+    downloader = Downloader(**kwargs)
+    errors = []
+    for url in locations:
+        target = dest or filename_for(url)
+        started = time.time()
+        try:
+            result = downloader.fetch(url, target, checksums)
+        except DownloadError as e:
+            log.info('fetch from %s failed: %s', url, e)
+            if ranker is not None and not isinstance(e, ChecksumMismatch):
+                ranker.history.record(url, ok=False)
+            errors.append(e)
+            continue
+        elapsed = time.time() - started
+        if ranker is not None and result.size and elapsed > 0:
+            ranker.history.record(url, throughput=result.size / elapsed)
+        return result
+    message = '; '.join(str(e) for e in errors)
+    if any(isinstance(e, ChecksumMismatch) for e in errors):
+        raise ChecksumMismatch(message)
+    raise DownloadError(message)
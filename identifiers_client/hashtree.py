@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import sqlite3
+import stat
+import time
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from urllib.parse import quote
+
+from identifiers_client.checksums import (CHUNK_SIZE, DEFAULT_ALGORITHMS,
+                                          hash_stream)
+
+log = logging.getLogger(__name__)
+
+# Files smaller than this are hashed in groups, so that each task sent to a
+# worker process carries enough work to be worth the round trip
+GROUP_BYTES = 64 * 1024 * 1024
+GROUP_FILES = 256
+
+# Tasks queued per worker, keeping every worker busy without queueing the
+# whole tree
+_TASKS_PER_WORKER = 4
+
+# The cache is committed after this many new entries
+_COMMIT_EVERY = 1000
+
+TreeFile = namedtuple('TreeFile', ['path', 'size', 'mtime_ns'])
+
+TreeEntry = namedtuple('TreeEntry',
+                       ['path', 'size', 'checksums', 'cached'])
+
+
+def _mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    return mtime_ns if mtime_ns is not None else int(st.st_mtime * 1e9)
+
+
+def walk_files(root):
+    """
+    Return a TreeFile for every regular file under the directory root
+    (symbolic links are not followed), with its path relative to root.
+    """
+    files = []
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError as err:
+                log.warning('skipping %s: %s', path, err)
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append(TreeFile(os.path.relpath(path, root),
+                                      st.st_size, _mtime_ns(st)))
+    return files
+
+
+class HashCache(object):
+    """
+    Checksums of files computed before, kept in a SQLite database at path
+    and keyed by each file's absolute path, size and modification time, so
+    that files which haven't changed aren't hashed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+            'checksums TEXT)')
+        self._db.commit()
+        self._uncommitted = 0
+
+    def get(self, path, size, mtime_ns, algorithms):
+        """The cached checksums of the file, if they are for this size and
+        mtime and include every one of algorithms; otherwise None."""
+        row = self._db.execute(
+            'SELECT checksums FROM checksums WHERE path = ? AND size = ? '
+            'AND mtime_ns = ?', (path, size, mtime_ns)).fetchone()
+        if row is None:
+            return None
+        checksums = json.loads(row[0])
+        if not all(algorithm in checksums for algorithm in algorithms):
+            return None
+        return dict((algorithm, checksums[algorithm])
+                    for algorithm in algorithms)
+
+    def put(self, path, size, mtime_ns, checksums):
+        self._db.execute(
+            'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)',
+            (path, size, mtime_ns, json.dumps(checksums, sort_keys=True)))
+        self._uncommitted += 1
+        if self._uncommitted >= _COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _hash_files(paths, algorithms, chunk_size):
+    """Hash each of paths, in a worker process. Returns ``(path,
+    FileChecksums, error message)`` for each."""
+    results = []
+    for path in paths:
+        try:
+            with open(path, 'rb') as stream:
+                results.append((path, hash_stream(
+                    stream, algorithms, chunk_size=chunk_size), None))
+        except (IOError, OSError) as err:
+            results.append((path, None, str(err)))
+    return results
+
+
+def _tasks(files):
+    """
+    Group files, largest first, into lists to hash as one task: large files
+    on their own and small ones together, up to GROUP_FILES files or
+    GROUP_BYTES bytes.
+    """
+    group = []
+    group_bytes = 0
+    for tree_file in sorted(files, key=lambda f: f.size, reverse=True):
+        if (group and (group_bytes + tree_file.size > GROUP_BYTES
+                       or len(group) >= GROUP_FILES)):
+            yield group
+            group, group_bytes = [], 0
+        group.append(tree_file)
+        group_bytes += tree_file.size
+    if group:
+        yield group
+
+
+def hash_tree(root, algorithms=DEFAULT_ALGORITHMS, processes=None,
+              cache=None, chunk_size=CHUNK_SIZE):
+    """
+    Compute the checksums for ``algorithms`` of every file under the
+    directory root, yielding a TreeEntry for each (with its path relative
+    to root) as it is done.
+
+    Files are hashed by a pool of ``processes`` worker processes (by
+    default, one per CPU), the largest first so that a few big files
+    finishing last don't leave the other workers idle, and each file is
+    read once for all algorithms. With a HashCache, files whose size and
+    modification time haven't changed since they were cached aren't read
+    at all, and the checksums of those which are read are added to it.
+    Files which can't be read are logged and skipped.
+    """
+    started = time.time()
+    root = os.path.abspath(root)
+    files = walk_files(root)
+    by_path = {}
+    todo = []
+    cached = 0
+    for tree_file in files:
+        path = os.path.join(root, tree_file.path)
+        checksums = None
+        if cache is not None:
+            checksums = cache.get(path, tree_file.size, tree_file.mtime_ns,
+                                  algorithms)
+        if checksums is not None:
+            cached += 1
+            yield TreeEntry(tree_file.path, tree_file.size, checksums, True)
+        else:
+            by_path[path] = tree_file
+            todo.append(tree_file._replace(path=path))
+    log.info('%s files under %s, %s unchanged since cached; hashing %s '
+             'bytes', len(files), root, cached,
+             sum(f.size for f in todo))
+
+    processes = processes or os.cpu_count() or 1
+    # A single worker gains nothing from another process
+    pool_class = ProcessPoolExecutor if processes > 1 else ThreadPoolExecutor
+    hashed = errors = 0
+    with pool_class(max_workers=processes) as pool:
+        tasks = _tasks(todo)
+        pending = set()
+        while True:
+            for group in tasks:
+                pending.add(pool.submit(_hash_files, [f.path for f in group],
+                                        algorithms, chunk_size))
+                if len(pending) >= processes * _TASKS_PER_WORKER:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for path, result, error in future.result():
+                    tree_file = by_path[path]
+                    if error is not None:
+                        errors += 1
+                        log.warning('skipping %s: %s', path, error)
+                        continue
+                    hashed += 1
+                    if cache is not None:
+                        cache.put(path, tree_file.size, tree_file.mtime_ns,
+                                  result.checksums)
+                    yield TreeEntry(tree_file.path, result.size,
+                                    result.checksums, False)
+    if cache is not None:
+        cache.commit()
+    log.info('hashed %s files (%s failed, %s cached) in %.1fs', hashed,
+             errors, cached, time.time() - started)
+
+
+def entry_record(entry, base_url=None):
+    """
+    The ``create_identifier`` arguments for a TreeEntry, as read by
+    identifier-batch-create: its checksums, and its path and size as the
+    metadata ``name`` and ``contentSize``. With base_url, its location is
+    its path appended to base_url.
+    """
+    record = {
+        'checksums': [{
+            'function': function,
+            'value': value
+        } for function, value in sorted(entry.checksums.items())],
+        'metadata': {
+            'name': entry.path.replace(os.sep, '/'),
+            'contentSize': entry.size
+        }
+    }
+    if base_url:
+        record['location'] = [
+            base_url.rstrip('/') + '/' + quote(entry.path.replace(os.sep, '/'))
+        ]
+    return record
@@ -1,3 +1,8 @@
+import io
+import sys
+from argparse import ArgumentParser
+from contextlib import contextmanager
+
 # Pattern (and code) taken from:
 # https://gist.github.com/mivade/384c2c41c3a29c637cb6c603d4197f9f
 
@@ -13,27 +18,91 @@ def argument(*name_or_flags, **kwargs):
     # return ([*name_or_flags], kwargs) # <-- tuple, set, and list unpacking requires Python 3.5 or greater
 
 
-def subcommand(args, parent, **kwargs):
+class DeferredArgumentParser(ArgumentParser):
+    """
+    An ArgumentParser whose arguments can be given ahead of time with
+    ``defer_arguments`` and are only added when it parses or formats help.
+    Used for the subcommand parsers, so a command line only builds the
+    parser for the subcommand it runs.
+    """
+
+    def defer_arguments(self, args):
+        self._deferred_arguments = list(args)
+
+    def _add_deferred_arguments(self):
+        args = getattr(self, '_deferred_arguments', None)
+        if args:
+            self._deferred_arguments = None
+            for arg in args:
+                self.add_argument(*arg[0], **arg[1])
+
+    def parse_known_args(self, args=None, namespace=None):
+        self._add_deferred_arguments()
+        return super(DeferredArgumentParser, self).parse_known_args(
+            args, namespace)
+
+    def format_usage(self):
+        self._add_deferred_arguments()
+        return super(DeferredArgumentParser, self).format_usage()
+
+    def format_help(self):
+        self._add_deferred_arguments()
+        return super(DeferredArgumentParser, self).format_help()
+
+
+def subcommand(args, parent, name=None, **kwargs):
     def decorator(func):
         parser = parent.add_parser(
-            func.__name__.replace('_', '-'),
+            name or func.__name__.replace('_', '-'),
             description=func.__doc__,
             **kwargs)
-        for arg in args:
-            parser.add_argument(*arg[0], **arg[1])
+        if isinstance(parser, DeferredArgumentParser):
+            parser.defer_arguments(args)
+        else:
+            for arg in args:
+                parser.add_argument(*arg[0], **arg[1])
         parser.set_defaults(func=func)
         return func
 
     return decorator
 
 
-_internal_arg_names = ['func', 'subcommand', 'identifier']
+# Arguments which are not properties of the object a command sends, the
+# global options among them
+_internal_arg_names = [
+    'func', 'subcommand', 'identifier', 'profile', 'metrics_file',
+    'output_format'
+]
 
 
 def clear_internal_args(args):
+    # A copy, since args is often vars() of the parsed arguments, whose
+    # global options are still needed to print the result
+    args = dict(args)
     for arg_name in _internal_arg_names:
         try:
             args.pop(arg_name)
         except KeyError:
             pass  # Its ok if the key is not in the list to be cleared
     return args
+
+
+@contextmanager
+def open_input(path):
+    """Open path for reading text, treating '-' as standard input."""
+    if path == '-':
+        yield sys.stdin
+    else:
+        with io.open(path, newline='') as stream:
+            yield stream
+
+
+@contextmanager
+def open_output(path):
+    """Open path for writing text, treating '-' as standard output."""
+    if path == '-':
+        yield sys.stdout
+        sys.stdout.flush()
+    else:
+        with io.open(path, 'w', newline='') as stream:
+            yield stream
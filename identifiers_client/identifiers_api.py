@@ -1,11 +1,26 @@
 import json
+import sqlite3
+from contextlib import closing
 
+import requests
+import six
 from globus_sdk import (AccessTokenAuthorizer, ClientCredentialsAuthorizer,
-                        RefreshTokenAuthorizer, NativeAppAuthClient)
-from globus_sdk.base import BaseClient, safe_stringify
-from globus_sdk.exc import GlobusAPIError
-
+                        RefreshTokenAuthorizer)
+from globus_sdk.base import BaseClient, safe_stringify, slash_join
+from globus_sdk.exc import GlobusAPIError, convert_request_exception
+from globus_sdk.response import GlobusResponse
+
+from identifiers_client import compression, defaults
+from identifiers_client.batch import (BatchResult, DEFAULT_CONCURRENCY,
+                                      bounded_map, prefetch,
+                                      size_connection_pool)
+from identifiers_client.cache import ResponseCache, cache_key
+from identifiers_client.index import MintedIndex
+from identifiers_client.jsonstream import ArrayMemberReader, READ_SIZE
+from identifiers_client import scheduler
 from identifiers_client.login import extract_and_save_tokens
+from identifiers_client.tokens import (ManagedRefreshTokenAuthorizer,
+                                       TokenState, auth_client)
 
 _namespace_properties = [
     'description', 'display_name', 'creators', 'admins', 'identifier_admins',
@@ -20,35 +35,54 @@ _identifier_properties = ['location', 'checksums', 'metadata', 'visible_to']
 _identifier_json_props = ['metadata', 'visible_to', 'location', 'checksums']
 
 
+_app_name = 'identifier_client'
+
+
 def identifiers_client(config, **kwargs):
-    app_name = 'identifier_client'
     base_url = config.get('client', 'service_url')
+    if 'cache' not in kwargs:
+        kwargs['cache'] = ResponseCache.from_config(config)
+    if 'scheduler' not in kwargs:
+        kwargs['scheduler'] = scheduler.RequestScheduler.from_config(config)
+    if 'compress_min_size' not in kwargs:
+        kwargs['compress_min_size'] = compression.min_size_from_config(config)
+    if 'index' not in kwargs:
+        kwargs['index'] = MintedIndex.from_config(config)
+    return IdentifierClient(
+        "identifier",
+        base_url=base_url,
+        app_name=_app_name,
+        authorizer=config_authorizer(config),
+        **kwargs)
+
+
+def config_authorizer(config):
+    """
+    Build a thread-safe refresh token authorizer from the tokens held in
+    config, saving refreshed tokens back to config.
+    """
     client_id = config.get('client', 'client_id')
     access_token = config.get('tokens', 'access_token')
     at_expires = int(config.get('tokens', 'access_token_expires'))
     refresh_token = config.get('tokens', 'refresh_token')
     if not (refresh_token and access_token):
         raise IdentifierNotLoggedIn("Missing tokens")
+    state = TokenState(config)
 
     def _on_refresh(tkn):
+        # A successful refresh shows the refresh token is still active
+        state.record_introspection(True, save=False)
         extract_and_save_tokens(tkn, config)
 
-    authorizer_client = NativeAppAuthClient(client_id, app_name=app_name)
-    authorizer = RefreshTokenAuthorizer(
+    return ManagedRefreshTokenAuthorizer(
         refresh_token,
-        authorizer_client,
+        auth_client(client_id, _app_name),
         access_token,
         at_expires,
         on_refresh=_on_refresh,
+        on_unauthorized=state.invalidate,
     )
 
-    return IdentifierClient(
-        "identifier",
-        base_url=base_url,
-        app_name=app_name,
-        authorizer=authorizer,
-        **kwargs)
-
 
 class IdentifierClientError(GlobusAPIError):
     pass
@@ -76,23 +110,147 @@ def _split_dict(in_dict, key_names):
 def _json_parse_args(in_dict, key_names):
     for key_name in key_names:
         val = in_dict.pop(key_name, None)
-        if val is not None:
+        if isinstance(val, six.string_types):
             try:
                 val = json.loads(val)
             except ValueError:
                 raise ValueError(
                     'value for {}: {} is not encoded in JSON'.format(
                         key_name, val))
+        if val is not None:
             in_dict[key_name] = val
     return in_dict
 
 
+def _changed_properties(body, current):
+    """
+    The properties of an update body whose values differ from those of the
+    current record, i.e. the smallest body which brings it to the same
+    state.
+    """
+    return dict((key, val) for key, val in body.items()
+                if key not in current or current[key] != val)
+
+
 class IdentifierClient(BaseClient):
     allowed_authorizer_types = (AccessTokenAuthorizer, RefreshTokenAuthorizer,
+                                ManagedRefreshTokenAuthorizer,
                                 ClientCredentialsAuthorizer)
 
     error_class = IdentifierClientError
 
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the BaseClient arguments, plus an optional ``cache``: a
+        ResponseCache used for ``get_namespace`` and ``get_identifier``, an
+        optional ``scheduler``: the RequestScheduler through which all
+        requests are sent (by default, one shared by the process), and an
+        optional ``compress_min_size``: JSON request bodies of at least this
+        many bytes are sent gzip compressed (by default none are), and an
+        optional ``index``: a MintedIndex recording the identifiers created
+        and updated, which ``create_identifier`` can consult to avoid
+        minting a second identifier for the same data.
+        Compressed responses are always accepted.
+        """
+        self.cache = kwargs.pop('cache', None)
+        self.scheduler = (kwargs.pop('scheduler', None)
+                          or scheduler.get_scheduler())
+        self.compress_min_size = kwargs.pop('compress_min_size', None)
+        self.compression_stats = compression.CompressionStats()
+        self.index = kwargs.pop('index', None)
+        super(IdentifierClient, self).__init__(*args, **kwargs)
+        scheduler.mount(self._session, self.scheduler)
+
+    def _request(self, method, path, params=None, headers=None,
+                 json_body=None, text_body=None, response_class=None,
+                 retry_401=True):
+        if json_body is not None and self.compress_min_size is not None:
+            body, body_headers, size = compression.encode_json_body(
+                json_body, self.compress_min_size)
+            compressed = 'Content-Encoding' in body_headers
+            body_headers.update(headers or {})
+            refused = False
+            try:
+                return self._logged_request(method, path, params,
+                                            body_headers, None, body,
+                                            response_class, retry_401)
+            except self.error_class as err:
+                if not compressed or err.http_status != 415:
+                    raise
+                refused = True
+                self.logger.warning(
+                    'The service does not accept compressed requests; '
+                    'sending them uncompressed from now on')
+                self.compress_min_size = None
+            finally:
+                if compressed and not refused:
+                    self.compression_stats.add(size, len(body))
+        return self._logged_request(method, path, params, headers, json_body,
+                                    text_body, response_class, retry_401)
+
+    def _logged_request(self, *args):
+        response = super(IdentifierClient, self)._request(*args)
+        r = response._data
+        if r.headers.get('Content-Encoding') == 'gzip':
+            self.logger.debug('response body of %s bytes was %s compressed',
+                              len(r.content), r.raw.tell())
+        return response
+
+    def _cached_get(self, path, params):
+        if self.cache is None:
+            return self.get(path, params=params)
+        key = cache_key(self.base_url, path, params)
+        entry, fresh = self.cache.lookup(key)
+        if fresh:
+            self.logger.debug('cache hit for %s', key)
+            return self.default_response_class(
+                self.cache.hit(entry), client=self)
+        headers = self.cache.conditional_headers(entry) if entry else None
+        response = self.get(path, params=params, headers=headers)
+        if response.http_status == 304 and entry is not None:
+            self.logger.debug('cache entry for %s revalidated', key)
+            return self.default_response_class(
+                self.cache.revalidated(key, entry), client=self)
+        self.cache.store(key, response._data)
+        return response
+
+    def _stream_get(self, path, params=None):
+        """
+        GET path without reading the response body, for responses too large
+        to hold in memory. Returns the streaming ``requests.Response``;
+        errors are raised as for any other request.
+        """
+        headers = dict(self._headers)
+        if self.authorizer is not None:
+            self.authorizer.set_authorization_header(headers)
+        url = slash_join(self.base_url, path)
+
+        def _send():
+            try:
+                return self._session.get(
+                    url,
+                    headers=headers,
+                    params=params,
+                    verify=self._verify,
+                    timeout=self._http_timeout,
+                    stream=True)
+            except requests.RequestException as e:
+                raise convert_request_exception(e)
+
+        r = _send()
+        if (r.status_code == 401 and self.authorizer is not None
+                and self.authorizer.handle_missing_authorization()):
+            r.close()
+            self.authorizer.set_authorization_header(headers)
+            r = _send()
+        if not 200 <= r.status_code < 300:
+            raise self.error_class(r)
+        return r
+
+    def _invalidate(self, path):
+        if self.cache is not None:
+            self.cache.invalidate(cache_key(self.base_url, path))
+
     def create_namespace(self, **kwargs):
         """
         ``POST /namespace``
@@ -118,8 +276,9 @@ class IdentifierClient(BaseClient):
         """
         kwargs = _json_parse_args(kwargs, _namespace_json_props)
         kwargs, body = _split_dict(kwargs, _namespace_properties)
-        self.logger.info("IdentifierClient.create_namespace({}, ...)".format(
-            body.get('display_name')))
+        self.logger.info(
+            "IdentifierClient.create_namespace(%s, ...)",
+            body.get('display_name'))
         path = self.qjoin_path("namespace")
         return self.post(path, body, params=kwargs)
 
@@ -145,14 +304,34 @@ class IdentifierClient(BaseClient):
           ``provider-config`` (*dict*)
           Configuration for the provider used for minting external
           identfiers in JSON format
+          ``minimal`` (*bool*)
+          Send only the properties which differ from the namespace's
+          current ones (see ``update_identifier``)
+          ``current`` (*dict*)
+          With ``minimal``, the namespace as last retrieved, rather than
+          getting it again
 
         """
+        minimal = kwargs.pop('minimal', False)
+        current = kwargs.pop('current', None)
         kwargs = _json_parse_args(kwargs, _namespace_json_props)
         kwargs, body = _split_dict(kwargs, _namespace_properties)
         self.logger.info(
-            "IdentifierClient.update_namespace({}, ...)".format(namespace_id))
+            "IdentifierClient.update_namespace(%s, ...)", namespace_id)
+        if minimal:
+            if current is None:
+                current = self.get_namespace(namespace_id).data
+            body = _changed_properties(body, current)
+            if not body:
+                self.logger.info('namespace %s unchanged, not updated',
+                                 namespace_id)
+                return GlobusResponse(dict(current, unchanged=True),
+                                      client=self)
         path = self.qjoin_path("namespace", safe_stringify(namespace_id))
-        return self.put(path, body, params=kwargs)
+        try:
+            return self.put(path, body, params=kwargs)
+        finally:
+            self._invalidate(path)
 
     def get_namespace(self, namespace_id, **params):
         """
@@ -163,9 +342,8 @@ class IdentifierClient(BaseClient):
           The id for the namespace to retrieve
         """
         path = self.qjoin_path("namespace", safe_stringify(namespace_id))
-        self.logger.info(
-            "IdentifierClient.get_namespace({})".format(namespace_id))
-        return self.get(path, params=params)
+        self.logger.info("IdentifierClient.get_namespace(%s)", namespace_id)
+        return self._cached_get(path, params)
 
     def delete_namespace(self, namespace_id, **params):
         """
@@ -176,9 +354,32 @@ class IdentifierClient(BaseClient):
           The id for the namespace to remove
         """
         path = self.qjoin_path("namespace", safe_stringify(namespace_id))
-        self.logger.info(
-            "IdentifierClient.delete_namespace({})".format(namespace_id))
-        return self.delete(path, params=params)
+        self.logger.info("IdentifierClient.delete_namespace(%s)", namespace_id)
+        try:
+            return self.delete(path, params=params)
+        finally:
+            self._invalidate(path)
+
+    def _record_minted(self, response):
+        if self.index is None:
+            return
+        try:
+            self.index.add(response.data)
+        except (sqlite3.Error, ValueError) as err:
+            self.logger.warning('Could not record %s in the local index: %s',
+                                response.get('identifier'), err)
+
+    def _find_minted(self, namespace, checksums):
+        """The record of the identifier in namespace already minted for
+        data with the sha256 in checksums, if there is one."""
+        for checksum in checksums or []:
+            if (checksum.get('function', '').lower() == 'sha256'
+                    and checksum.get('value')):
+                found = self.index.find('sha256', checksum['value'],
+                                        namespace=namespace)
+                if found is not None:
+                    return found
+        return None
 
     def create_identifier(self, **kwargs):
         """
@@ -200,15 +401,114 @@ class IdentifierClient(BaseClient):
           what users may see the created identifier
           ``metadata`` (*dict*)
           Additional metadata associated with the identifier
+          ``dedupe`` (*bool*)
+          If the local index records an identifier in the namespace for
+          data with the same sha256 checksum, return it rather than
+          minting another, without contacting the service. The response
+          then has ``deduplicated`` set.
 
         """
+        dedupe = kwargs.pop('dedupe', False)
         kwargs = _json_parse_args(kwargs, _identifier_json_props)
         kwargs, body = _split_dict(kwargs, _identifier_properties)
-        self.logger.info('IdentifierClient.create_identifier({}, ...)'.format(
-            body.get('namespace_id')))
+        self.logger.info(
+            'IdentifierClient.create_identifier(%s, ...)',
+            kwargs.get('namespace'))
+        if dedupe:
+            if self.index is None:
+                raise ValueError(
+                    'Deduplication needs the local index; add an [index] '
+                    'section to the configuration to keep one')
+            found = self._find_minted(kwargs.get('namespace'),
+                                      body.get('checksums'))
+            if found is not None:
+                self.logger.info('%s already minted for this data',
+                                 found.identifier)
+                return GlobusResponse({
+                    'identifier': found.identifier,
+                    'namespace': found.namespace,
+                    'location': found.location,
+                    'checksums': found.checksums,
+                    'deduplicated': True
+                }, client=self)
         path = self.qjoin_path('namespace/{}/identifier'.format(
             kwargs['namespace']))
-        return self.post(path, body, params=kwargs)
+        response = self.post(path, body, params=kwargs)
+        self._record_minted(response)
+        return response
+
+    def create_identifiers(self, records, concurrency=DEFAULT_CONCURRENCY,
+                           dedupe=False):
+        """
+        Create many identifiers, running up to ``concurrency`` requests at
+        once over this client's session.
+
+        ** Parameters **
+          ``records`` (*iterable of dict*)
+          Each record holds the keyword arguments for ``create_identifier``
+          (``namespace``, ``location``, ``checksums``, ``metadata``,
+          ``visible_to``). May be a lazy iterator.
+          ``concurrency`` (*int*)
+          The maximum number of requests in flight
+          ``dedupe`` (*bool*)
+          Passed to ``create_identifier`` for each record
+
+        Yields a ``BatchResult(index, record, response, error)`` for every
+        record, in input order. A record which fails has ``response`` None
+        and the raised exception as ``error``; the remaining records are
+        still processed.
+        """
+        size_connection_pool(self, concurrency)
+        self.logger.info(
+            'IdentifierClient.create_identifiers(concurrency=%s)', concurrency)
+        before = self.compression_stats.as_dict()
+
+        def _create(record):
+            return self.create_identifier(dedupe=dedupe, **dict(record))
+
+        for result in bounded_map(_create, records, concurrency):
+            yield BatchResult(*result)
+        compression.log_saved(self.logger, self.compression_stats, before)
+
+    def iter_identifiers(self, namespace_id,
+                         page_size=defaults.EXPORT_PAGE_SIZE,
+                         prefetch_page=True):
+        """
+        ``GET /namespace/<namespace_id>/identifier``
+
+        ** Parameters **
+          ``namespace_id`` (*string*)
+          The id for the namespace to list
+          ``page_size`` (*int*)
+          The number of identifiers to request per page
+          ``prefetch_page`` (*bool*)
+          Fetch the next page in the background while the current one is
+          consumed
+
+        Yields every identifier record in the namespace, following the
+        ``next_marker`` of each page. Each page is parsed as it is read, so
+        memory use does not grow with the size of the namespace.
+        """
+        path = self.qjoin_path('namespace', safe_stringify(namespace_id),
+                               'identifier')
+        self.logger.info('IdentifierClient.iter_identifiers(%s)', namespace_id)
+
+        def _pages():
+            params = {'limit': page_size}
+            while True:
+                with closing(self._stream_get(path, params)) as r:
+                    page = ArrayMemberReader(
+                        r.iter_content(READ_SIZE), 'identifiers')
+                    for record in page:
+                        yield record
+                marker = page.fields.get('next_marker')
+                if not marker or not page.fields.get('has_next_page', True):
+                    return
+                params['marker'] = marker
+
+        if prefetch_page:
+            return prefetch(_pages(), page_size)
+        return _pages()
 
     def get_identifier(self, identifier_id, **params):
         """
@@ -218,9 +518,50 @@ class IdentifierClient(BaseClient):
         ``identifier_id`` The identification url for the identifier
         """
         path = safe_stringify(identifier_id)
+        self.logger.info('IdentifierClient.get_identifier(%s)', identifier_id)
+        return self._cached_get(path, params)
+
+    def get_identifiers(self, identifier_ids, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Get many identifiers, running up to ``concurrency`` requests at once
+        over this client's session.
+
+        ** Parameters **
+          ``identifier_ids`` (*iterable of string*)
+          The identification urls of the identifiers. May be a lazy
+          iterator; an id repeated is fetched only once.
+          ``concurrency`` (*int*)
+          The maximum number of requests in flight
+
+        Yields a ``BatchResult(index, record, response, error)`` for every
+        distinct id as its request completes, with the id as ``record`` and
+        the position of its first appearance as ``index``. An identifier
+        which can't be fetched (e.g. it doesn't exist or is not visible)
+        has ``response`` None and the raised exception as ``error``; the
+        others are still fetched.
+        """
+        size_connection_pool(self, concurrency)
         self.logger.info(
-            'IdentifierClient.get_identifier({})'.format(identifier_id))
-        return self.get(path, params=params)
+            'IdentifierClient.get_identifiers(concurrency=%s)', concurrency)
+        seen = set()
+
+        def _distinct():
+            for position, identifier_id in enumerate(identifier_ids):
+                if isinstance(identifier_id, Exception):
+                    yield position, identifier_id
+                elif identifier_id not in seen:
+                    seen.add(identifier_id)
+                    yield position, identifier_id
+
+        def _get(item):
+            identifier_id = item[1]
+            if isinstance(identifier_id, Exception):
+                raise identifier_id
+            return self.get_identifier(identifier_id)
+
+        for _, item, response, error in bounded_map(
+                _get, _distinct(), concurrency, ordered=False):
+            yield BatchResult(item[0], item[1], response, error)
 
     def update_identifier(self, identifier_id, **kwargs):
         """
@@ -242,10 +583,35 @@ class IdentifierClient(BaseClient):
           what users may see the created identifier
           ``metadata`` (*dict*)
           Additional metadata associated with the identifier
+          ``minimal`` (*bool*)
+          Compare the update with the identifier's current record and send
+          only the properties whose values differ. If none do, no request
+          is made and the current record is returned with ``unchanged``
+          set. The record is retrieved with ``get_identifier``, so comes
+          from the response cache if one is configured.
+          ``current`` (*dict*)
+          With ``minimal``, the identifier's record as last retrieved, to
+          compare with rather than getting it again
 
         """
+        minimal = kwargs.pop('minimal', False)
+        current = kwargs.pop('current', None)
         kwargs = _json_parse_args(kwargs, _identifier_json_props)
         kwargs, body = _split_dict(kwargs, _identifier_properties)
-        self.logger.info('IdentifierClient.update_identifier({}, ...)'.format(
-            body.get('identifier_id')))
-        return self.put(identifier_id, body, params=kwargs)
+        self.logger.info(
+            'IdentifierClient.update_identifier(%s, ...)', identifier_id)
+        if minimal:
+            if current is None:
+                current = self.get_identifier(identifier_id).data
+            body = _changed_properties(body, current)
+            if not body:
+                self.logger.info('identifier %s unchanged, not updated',
+                                 identifier_id)
+                return GlobusResponse(dict(current, unchanged=True),
+                                      client=self)
+        try:
+            response = self.put(identifier_id, body, params=kwargs)
+        finally:
+            self._invalidate(safe_stringify(identifier_id))
+        self._record_minted(response)
+        return response
@@ -0,0 +1,387 @@
+import atexit
+import binascii
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from identifiers_client.config import IDENTIFIER_INDEX_FILE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FILTER_CAPACITY = 1000000
+DEFAULT_FILTER_ERROR_RATE = 0.01
+
+# SQLite page cache, in KiB (a negative cache_size is in KiB)
+_CACHE_KIB = 64 * 1024
+
+_FILTER_MAGIC = b'IDXBLOOM1'
+_FILTER_HEADER = struct.Struct('<9sQQQq')
+
+IndexedIdentifier = namedtuple(
+    'IndexedIdentifier',
+    ['identifier', 'namespace', 'location', 'checksums', 'metadata_hash',
+     'created_at'])
+
+
+def metadata_hash(metadata):
+    """The sha256 of metadata's canonical JSON encoding."""
+    if metadata is None:
+        return None
+    text = json.dumps(metadata, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _stored_value(value):
+    """Hex digests are stored as their bytes, half the size of the text;
+    anything else as it is."""
+    try:
+        return sqlite3.Binary(binascii.unhexlify(value.lower()))
+    except (TypeError, ValueError, binascii.Error):
+        return value
+
+
+def _digest_text(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return binascii.hexlify(bytes(value)).decode('ascii')
+    return value
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter sized for ``capacity`` keys with a false positive rate
+    of ``error_rate``: ``key in filter`` is never False for a key which was
+    added, and rarely True for one which wasn't. 100 million keys at 1%
+    take 114MiB.
+    """
+
+    def __init__(self, capacity=DEFAULT_FILTER_CAPACITY,
+                 error_rate=DEFAULT_FILTER_ERROR_RATE, bits=None):
+        self.capacity = capacity
+        self.num_bits = max(64, int(-capacity * math.log(error_rate) /
+                                    math.log(2)**2))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / float(capacity) * math.log(2))))
+        if bits is None:
+            bits = bytearray((self.num_bits + 7) // 8)
+        self.bits = bits
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+def _filter_key(function, value):
+    return u'{}:{}'.format(function, value).encode('utf-8')
+
+
+class MintedIndex(object):
+    """
+    A local record of identifiers minted (or updated) by this client, kept
+    in a SQLite database at path so that data which already has an
+    identifier isn't given another. Identifiers are looked up by checksum,
+    through a Bloom filter which answers most lookups for checksums never
+    seen without reading the database. The filter is saved beside the
+    database (at path + '.bloom') by ``close()``; if it is missing or out
+    of date it is brought up to date from the database when opened, and
+    again before a lookup it misses if another process has written to the
+    database since.
+    """
+
+    def __init__(self, path, filter_capacity=DEFAULT_FILTER_CAPACITY,
+                 filter_error_rate=DEFAULT_FILTER_ERROR_RATE):
+        self.path = path
+        self.filter_path = path + '.bloom'
+        self.filter_capacity = filter_capacity
+        self.filter_error_rate = filter_error_rate
+        self._lock = threading.Lock()
+        # Opened when first used, so commands which never touch the index
+        # don't pay for loading the filter
+        self._db = None
+
+    def _connect(self):
+        """Open the database and filter, if they aren't. Call with the lock
+        held."""
+        if self._db is not None:
+            return
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('PRAGMA cache_size=-{}'.format(_CACHE_KIB))
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS identifiers ('
+            'id INTEGER PRIMARY KEY, identifier TEXT NOT NULL UNIQUE, '
+            'namespace TEXT, location TEXT, metadata_hash TEXT, '
+            'created_at REAL)')
+        # Clustered on the checksum, so a lookup is a single b-tree search
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            'function TEXT NOT NULL, value BLOB NOT NULL, '
+            'identifier_id INTEGER NOT NULL, '
+            'PRIMARY KEY (function, value, identifier_id)) WITHOUT ROWID')
+        db.execute('CREATE INDEX IF NOT EXISTS checksums_identifier '
+                   'ON checksums (identifier_id)')
+        db.commit()
+        self._db = db
+        self._filter, self._filter_rowid = self._load_filter()
+        self._filter_count = self._filter.count
+        self._filter_dirty = False
+        # Read first, so that a commit made while catching up is noticed
+        self._data_version = self._db_version()
+        self._catch_up_filter()
+
+    def _db_version(self):
+        # Changes whenever another connection commits to the database
+        return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Open the index described by the optional ``[index]`` section of
+        config (options ``enabled``, ``path``, ``filter_capacity`` and
+        ``filter_error_rate``); by default at IDENTIFIER_INDEX_FILE. Returns
+        None when there is no such section, or the index is turned off. The
+        index is closed, saving its filter, when the process exits.
+        """
+        if not config.has_section('index'):
+            return None
+
+        def _option(name, default):
+            if config.has_option('index', name):
+                return config.get('index', name)
+            return default
+
+        if (config.has_option('index', 'enabled')
+                and not config.getboolean('index', 'enabled')):
+            return None
+        index = cls(
+            os.path.expanduser(_option('path', IDENTIFIER_INDEX_FILE)),
+            filter_capacity=int(_option('filter_capacity',
+                                        DEFAULT_FILTER_CAPACITY)),
+            filter_error_rate=float(_option('filter_error_rate',
+                                            DEFAULT_FILTER_ERROR_RATE)))
+        atexit.register(index.close)
+        return index
+
+    def _load_filter(self):
+        try:
+            with open(self.filter_path, 'rb') as f:
+                magic, saved_capacity, num_bits, count, rowid = (
+                    _FILTER_HEADER.unpack(f.read(_FILTER_HEADER.size)))
+                bits = bytearray(f.read())
+            if magic == _FILTER_MAGIC:
+                bloom = BloomFilter(saved_capacity, self.filter_error_rate,
+                                    bits)
+                if (bloom.num_bits == num_bits
+                        and len(bits) == (num_bits + 7) // 8):
+                    bloom.count = count
+                    return bloom, rowid
+        except (IOError, OSError, struct.error):
+            pass
+        return BloomFilter(self.filter_capacity, self.filter_error_rate), 0
+
+    def _catch_up_filter(self):
+        """
+        Add the checksums of identifiers recorded (by any process) since
+        the filter was last brought up to date. An identifier recorded
+        again is moved to a new id (see ``_add``), so this finds its new
+        checksums too. Call with the lock held.
+        """
+        count = self._db.execute(
+            'SELECT COUNT(*) FROM checksums WHERE identifier_id > ?',
+            (self._filter_rowid, )).fetchone()[0]
+        if not count:
+            return
+        if self._filter_count + count > self._filter.capacity:
+            self._rebuild_filter()
+            return
+        log.debug('adding %s checksums to the index filter', count)
+        self._fill_filter('WHERE identifier_id > ?', (self._filter_rowid, ))
+
+    def _rebuild_filter(self):
+        total = self._db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+        capacity = max(self._filter.capacity, 1)
+        while capacity < total * 2:
+            capacity *= 2
+        log.info('rebuilding the index filter for %s checksums', capacity)
+        self._filter = BloomFilter(capacity, self.filter_error_rate)
+        self._filter_rowid = self._filter_count = 0
+        self._fill_filter('', ())
+
+    def _fill_filter(self, where, params):
+        rows = self._db.execute(
+            'SELECT function, value, identifier_id FROM checksums ' + where,
+            params)
+        for function, value, identifier_id in rows:
+            self._filter.add(_filter_key(function, _digest_text(value)))
+            self._filter_count += 1
+            self._filter_rowid = max(self._filter_rowid, identifier_id)
+        self._filter.count = max(self._filter.count, self._filter_count)
+        self._filter_dirty = True
+
+    def save_filter(self):
+        """
+        Write the filter beside the database, so that the next process to
+        open the index need not build it again.
+        """
+        with self._lock:
+            if self._db is None or not self._filter_dirty:
+                return
+            # Identifiers added here are already in the filter, but only
+            # those read back from the database are counted as covered,
+            # so that ones added meanwhile by other processes aren't missed
+            self._catch_up_filter()
+            tmp = '{}.{}.tmp'.format(self.filter_path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(_FILTER_HEADER.pack(
+                    _FILTER_MAGIC, self._filter.capacity,
+                    self._filter.num_bits, self._filter_count,
+                    self._filter_rowid))
+                f.write(self._filter.bits)
+            os.rename(tmp, self.filter_path)
+            self._filter_dirty = False
+
+    def _add(self, record):
+        identifier = record.get('identifier')
+        if not identifier:
+            raise ValueError('Record has no identifier')
+        location = record.get('location')
+        row = self._db.execute(
+            'SELECT id FROM identifiers WHERE identifier = ?',
+            (identifier, )).fetchone()
+        values = (record.get('namespace'),
+                  None if location is None else json.dumps(location),
+                  metadata_hash(record.get('metadata')))
+        if row is None:
+            rowid = self._db.execute(
+                'INSERT INTO identifiers (identifier, namespace, location, '
+                'metadata_hash, created_at) VALUES (?, ?, ?, ?, ?)',
+                (identifier, ) + values + (time.time(), )).lastrowid
+        else:
+            # Moved to the next id, so that filters catching up from the
+            # highest id they have seen pick up its new checksums
+            self._db.execute('DELETE FROM checksums WHERE identifier_id = ?',
+                             (row[0], ))
+            rowid = self._db.execute(
+                'SELECT MAX(id) + 1 FROM identifiers').fetchone()[0]
+            self._db.execute(
+                'UPDATE identifiers SET id = ?, '
+                'namespace = coalesce(?, namespace), location = ?, '
+                'metadata_hash = ? WHERE id = ?',
+                (rowid, ) + values + (row[0], ))
+        checksums = [(c['function'].lower(), c['value'])
+                     for c in record.get('checksums') or []
+                     if c.get('function') and c.get('value')]
+        self._db.executemany(
+            'INSERT OR IGNORE INTO checksums VALUES (?, ?, ?)',
+            [(function, _stored_value(value), rowid)
+             for function, value in checksums])
+        for function, value in checksums:
+            self._filter.add(_filter_key(function, _digest_text(
+                _stored_value(value))))
+        self._filter_dirty = True
+        if self._filter.count > self._filter.capacity:
+            self._rebuild_filter()
+
+    def add(self, record):
+        """
+        Record an identifier, given as the service returns it (with
+        ``identifier``, ``namespace``, ``location``, ``checksums`` and
+        ``metadata``), replacing anything recorded for it before.
+        """
+        self.add_many([record])
+
+    def add_many(self, records):
+        """Record many identifiers in one transaction."""
+        with self._lock:
+            self._connect()
+            try:
+                for record in records:
+                    self._add(record)
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+
+    def might_contain(self, function, value):
+        """False if no identifier has this checksum; True if one may."""
+        key = _filter_key(function.lower(), _digest_text(
+            _stored_value(value)))
+        with self._lock:
+            self._connect()
+            if key in self._filter:
+                return True
+            # The checksum may have been recorded by another process since
+            # the filter was brought up to date
+            version = self._db_version()
+            if version == self._data_version:
+                return False
+            self._catch_up_filter()
+            self._data_version = version
+            return key in self._filter
+
+    def find(self, function, value, namespace=None):
+        """
+        The earliest recorded identifier (in namespace, if given) with the
+        checksum ``value`` computed by ``function``, as an
+        IndexedIdentifier, or None.
+        """
+        function = function.lower()
+        if not self.might_contain(function, value):
+            return None
+        query = ('SELECT i.id, i.identifier, i.namespace, i.location, '
+                 'i.metadata_hash, i.created_at FROM checksums c '
+                 'JOIN identifiers i ON i.id = c.identifier_id '
+                 'WHERE c.function = ? AND c.value = ?')
+        params = [function, _stored_value(value)]
+        if namespace is not None:
+            query += ' AND i.namespace = ?'
+            params.append(namespace)
+        with self._lock:
+            row = self._db.execute(
+                query + ' ORDER BY i.created_at, i.id LIMIT 1',
+                params).fetchone()
+            if row is None:
+                return None
+            checksums = self._db.execute(
+                'SELECT function, value FROM checksums '
+                'WHERE identifier_id = ?', (row[0], )).fetchall()
+        return IndexedIdentifier(
+            row[1], row[2], None if row[3] is None else json.loads(row[3]),
+            [{'function': f, 'value': _digest_text(v)} for f, v in checksums],
+            row[4], row[5])
+
+    def __len__(self):
+        with self._lock:
+            self._connect()
+            return self._db.execute(
+                'SELECT COUNT(*) FROM identifiers').fetchone()[0]
+
+    def close(self):
+        self.save_filter()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
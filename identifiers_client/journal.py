@@ -0,0 +1,467 @@
+import errno
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+from identifiers_client.config import IDENTIFIER_JOURNAL_FILE
+
+log = logging.getLogger(__name__)
+
+CREATE = 'create'
+UPDATE = 'update'
+
+# States of a journalled operation
+PENDING = 'pending'
+INFLIGHT = 'inflight'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, INFLIGHT, DONE, FAILED)
+
+DEFAULT_MAX_ATTEMPTS = 10
+
+# An operation claimed by a flusher is taken over by another after this
+# many seconds, in case the first stopped without its process exiting
+DEFAULT_LEASE = 600
+
+# Longest wait between attempts at an operation, in seconds
+_MAX_BACKOFF = 300
+
+# HTTP statuses after which an operation is tried again later rather than
+# failed
+_retry_statuses = frozenset([408, 429, 500, 502, 503, 504])
+
+
+def _owner():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def _owner_gone(owner):
+    """Whether the process named by owner (from ``_owner()``) has exited,
+    as far as can be told from this host."""
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        # EPERM: the process exists but belongs to someone else
+        return err.errno != errno.EPERM
+    return False
+
+
+def path_from_config(config):
+    """The journal's path: the ``path`` option of the optional
+    ``[journal]`` section of config, or IDENTIFIER_JOURNAL_FILE."""
+    if config.has_option('journal', 'path'):
+        return os.path.expanduser(config.get('journal', 'path'))
+    return IDENTIFIER_JOURNAL_FILE
+
+
+class JournalEntry(object):
+    """An operation claimed from the journal."""
+
+    __slots__ = ('ticket', 'operation', 'identifier', 'args', 'attempts',
+                 'recovered')
+
+    def __init__(self, ticket, operation, identifier, args, attempts,
+                 recovered):
+        self.ticket = ticket
+        self.operation = operation
+        self.identifier = identifier
+        self.args = args
+        self.attempts = attempts
+        # Claimed from a flusher which stopped part way through, so it may
+        # already have reached the service
+        self.recovered = recovered
+
+
+class Journal(object):
+    """
+    A crash-safe record of identifier creates and updates to be sent to
+    the service later, kept in a SQLite database at path. Each operation
+    appended gets a ticket by which its progress and, once sent, the
+    service's response can be looked up. Operations are committed to disk
+    before their ticket is returned.
+
+    Any number of processes may append to and flush the same journal.
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE):
+        self.path = path
+        self.lease = lease
+        self._owner = _owner()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS operations ('
+            'ticket INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'operation TEXT NOT NULL, identifier TEXT, args TEXT NOT NULL, '
+            'state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+            'next_attempt_at REAL NOT NULL, owner TEXT, lease_until REAL, '
+            'created_at REAL NOT NULL, finished_at REAL, response TEXT, '
+            'error TEXT)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS operations_state '
+            'ON operations (state, next_attempt_at)')
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Open the journal given by the optional ``[journal]`` section of
+        config (option ``path``), by default at IDENTIFIER_JOURNAL_FILE.
+        """
+        return cls(path_from_config(config))
+
+    def _transaction(self, mode='IMMEDIATE'):
+        return _Transaction(self._db, self._lock, mode)
+
+    def append(self, operation, args, identifier=None):
+        """Journal an operation, returning its ticket."""
+        if operation not in (CREATE, UPDATE):
+            raise ValueError('Unknown operation: {}'.format(operation))
+        if operation == UPDATE and not identifier:
+            raise ValueError('An update needs an identifier')
+        now = time.time()
+        with self._transaction() as db:
+            return db.execute(
+                'INSERT INTO operations (operation, identifier, args, state, '
+                'next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (operation, identifier, json.dumps(args), PENDING, now,
+                 now)).lastrowid
+
+    def create_identifier(self, **kwargs):
+        """Journal a ``create_identifier`` call, returning its ticket."""
+        return self.append(CREATE, kwargs)
+
+    def update_identifier(self, identifier_id, **kwargs):
+        """Journal an ``update_identifier`` call, returning its ticket."""
+        return self.append(UPDATE, kwargs, identifier=identifier_id)
+
+    def claim(self, limit):
+        """
+        Take up to limit operations which are due to be sent, marking them
+        in flight for this process, and return them as JournalEntries in
+        ticket order. Operations left in flight by a process which has
+        exited, or whose lease has run out, are taken over. An update is
+        not taken while an earlier update to the same identifier is in
+        flight or waiting to be retried, so updates reach the service in
+        order.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT ticket, operation, identifier, args, attempts, state, '
+                'next_attempt_at, owner, lease_until FROM operations '
+                'WHERE state IN (?, ?) ORDER BY ticket', (PENDING, INFLIGHT))
+            entries = []
+            # Identifiers with an earlier update which isn't being sent now
+            busy = set()
+            for (ticket, operation, identifier, args, attempts, state,
+                 next_attempt_at, owner, lease_until) in rows:
+                recovered = False
+                if state == INFLIGHT:
+                    if owner == self._owner or (lease_until > now and
+                                                not _owner_gone(owner)):
+                        busy.add(identifier)
+                        continue
+                    recovered = True
+                elif next_attempt_at > now:
+                    busy.add(identifier)
+                    continue
+                if operation == UPDATE and identifier in busy:
+                    continue
+                entries.append(JournalEntry(ticket, operation, identifier,
+                                            json.loads(args), attempts,
+                                            recovered))
+                if len(entries) >= limit:
+                    break
+            db.executemany(
+                'UPDATE operations SET state = ?, owner = ?, lease_until = ? '
+                'WHERE ticket = ?',
+                [(INFLIGHT, self._owner, now + self.lease, e.ticket)
+                 for e in entries])
+        for entry in entries:
+            if entry.recovered:
+                log.info('recovered journal ticket %s from a stopped flusher',
+                         entry.ticket)
+        return entries
+
+    def complete(self, tickets, response):
+        """Record the service's response to the operations tickets."""
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE operations SET state = ?, finished_at = ?, '
+                'response = ?, error = NULL, owner = NULL WHERE ticket = ?',
+                [(DONE, time.time(), json.dumps(response), t)
+                 for t in tickets])
+
+    def retry(self, tickets, error, attempts):
+        """Put the operations tickets back to be tried again after a delay
+        growing with attempts, the number made so far."""
+        delay = min(_MAX_BACKOFF, 2**attempts) * random.uniform(0.5, 1.0)
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE operations SET state = ?, attempts = ?, '
+                'next_attempt_at = ?, error = ?, owner = NULL '
+                'WHERE ticket = ?',
+                [(PENDING, attempts, time.time() + delay, error, t)
+                 for t in tickets])
+
+    def fail(self, tickets, error, attempts):
+        """Give up on the operations tickets."""
+        with self._transaction() as db:
+            db.executemany(
+                'UPDATE operations SET state = ?, attempts = ?, '
+                'finished_at = ?, error = ?, owner = NULL WHERE ticket = ?',
+                [(FAILED, attempts, time.time(), error, t) for t in tickets])
+
+    def release(self):
+        """Hand back operations this process has claimed but not
+        finished, e.g. when stopping, so others may send them at once."""
+        with self._transaction() as db:
+            db.execute(
+                'UPDATE operations SET state = ?, owner = NULL '
+                'WHERE state = ? AND owner = ?',
+                (PENDING, INFLIGHT, self._owner))
+
+    def get(self, ticket):
+        """The state of the operation ticket as a dict, or None."""
+        with self._transaction('DEFERRED') as db:
+            db.row_factory = sqlite3.Row
+            try:
+                row = db.execute('SELECT * FROM operations WHERE ticket = ?',
+                                 (ticket, )).fetchone()
+            finally:
+                db.row_factory = None
+        if row is None:
+            return None
+        entry = dict((key, row[key]) for key in row.keys())
+        for key in ('args', 'response'):
+            if entry[key] is not None:
+                entry[key] = json.loads(entry[key])
+        entry.pop('owner')
+        entry.pop('lease_until')
+        return entry
+
+    def next_due(self):
+        """
+        Seconds until the next pending operation is due (0 if one is due
+        now), or None if nothing is pending or in flight.
+        """
+        with self._transaction('DEFERRED') as db:
+            pending = db.execute(
+                'SELECT MIN(next_attempt_at) FROM operations WHERE state = ?',
+                (PENDING, )).fetchone()[0]
+            inflight = db.execute(
+                'SELECT COUNT(*) FROM operations WHERE state = ?',
+                (INFLIGHT, )).fetchone()[0]
+        if pending is None:
+            return 0 if inflight else None
+        return max(0, pending - time.time())
+
+    def summary(self):
+        """Counts of operations by state, and the age in seconds of the
+        oldest not yet sent."""
+        with self._transaction('DEFERRED') as db:
+            counts = dict(db.execute(
+                'SELECT state, COUNT(*) FROM operations GROUP BY state'))
+            oldest = db.execute(
+                'SELECT MIN(created_at) FROM operations WHERE state IN (?, ?)',
+                (PENDING, INFLIGHT)).fetchone()[0]
+        summary = dict((state, counts.get(state, 0)) for state in STATES)
+        summary['path'] = self.path
+        summary['oldest_unsent_age'] = (None if oldest is None else
+                                        round(time.time() - oldest, 1))
+        return summary
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class _Transaction(object):
+    def __init__(self, db, lock, mode):
+        self.db = db
+        self.lock = lock
+        self.mode = mode
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.db.execute('BEGIN {}'.format(self.mode))
+        except Exception:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        finally:
+            self.lock.release()
+
+
+def _merge(entries):
+    """
+    Group claimed entries into requests: each create on its own, and the
+    updates to an identifier merged into one, later values replacing
+    earlier ones. Returns ``(entries, operation, identifier, args)`` for
+    each request.
+    """
+    requests = []
+    updates = {}
+    for entry in entries:
+        if entry.operation == UPDATE:
+            if entry.identifier in updates:
+                request = updates[entry.identifier]
+                request[0].append(entry)
+                request[3].update(entry.args)
+                continue
+            request = ([entry], UPDATE, entry.identifier, dict(entry.args))
+            updates[entry.identifier] = request
+        else:
+            request = ([entry], CREATE, None, dict(entry.args))
+        requests.append(request)
+    return requests
+
+
+def _retryable(error):
+    from globus_sdk.exc import GlobusAPIError, NetworkError
+    if isinstance(error, NetworkError):
+        return True
+    return (isinstance(error, GlobusAPIError)
+            and error.http_status in _retry_statuses)
+
+
+def _describe(error):
+    status = getattr(error, 'http_status', None)
+    message = getattr(error, 'message', None) or str(error)
+    return message if status is None else '{}: {}'.format(status, message)
+
+
+class JournalFlusher(object):
+    """
+    Sends the operations in a Journal to the service, running up to
+    ``concurrency`` requests at once, through the client returned by
+    get_client (called for each batch, so a client replaced after logging
+    in again is picked up). Successive updates to an identifier waiting in
+    the journal are merged into one request. Operations which fail with a
+    network error or a retryable status are tried again later, with
+    growing delays, up to ``max_attempts`` times; others fail at once.
+
+    A create which may already have reached the service (one being tried
+    again, or taken over from a flusher which stopped part way) is sent with
+    ``dedupe``, so that if it had already been minted, and recorded in the
+    client's index, it is not minted again. The index only knows of
+    identifiers whose creation was answered, so a create whose answer was
+    lost (e.g. to a read timeout or a 502) can still be minted twice, as
+    can any create retried through a client without an index.
+    """
+
+    def __init__(self, journal, get_client, concurrency=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS, interval=1.0):
+        from identifiers_client.batch import DEFAULT_CONCURRENCY
+        self.journal = journal
+        self.get_client = get_client
+        self.concurrency = concurrency or DEFAULT_CONCURRENCY
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _send(self, client, request):
+        entries, operation, identifier, args = request
+        if operation == UPDATE:
+            return client.update_identifier(identifier, **args)
+        entry = entries[0]
+        if ((entry.recovered or entry.attempts > 0)
+                and client.index is not None):
+            args['dedupe'] = True
+        return client.create_identifier(**args)
+
+    def flush_once(self):
+        """Send one batch of due operations, returning how many."""
+        # Before claiming anything, so a client which can't be made (e.g.
+        # when logged out) leaves the journal as it was
+        client = self.get_client()
+        entries = self.journal.claim(self.concurrency * 4)
+        if not entries:
+            return 0
+        try:
+            self._send_all(client, entries)
+        except Exception:
+            self.journal.release()
+            raise
+        return len(entries)
+
+    def _send_all(self, client, entries):
+        from identifiers_client.batch import bounded_map, size_connection_pool
+
+        size_connection_pool(client, self.concurrency)
+        requests = _merge(entries)
+        log.debug('flushing %s journalled operations in %s requests',
+                  len(entries), len(requests))
+        for _, request, response, error in bounded_map(
+                lambda r: self._send(client, r), requests, self.concurrency):
+            tickets = [e.ticket for e in request[0]]
+            if error is None:
+                self.journal.complete(tickets, response.data)
+                continue
+            attempts = max(e.attempts for e in request[0]) + 1
+            if _retryable(error) and attempts < self.max_attempts:
+                log.info('journal tickets %s will be retried: %s', tickets,
+                         _describe(error))
+                self.journal.retry(tickets, _describe(error), attempts)
+            else:
+                log.warning('journal tickets %s failed: %s', tickets,
+                            _describe(error))
+                self.journal.fail(tickets, _describe(error), attempts)
+
+    def flush(self, timeout=None):
+        """
+        Send operations until none are waiting (waiting out any retry
+        delays) or timeout seconds have passed. Returns True if the journal
+        was emptied.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self.flush_once():
+                continue
+            due = self.journal.next_due()
+            if due is None:
+                return True
+            if deadline is not None and time.time() + due > deadline:
+                return False
+            # Operations in flight elsewhere are waited on too
+            time.sleep(max(due, self.interval))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.flush_once():
+                    continue
+            except Exception:
+                log.exception('flushing the journal failed')
+            self._stop.wait(self.interval)
+        self.journal.release()
+
+    def start(self):
+        """Keep flushing the journal on a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
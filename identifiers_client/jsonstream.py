@@ -0,0 +1,111 @@
+import codecs
+import json
+
+READ_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+_number_chars = '0123456789.eE+-'
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class ArrayMemberReader(object):
+    """
+    Parses a JSON object read in chunks (bytes or text), yielding the
+    elements of its array member ``key`` one at a time as they are parsed,
+    so a large response is never held in memory whole. The object's other
+    members are collected in ``fields`` as they are passed; all of them are
+    there once iteration has finished.
+    """
+
+    def __init__(self, chunks, key):
+        self.key = key
+        self.fields = {}
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk into the buffer; False at the end of input."""
+        if self._eof:
+            return False
+        if self._pos >= READ_SIZE:
+            # Drop what has been parsed so the buffer doesn't grow with the
+            # whole document
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                if isinstance(chunk, bytes):
+                    chunk = self._decode(chunk)
+                self._buf += chunk
+                return True
+        self._eof = True
+        self._buf += self._decode(b'', True)
+        return False
+
+    def _peek(self):
+        while True:
+            while (self._pos < len(self._buf)
+                   and self._buf[self._pos] in _whitespace):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise JSONStreamError('Unexpected end of JSON input')
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise JSONStreamError('Expected one of {!r} but found {!r}'.format(
+                chars, c))
+        self._pos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buf, self._pos)
+            except ValueError as err:
+                if self._fill():
+                    continue
+                raise JSONStreamError('Invalid JSON: {}'.format(err))
+            # A number reaching the end of the buffer, perhaps with a
+            # partial fraction or exponent after it, may carry on in the
+            # next chunk
+            if (isinstance(value, (int, float))
+                    and not self._buf[end:].strip(_number_chars)
+                    and self._fill()):
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            name = self._value()
+            if not isinstance(name, str):
+                raise JSONStreamError('Expected an object member name')
+            self._expect(':')
+            if name == self.key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.fields[name] = self._value()
+            if self._expect(',}') == '}':
+                return
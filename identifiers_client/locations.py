@@ -0,0 +1,273 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from identifiers_client.config import IDENTIFIER_HOST_HISTORY
+
+log = logging.getLogger(__name__)
+
+# Observations lose half their weight in the estimates after this many
+# seconds, so a host which has got faster or slower is soon seen as such
+DEFAULT_HALF_LIFE = 24 * 60 * 60
+
+# No estimate counts for more than this many observations, so recent ones
+# always move it
+_MAX_WEIGHT = 10.0
+
+# Hosts observed more recently than this are ranked from their history
+# without probing them again
+DEFAULT_PROBE_AFTER = 60 * 60
+
+# Bytes read by a probe, enough to get past a server's first packets
+PROBE_BYTES = 64 * 1024
+
+# Transfer size assumed when ranking for data of unknown size
+_ASSUMED_SIZE = 16 * 1024 * 1024
+
+# Throughput assumed for a host with a latency but no throughput estimate
+_ASSUMED_THROUGHPUT = 10 * 1000 * 1000
+
+# A host failing this often is ranked as if it always failed
+_MAX_FAILURE_RATE = 0.95
+
+HostEstimate = namedtuple(
+    'HostEstimate',
+    ['host', 'latency', 'throughput', 'failure_rate', 'updated_at'])
+
+RankedLocation = namedtuple(
+    'RankedLocation',
+    ['url', 'expected_seconds', 'latency', 'throughput', 'failure_rate'])
+
+
+def host_of(url):
+    parsed = urlparse(url)
+    return '{}://{}'.format(parsed.scheme, parsed.netloc).lower()
+
+
+def _decayed(value, weight, sample):
+    """Fold sample into an average of value over weight observations."""
+    if sample is None:
+        return value, weight
+    if value is None or weight <= 0:
+        return float(sample), 1.0
+    return ((value * weight + sample) / (weight + 1),
+            min(_MAX_WEIGHT, weight + 1))
+
+
+class HostHistory(object):
+    """
+    Latency, throughput and failure rate observed for each host (a URL's
+    scheme and network location), kept in a SQLite database at path. Each
+    is an average in which an observation's weight halves every
+    ``half_life`` seconds.
+    """
+
+    def __init__(self, path, half_life=DEFAULT_HALF_LIFE):
+        self.path = path
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS hosts ('
+            'host TEXT PRIMARY KEY, latency REAL, latency_weight REAL, '
+            'throughput REAL, throughput_weight REAL, failure_rate REAL, '
+            'failure_weight REAL, updated_at REAL)')
+        self._db.commit()
+
+    def record(self, url, latency=None, throughput=None, ok=True):
+        """
+        Add an observation of url's host: the seconds it took to start
+        responding and the bytes a second it sent, if measured, and whether
+        the request succeeded.
+        """
+        host = host_of(url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT latency, latency_weight, throughput, '
+                'throughput_weight, failure_rate, failure_weight, updated_at '
+                'FROM hosts WHERE host = ?', (host, )).fetchone()
+            if row is None:
+                row = (None, 0.0, None, 0.0, None, 0.0, now)
+            decay = 0.5**(max(0.0, now - row[6]) / self.half_life)
+            latency, latency_weight = _decayed(row[0], row[1] * decay,
+                                               latency)
+            throughput, throughput_weight = _decayed(
+                row[2], row[3] * decay, throughput)
+            failure_rate, failure_weight = _decayed(row[4], row[5] * decay,
+                                                    0.0 if ok else 1.0)
+            self._db.execute(
+                'INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (host, latency, latency_weight, throughput, throughput_weight,
+                 failure_rate, failure_weight, now))
+            self._db.commit()
+
+    def estimate(self, url):
+        """The HostEstimate for url's host, or None if it has never been
+        observed."""
+        host = host_of(url)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT latency, throughput, failure_rate, updated_at FROM '
+                'hosts WHERE host = ?', (host, )).fetchone()
+        return None if row is None else HostEstimate(host, *row)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def expected_seconds(estimate, size=None):
+    """
+    The expected time to transfer size bytes (by default _ASSUMED_SIZE) from
+    a host with the given HostEstimate, allowing for attempts which fail, or
+    None if its latency isn't known.
+    """
+    if estimate is None or estimate.latency is None:
+        return None
+    if size is None:
+        size = _ASSUMED_SIZE
+    throughput = estimate.throughput or _ASSUMED_THROUGHPUT
+    seconds = estimate.latency + size / float(throughput)
+    failure_rate = min(estimate.failure_rate or 0.0, _MAX_FAILURE_RATE)
+    return seconds / (1 - failure_rate)
+
+
+class LocationRanker(object):
+    """
+    Orders the locations of some data by how quickly each is expected to
+    deliver it, from the HostHistory of their hosts. Hosts which haven't
+    been observed within ``probe_after`` seconds are first probed, all at
+    once, with a small range request which measures their latency and
+    throughput. Locations which can't be probed (such as those which aren't
+    HTTP URLs) or ranked keep their order, after those which can, and
+    locations whose hosts mostly fail come last.
+    """
+
+    def __init__(self, history, probe_after=DEFAULT_PROBE_AFTER,
+                 probe_bytes=PROBE_BYTES, timeout=5, max_workers=8,
+                 session=None):
+        self.history = history
+        self.probe_after = probe_after
+        self.probe_bytes = probe_bytes
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def probe(self, url):
+        """
+        Request the first probe_bytes of url, recording in the history the
+        time to the response and the rate at which the bytes arrived.
+        Returns whether the location responded.
+        """
+        headers = {
+            'Range': 'bytes=0-{}'.format(self.probe_bytes - 1),
+            'Accept-Encoding': 'identity'
+        }
+        started = time.time()
+        try:
+            r = self.session.get(url, headers=headers, stream=True,
+                                 timeout=self.timeout)
+            with r:
+                latency = time.time() - started
+                if r.status_code not in (200, 206):
+                    log.debug('probe of %s: HTTP status %s', url,
+                              r.status_code)
+                    self.history.record(url, latency, ok=False)
+                    return False
+                received = 0
+                # A server ignoring the range sends everything; only the
+                # start is read
+                for chunk in r.iter_content(16 * 1024):
+                    received += len(chunk)
+                    if received >= self.probe_bytes:
+                        break
+                elapsed = time.time() - started - latency
+        except requests.RequestException as err:
+            log.debug('probe of %s failed: %s', url, err)
+            self.history.record(url, ok=False)
+            return False
+        throughput = None
+        if received >= self.probe_bytes:
+            # Reads too quick to time show the throughput is at least this
+            throughput = received / max(elapsed, 0.001)
+        self.history.record(url, latency, throughput)
+        return True
+
+    def _stale(self, url):
+        estimate = self.history.estimate(url)
+        return (estimate is None
+                or time.time() - estimate.updated_at >= self.probe_after)
+
+    def rank(self, urls, size=None, probe=True):
+        """
+        Return a RankedLocation for each of urls, fastest expected first,
+        for data of size bytes. With ``probe=False`` only the history is
+        used.
+        """
+        urls = list(urls)
+        if probe and len(urls) > 1:
+            # One probe per host is enough
+            to_probe = {}
+            for url in urls:
+                if (urlparse(url).scheme in ('http', 'https')
+                        and host_of(url) not in to_probe
+                        and self._stale(url)):
+                    to_probe[host_of(url)] = url
+            if to_probe:
+                log.debug('probing %s', ', '.join(sorted(to_probe)))
+                list(self._pool.map(self.probe, to_probe.values()))
+        ranked = []
+        for position, url in enumerate(urls):
+            estimate = self.history.estimate(url)
+            seconds = expected_seconds(estimate, size)
+            # A failing host is still timed (its error responses have a
+            # latency), so is checked for first
+            if (estimate is not None and estimate.failure_rate is not None
+                    and estimate.failure_rate >= 0.5):
+                group = 2
+            elif seconds is not None:
+                group = 0
+            else:
+                group = 1
+            ranked.append((group, seconds or 0, position,
+                           RankedLocation(
+                               url, seconds,
+                               estimate and estimate.latency,
+                               estimate and estimate.throughput,
+                               estimate and estimate.failure_rate)))
+        ranked.sort(key=lambda item: item[:3])
+        return [item[3] for item in ranked]
+
+    def order(self, urls, size=None, probe=True):
+        """urls, fastest expected first (see ``rank``)."""
+        return [location.url for location in self.rank(urls, size, probe)]
+
+
+_default_ranker = None
+_default_ranker_lock = threading.Lock()
+
+
+def get_ranker():
+    """Return a LocationRanker shared by the process, with the history kept
+    at IDENTIFIER_HOST_HISTORY."""
+    global _default_ranker
+    with _default_ranker_lock:
+        if _default_ranker is None:
+            _default_ranker = LocationRanker(
+                HostHistory(IDENTIFIER_HOST_HISTORY))
+        return _default_ranker
@@ -1,19 +1,16 @@
 from __future__ import print_function
-import platform
-import webbrowser
 import sys
 
-from six.moves import input
-from globus_sdk import NativeAppAuthClient
-
 from identifiers_client.config import config
-from identifiers_client.local_server import (start_local_server,
-                                             LocalServerError)
+
+# The browser, local server and Globus Auth modules are imported by the
+# functions using them, as most commands never log in.
 
 
 def _login_client(config):
+    from identifiers_client.tokens import auth_client
     client_id = config.get('client', 'client_id')
-    return NativeAppAuthClient(client_id, app_name='identifier_client_dev')
+    return auth_client(client_id, 'identifier_client_dev')
 
 
 _SHARED_EPILOG = ("""\
@@ -42,29 +39,21 @@ You can log in again with
 
 
 def check_logged_in():
-    # first, pull up all of the data from config and see what we can get
-    # we can skip the access tokens and their expiration times as those are not
-    # strictly necessary
-    refresh_token = config.get('tokens', 'REFRESH_TOKEN')
-    access_token = config.get('tokens', 'ACCESS_TOKEN')
-    if not (refresh_token and access_token):
-        return False
-
-    # check that at least refresh token is valid
-    native_client = _login_client(config)
-    res = native_client.oauth2_validate_token(refresh_token)
-    if not res['active']:
-        return False
-
-    return True
+    # An unexpired access token is enough; otherwise check that the refresh
+    # token is valid, at most once per introspection interval
+    from identifiers_client.tokens import TokenState
+    return TokenState(config).is_logged_in(_login_client(config))
 
 
 def do_link_login_flow():
     """
     Prompts the user with a link to authorize the CLI to act on their behalf.
     """
+    import platform
+    from six.moves import input
+
     # get the NativeApp client object
-    native_client = _login_client()
+    native_client = _login_client(config)
 
     # start the Native App Grant flow, prefilling the
     # named grant label on the consent page if we can get a
@@ -93,6 +82,11 @@ def do_local_server_login_flow():
     Starts a local http server, opens a browser to have the user login,
     and gets the code redirected to the server (no copy and pasting required)
     """
+    import platform
+    import webbrowser
+    from identifiers_client.local_server import (start_local_server,
+                                                 LocalServerError)
+
     print(
         "You are running 'identifier login', which should automatically open "
         "a browser window for you to login.\n"
@@ -1,24 +1,74 @@
 from __future__ import print_function
+import os
 import sys
-import json
 import logging
+import threading
+from contextlib import contextmanager
 
-from identifiers_client.local_server import is_remote_session
-from identifiers_client.identifiers_api import (
-    identifiers_client, IdentifierClientError, IdentifierNotLoggedIn)
-from identifiers_client.config import config
-from identifiers_client.login import (
-    LOGGED_IN_RESPONSE, LOGGED_OUT_RESPONSE, check_logged_in,
-    do_link_login_flow, do_local_server_login_flow, revoke_tokens)
+from identifiers_client.config import (config, IDENTIFIER_AUDIT_FILE,
+                                      IDENTIFIER_CONFIG_FILE,
+                                      IDENTIFIER_HASH_CACHE)
 from identifiers_client.helpers import (subcommand, argument,
-                                        clear_internal_args)
-from argparse import ArgumentParser
+                                        clear_internal_args, open_input,
+                                        open_output, DeferredArgumentParser)
+from identifiers_client import daemon, defaults
+
+# Modules which bring in globus_sdk, requests or other slow imports are
+# imported by the subcommands which use them, so that starting the command
+# line, and commands passed to the session daemon, stay fast.
 
 log = logging.getLogger(__name__)
 
-cli = ArgumentParser()
+cli = DeferredArgumentParser()
+cli.add_argument(
+    '--profile',
+    action='store_true',
+    default=False,
+    help="After the subcommand, print a cProfile summary and a table of "
+    "its HTTP requests to standard error")
+cli.add_argument(
+    '--metrics-file',
+    help="Write request metrics to this file after the subcommand: JSON if "
+    "it ends in .json, otherwise the Prometheus text format")
+cli.add_argument(
+    '--output',
+    dest='output_format',
+    choices=('pretty', 'json', 'ndjson'),
+    help="How to print results: indented JSON ('pretty'), compact JSON "
+    "('json', with the results of batch commands in one array) or one "
+    "compact JSON document per line ('ndjson'). By default single results "
+    "are pretty and batch results ndjson. Also applies to the records "
+    "written by namespace-export --format ndjson")
 subparsers = cli.add_subparsers(dest="subcommand")
 
+_client_cache = {}
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the IdentifierClient used by subcommands. A single client is kept
+    per process so that the session daemon reuses its tokens and pooled
+    connections across commands.
+    """
+    with _client_lock:
+        if 'client' not in _client_cache:
+            from identifiers_client.identifiers_api import identifiers_client
+            _client_cache['client'] = identifiers_client(config)
+        return _client_cache['client']
+
+
+def reset_client():
+    with _client_lock:
+        _client_cache.pop('client', None)
+
+
+def _response(data):
+    # Wraps results which don't come from the service for printing
+    from globus_sdk.response import GlobusResponse
+    return GlobusResponse(data)
+
+
 _namespace_skin_props = [
     'header_background', 'header_icon_url', 'header_icon_link', 'header_text',
     'page_title', 'favicon_url', 'preamble_text'
@@ -44,6 +94,11 @@ _namespace_skin_props = [
           'the Identifiers client'),
 )
 def login(args):
+    from identifiers_client.local_server import is_remote_session
+    from identifiers_client.login import (
+        LOGGED_IN_RESPONSE, check_logged_in, do_link_login_flow,
+        do_local_server_login_flow)
+
     # if not forcing, stop if user already logged in
     if not args.force and check_logged_in():
         print(LOGGED_IN_RESPONSE)
@@ -59,10 +114,13 @@ def login(args):
 
 @subcommand([], parent=subparsers, help='Log out of Identifier client')
 def logout(args):
+    from identifiers_client.login import LOGGED_OUT_RESPONSE, revoke_tokens
+
     revoke_tokens(config)
     config.set('tokens', 'access_token', '')
     config.set('tokens', 'access_token_expires', '0')
     config.set('tokens', 'refresh_token', '')
+    config.remove_option('tokens', 'introspected_at')
     config.save()
     print(LOGGED_OUT_RESPONSE)
 
@@ -135,7 +193,7 @@ def namespace_create(args):
     """
     Create a new namespace
     """
-    client = identifiers_client(config)
+    client = get_client()
     args = clear_internal_args(vars(args))
     # Convenience helper: If user doesn't specify a member
     # group, just use the same group as for admins.
@@ -169,14 +227,20 @@ def namespace_create(args):
     argument(
         "--provider-config",
         help="Configuration for the provider used for "
-        "minting identfiers in JSON format")
+        "minting identfiers in JSON format"),
+    argument(
+        "--minimal",
+        action='store_true',
+        default=False,
+        help="Send only the properties which differ from the namespace's "
+        "current ones, and nothing at all if none do")
 ],
             parent=subparsers)
 def namespace_update(args):
     """
     Update the properties of an existing namespace
     """
-    client = identifiers_client(config)
+    client = get_client()
     args = clear_internal_args(vars(args))
 
     # Convenience helper: If user doesn't specify a member
@@ -200,7 +264,7 @@ def namespace_display(args):
     """
     Display a namespace
     """
-    client = identifiers_client(config)
+    client = get_client()
     return client.get_namespace(args.namespace_id)
 
 
@@ -215,10 +279,68 @@ def namespace_delete(args):
     """
     Remove an existing namespace
     """
-    client = identifiers_client(config)
+    client = get_client()
     return client.delete_namespace(args.namespace_id)
 
 
+@subcommand([
+    argument(
+        "--namespace-id",
+        help="The id for the namespace to export",
+        required=True),
+    argument(
+        "--output-file",
+        default='-',
+        help="File to write to, or - for standard output (the default)"),
+    argument(
+        "--format",
+        choices=('ndjson', 'csv'),
+        default='ndjson',
+        help="ndjson (the default) for one JSON record per line, or csv "
+        "for a column per record field. JSON records are written in the "
+        "format given by the global --output, if it is"),
+    argument(
+        "--page-size",
+        type=int,
+        default=defaults.EXPORT_PAGE_SIZE,
+        help="Number of identifiers to request at a time (default: {})".format(
+            defaults.EXPORT_PAGE_SIZE))
+],
+            parent=subparsers)
+def namespace_export(args):
+    """
+    Export every identifier in a namespace, as NDJSON or as CSV with the
+    columns identifier, namespace, location, checksums, metadata and
+    visible_to, either of which identifier-batch-create can read. Records
+    are written as they arrive, so memory use stays the same however large
+    the namespace.
+    """
+    from identifiers_client.batch import write_records
+    from identifiers_client.output import write_stream
+
+    if args.format == 'csv' and args.output_format not in (None, 'ndjson'):
+        raise ValueError('--output {} does not apply to --format csv'.format(
+            args.output_format))
+    client = get_client()
+    records = client.iter_identifiers(
+        args.namespace_id, page_size=args.page_size)
+    with open_output(args.output_file) as stream:
+        if args.format == 'ndjson' and args.output_format is not None:
+            exported = [0]
+
+            def _counted(records):
+                for record in records:
+                    exported[0] += 1
+                    yield record
+
+            write_stream(_counted(records), stream, args.output_format)
+            count = exported[0]
+        else:
+            count = write_records(records, stream, args.format)
+    if args.output_file != '-':
+        return _response({'namespace': args.namespace_id, 'exported': count})
+
+
 @subcommand([
     argument(
         "--namespace",
@@ -243,18 +365,199 @@ def namespace_delete(args):
         "--metadata",
         help='Additional metadata associated with the '
         'identifier in JSON format '
-        '(e.g. \'{"author": "John Doe", "year": 2018}\')')
+        '(e.g. \'{"author": "John Doe", "year": 2018}\')'),
+    argument(
+        "--file",
+        help="A local copy of the data. Its sha256, md5 and sha512 "
+        "checksums are added to --checksums and its size to the metadata "
+        "as contentSize"),
+    argument(
+        "--dedupe",
+        action='store_true',
+        default=False,
+        help="If an identifier in the namespace was already minted here "
+        "for data with the same sha256 checksum, print it instead of "
+        "creating another (needs an [index] section in the configuration)"),
+    argument(
+        "--write-behind",
+        action='store_true',
+        default=False,
+        help="Add the create to the local journal and print its ticket at "
+        "once, leaving it to be sent by the session daemon or by journal "
+        "flush")
 ],
             parent=subparsers)
 def identifier_create(args):
     """
     Create a new identifier
     """
-    client = identifiers_client(config)
     args = clear_internal_args(vars(args))
+    path = args.pop('file', None)
+    if path is not None:
+        args = _add_file_checksums(args, path)
+    if args.pop('write_behind'):
+        return _journal_append('create_identifier', args)
+    client = get_client()
     return client.create_identifier(**args)
 
 
+def _add_file_checksums(args, path):
+    """
+    Add the checksums and size of the file at path to the checksums and
+    metadata in args, keeping any values given explicitly.
+    """
+    from identifiers_client.checksums import compute_checksums
+    from identifiers_client.identifiers_api import _json_parse_args
+
+    args = _json_parse_args(args, ['checksums', 'metadata'])
+    computed = compute_checksums(path)
+    checksums = list(args.get('checksums') or [])
+    given = set(c.get('function') for c in checksums)
+    checksums.extend(c for c in computed.as_identifier_checksums()
+                     if c['function'] not in given)
+    args['checksums'] = checksums
+    metadata = dict(args.get('metadata') or {})
+    metadata.setdefault('contentSize', computed.size)
+    args['metadata'] = metadata
+    return args
+
+
+@subcommand([
+    argument(
+        "--root",
+        required=True,
+        help="Directory to hash every file under"),
+    argument(
+        "--algorithms",
+        help="Comma separated checksum algorithms to compute, each file "
+        "being read once for all of them (default: sha256,md5,sha512)"),
+    argument(
+        "--processes",
+        type=int,
+        help="Worker processes hashing files (default: one per CPU)"),
+    argument(
+        "--cache",
+        default=IDENTIFIER_HASH_CACHE,
+        help="Database of checksums already computed, by file path, size "
+        "and modification time; unchanged files are not read again "
+        "(default: {})".format(IDENTIFIER_HASH_CACHE)),
+    argument(
+        "--no-cache",
+        action='store_true',
+        default=False,
+        help="Hash every file, neither using nor updating the cache"),
+    argument(
+        "--base-url",
+        help="URL under which the directory is published, giving each "
+        "record a location")
+],
+            parent=subparsers)
+def identifier_hash_tree(args):
+    """
+    Compute the checksums of every file under a directory, largest files
+    first across a pool of processes, and print a record for each, one JSON
+    object per line, with its checksums and its path and size as metadata,
+    ready for identifier-batch-create. Records are printed as files finish,
+    not in any fixed order.
+    """
+    import hashlib
+    from identifiers_client import checksums, hashtree
+
+    algorithms = checksums.DEFAULT_ALGORITHMS
+    if args.algorithms:
+        algorithms = tuple(a.strip().lower()
+                           for a in args.algorithms.split(',') if a.strip())
+        unknown = [a for a in algorithms
+                   if a not in hashlib.algorithms_available]
+        if unknown or not algorithms:
+            raise ValueError('Unknown checksum algorithms: {}'.format(
+                ', '.join(unknown) or args.algorithms))
+    if not os.path.isdir(args.root):
+        raise ValueError('{} is not a directory'.format(args.root))
+
+    def _results():
+        cache = None if args.no_cache else hashtree.HashCache(args.cache)
+        try:
+            for entry in hashtree.hash_tree(
+                    args.root, algorithms, processes=args.processes,
+                    cache=cache):
+                yield hashtree.entry_record(entry, args.base_url)
+        finally:
+            if cache is not None:
+                cache.close()
+
+    return _results()
+
+
+@subcommand([
+    argument(
+        "--input",
+        default='-',
+        help="File of records to create, or - to read standard input "
+        "(the default)"),
+    argument(
+        "--format",
+        choices=('ndjson', 'csv'),
+        help="Format of the input records. Guessed from the input when "
+        "not given"),
+    argument(
+        "--namespace",
+        help="The id for the namespace used for records which do not "
+        "name one"),
+    argument(
+        "--visible-to",
+        help='JSON List of users allowed to view identifiers for records '
+        'which do not give one (e.g. \'["public"]\')'),
+    argument(
+        "--concurrency",
+        type=int,
+        default=defaults.BATCH_CONCURRENCY,
+        help="Most identifiers to create at once, fewer while the service "
+        "is busy (default: {})".format(
+            defaults.BATCH_CONCURRENCY)),
+    argument(
+        "--dedupe",
+        action='store_true',
+        default=False,
+        help="For records whose sha256 checksum matches an identifier "
+        "already minted here in the same namespace, report that identifier "
+        "instead of creating another (needs an [index] section in the "
+        "configuration)")
+],
+            parent=subparsers)
+def identifier_batch_create(args):
+    """
+    Create many identifiers from a file of records, one per line as NDJSON
+    or one per row as CSV with a header of namespace, location, checksums,
+    metadata and visible_to. Results are printed one JSON object per line
+    in input order; a failed record is reported without stopping the run.
+    """
+    from identifiers_client.batch import read_records
+
+    client = get_client()
+    record_defaults = dict(
+        (k, v) for k, v in (('namespace', args.namespace),
+                            ('visible_to', args.visible_to))
+        if v is not None)
+
+    def _records(stream):
+        for record in read_records(stream, args.format):
+            if isinstance(record, dict):
+                for k, v in record_defaults.items():
+                    record.setdefault(k, v)
+            yield record
+
+    def _results():
+        with open_input(args.input) as stream:
+            results = client.create_identifiers(
+                _records(stream), concurrency=args.concurrency,
+                dedupe=args.dedupe)
+            for result in results:
+                yield _batch_result_data(result)
+
+    return _results()
+
+
 @subcommand([
     argument(
         "--identifier",
@@ -271,55 +574,749 @@ def identifier_create(args):
     argument(
         "--metadata",
         help="Additional metadata associated with the "
-        "identifier in JSON format")
+        "identifier in JSON format"),
+    argument(
+        "--write-behind",
+        action='store_true',
+        default=False,
+        help="Add the update to the local journal and print its ticket at "
+        "once, leaving it to be sent by the session daemon or by journal "
+        "flush. Updates to the same identifier waiting in the journal are "
+        "sent as one"),
+    argument(
+        "--minimal",
+        action='store_true',
+        default=False,
+        help="Send only the properties which differ from the identifier's "
+        "current ones, and nothing at all if none do")
 ],
             parent=subparsers)
 def identifier_update(args):
     """
     Update the state of an identifier
     """
-    client = identifiers_client(config)
     identifier_id = args.identifier
     args = clear_internal_args(vars(args))
+    if args.pop('write_behind'):
+        return _journal_append('update_identifier', args, identifier_id)
+    client = get_client()
 
     return client.update_identifier(identifier_id, **args)
 
 
+def _journal_append(method, args, *positional):
+    """
+    Journal a create or update (the Journal method named method) for
+    sending later, returning its ticket. Inside the session daemon the
+    journal's flusher is started, if it isn't running, to send it.
+    """
+    from identifiers_client.identifiers_api import (_identifier_json_props,
+                                                    _json_parse_args)
+
+    # Reject malformed JSON now rather than when the journal is flushed
+    args = _json_parse_args(args, _identifier_json_props)
+    ticket = getattr(_get_journal(), method)(*positional, **args)
+    if daemon.serving:
+        start_journal_flusher()
+    return _response({'ticket': ticket, 'state': 'pending'})
+
+
+_journal_cache = {}
+
+
+def _get_journal():
+    from identifiers_client.journal import Journal
+
+    with _client_lock:
+        if 'journal' not in _journal_cache:
+            _journal_cache['journal'] = Journal.from_config(config)
+        return _journal_cache['journal']
+
+
+def start_journal_flusher():
+    """
+    Start sending the operations in the write-behind journal on a
+    background thread, if that isn't already happening in this process.
+    """
+    from identifiers_client.journal import JournalFlusher
+
+    journal = _get_journal()
+    with _client_lock:
+        if 'flusher' not in _journal_cache:
+            _journal_cache['flusher'] = JournalFlusher(journal, get_client)
+        flusher = _journal_cache['flusher']
+    flusher.start()
+
+
+@subcommand([
+    argument(
+        "--input",
+        help="File of identifiers to update, or - to read standard input: "
+        "NDJSON or CSV records naming an identifier and its new location, "
+        "checksums, metadata or visible_to, or one identifier per line "
+        "with --old-prefix"),
+    argument(
+        "--format",
+        choices=('ndjson', 'csv', 'ids'),
+        help="Format of the input. Guessed from the input when not given"),
+    argument(
+        "--namespace-id",
+        help="Update the identifiers in this namespace with a location "
+        "starting with --old-prefix, instead of reading --input"),
+    argument(
+        "--old-prefix",
+        help="Location URL prefix to replace with --new-prefix"),
+    argument(
+        "--new-prefix",
+        help="Location URL prefix which replaces --old-prefix"),
+    argument(
+        "--dry-run",
+        action='store_true',
+        default=False,
+        help="Report the changes which would be made without making them"),
+    argument(
+        "--checkpoint",
+        help="File recording the identifiers already updated. Running the "
+        "same command again with it skips them, resuming an interrupted "
+        "update"),
+    argument(
+        "--minimal",
+        action='store_true',
+        default=False,
+        help="Send only the properties which differ from each identifier's "
+        "current ones, and skip identifiers with none"),
+    argument(
+        "--baseline",
+        help="Export of the identifiers' current state (as written by "
+        "namespace-export) to compare with for --minimal, instead of "
+        "getting each identifier. Implies --minimal"),
+    argument(
+        "--concurrency",
+        type=int,
+        default=defaults.BATCH_CONCURRENCY,
+        help="Most identifiers to update at once, fewer while the service "
+        "is busy (default: {})".format(
+            defaults.BATCH_CONCURRENCY))
+],
+            parent=subparsers)
+def identifier_batch_update(args):
+    """
+    Update many identifiers, either setting the properties given for each
+    in the input, or rewriting the prefix of their locations (for example
+    when data moves to a new server). Results are printed one JSON object
+    per line in input order, with the changes made or, with --dry-run,
+    planned.
+    """
+    from identifiers_client.batch import _export_fields, read_records
+    from identifiers_client import migrate
+
+    if (args.input is None) == (args.namespace_id is None):
+        raise ValueError('Give one of --input or --namespace-id')
+    if (args.old_prefix is None) != (args.new_prefix is None):
+        raise ValueError('--old-prefix and --new-prefix go together')
+    rewrite = None
+    if args.old_prefix is not None:
+        rewrite = migrate.LocationRewrite(args.old_prefix, args.new_prefix)
+    elif args.namespace_id is not None:
+        raise ValueError('--namespace-id needs --old-prefix and --new-prefix')
+    baseline = None
+    if args.baseline is not None:
+        with open_input(args.baseline) as stream:
+            baseline = migrate.Baseline(
+                read_records(stream, fields=_export_fields))
+    minimal = args.minimal or baseline is not None
+    client = get_client()
+
+    def _results():
+        with _optional_checkpoint(args.checkpoint) as cp:
+            if args.namespace_id is not None:
+                records = migrate.select(
+                    client.iter_identifiers(args.namespace_id), rewrite)
+                for result in migrate.update_identifiers(
+                        client, records, rewrite, args.dry_run, cp,
+                        args.concurrency, minimal, baseline):
+                    yield _update_result_data(result)
+            else:
+                with open_input(args.input) as stream:
+                    records = read_records(stream, args.format,
+                                           fields=_export_fields)
+                    for result in migrate.update_identifiers(
+                            client, records, rewrite, args.dry_run, cp,
+                            args.concurrency, minimal, baseline):
+                        yield _update_result_data(result)
+
+    return _results()
+
+
+@contextmanager
+def _optional_checkpoint(path):
+    from identifiers_client.migrate import Checkpoint
+
+    if path is None:
+        yield None
+    else:
+        with Checkpoint(path) as checkpoint:
+            yield checkpoint
+
+
+@subcommand([
+    argument(
+        "--bag",
+        required=True,
+        help="Directory of the bag, e.g. after bdbag --resolve-fetch and "
+        "bdbag --validate full"),
+    argument(
+        "--namespace",
+        required=True,
+        help="The id for the namespace in which to add the identifiers"),
+    argument(
+        "--visible-to",
+        required=True,
+        help='JSON List of users allowed to view the identifiers '
+        '(e.g. \'["public"]\')'),
+    argument(
+        "--base-url",
+        help="URL under which the bag's payload is published, giving the "
+        "location of files which fetch.txt does not list"),
+    argument(
+        "--dedupe",
+        action='store_true',
+        default=False,
+        help="For files whose sha256 checksum matches an identifier already "
+        "minted here in the same namespace, use that identifier instead of "
+        "creating another (needs an [index] section in the configuration)"),
+    argument(
+        "--concurrency",
+        type=int,
+        default=defaults.BATCH_CONCURRENCY,
+        help="Most identifiers to create at once, fewer while the service "
+        "is busy (default: {})".format(
+            defaults.BATCH_CONCURRENCY))
+],
+            parent=subparsers)
+def identifier_mint_bag(args):
+    """
+    Mint an identifier for every file of a BDBag, using the checksums in
+    its manifests and the sizes and remote locations in its fetch.txt
+    rather than hashing the files again. The identifiers are written to
+    metadata/identifiers.txt in the bag (and its tag manifests updated) as
+    they are minted, and files already listed there are skipped, so an
+    interrupted run can be repeated. Results are printed one JSON object
+    per line in manifest order.
+    """
+    from identifiers_client import bag
+
+    client = get_client()
+
+    def _results():
+        for result in bag.mint_bag(
+                client, args.bag, args.namespace, args.visible_to,
+                base_url=args.base_url, concurrency=args.concurrency,
+                dedupe=args.dedupe):
+            data = {
+                'index': result.index,
+                'path': result.path,
+                'identifier': result.identifier,
+                'status': result.status
+            }
+            if result.error is not None:
+                data['error'] = _error_data(result.error)
+            yield data
+
+    return _results()
+
+
 @subcommand([
+    argument("--identifier", help="The id for identifier to display"),
     argument(
-        "--identifier", help="The id for identifier to display", required=True)
+        "--input",
+        help="File of identifiers to display, one per line (or NDJSON or "
+        "CSV records with an identifier), or - to read standard input"),
+    argument(
+        "--concurrency",
+        type=int,
+        default=defaults.BATCH_CONCURRENCY,
+        help="Most identifiers to fetch at once with --input, fewer while "
+        "the service is busy (default: {})".format(
+            defaults.BATCH_CONCURRENCY))
 ],
             parent=subparsers)
 def identifier_display(args):
     """
-    Display the state of an identifier
+    Display the state of an identifier, or with --input of many
+    identifiers, fetched concurrently. Each distinct identifier is printed
+    as one JSON object per line as it arrives, with its index in the input;
+    one which can't be fetched is reported there without stopping the run.
     """
-    client = identifiers_client(config)
-    return client.get_identifier(args.identifier)
+    if (args.identifier is None) == (args.input is None):
+        raise ValueError('Give one of --identifier or --input')
+    client = get_client()
+    if args.identifier is not None:
+        return client.get_identifier(args.identifier)
 
+    from identifiers_client.batch import read_records
 
-def main():
-    args = cli.parse_args()
+    def _ids(records):
+        for record in records:
+            if isinstance(record, dict):
+                record = record.get('identifier') or ValueError(
+                    'Record has no identifier')
+            yield record
+
+    def _results():
+        with open_input(args.input) as stream:
+            results = client.get_identifiers(
+                _ids(read_records(stream, fields=['identifier'])),
+                concurrency=args.concurrency)
+            for result in results:
+                data = _batch_result_data(result)
+                if not isinstance(result.record, Exception):
+                    data['identifier'] = result.record
+                yield data
+
+    return _results()
+
+
+@subcommand([
+    argument(
+        "--identifier",
+        help="The DOI, ARK, minid or dataguid (dg.*) to resolve",
+        required=True),
+    argument(
+        "--hedge-after",
+        type=float,
+        default=defaults.RESOLVER_HEDGE_AFTER,
+        help="Seconds to wait for a resolver before also asking the next "
+        "one for the scheme (default: {})".format(
+            defaults.RESOLVER_HEDGE_AFTER)),
+    argument(
+        "--race",
+        action='store_true',
+        default=False,
+        help="Ask all resolvers for the scheme at once"),
+    argument(
+        "--timeout",
+        type=float,
+        default=defaults.RESOLVER_TIMEOUT,
+        help="Seconds to wait for an answer (default: {})".format(
+            defaults.RESOLVER_TIMEOUT))
+],
+            parent=subparsers)
+def identifier_resolve(args):
+    """
+    Resolve an identifier through the global resolvers for its scheme and
+    display its schema.org metadata
+    """
+    from identifiers_client import resolver
+
+    resolved = resolver.resolve(
+        args.identifier,
+        hedge_after=args.hedge_after,
+        race=args.race,
+        timeout=args.timeout)
+    return _response(resolved._asdict())
+
+
+@subcommand([
+    argument(
+        "--identifier", help="The id for identifier to fetch", required=True),
+    argument(
+        "--resolve",
+        action='store_true',
+        default=False,
+        help="Find the locations and checksums from the metadata given by "
+        "the global resolvers rather than the Identifiers service"),
+    argument(
+        "--output-file",
+        help="File to write the data to (default: the file name from the "
+        "location URL)"),
+    argument(
+        "--connections",
+        type=int,
+        default=defaults.DOWNLOAD_CONNECTIONS,
+        help="Number of concurrent range requests (default: {})".format(
+            defaults.DOWNLOAD_CONNECTIONS)),
+    argument(
+        "--no-rank",
+        action='store_true',
+        default=False,
+        help="Try the identifier's locations in the order given, rather "
+        "than the fastest expected first")
+],
+            parent=subparsers)
+def identifier_fetch(args):
+    """
+    Download the data referred to by an identifier, verifying it against the
+    identifier's checksums as it arrives. Of several locations, the one
+    expected to be fastest is tried first. An interrupted download resumes
+    when run again.
+    """
+    from identifiers_client import download, locations, metadata
+
+    record = _location_record(args)
+    urls, checksums = download.checksums_from_record(record)
+    result = download.fetch(
+        urls,
+        dest=args.output_file,
+        checksums=checksums,
+        ranker=None if args.no_rank else locations.get_ranker(),
+        size=metadata.normalize(record).size,
+        connections=args.connections)
+    return _response(result._asdict())
+
+
+def _location_record(args):
+    from identifiers_client import resolver
+
+    if args.resolve:
+        return resolver.resolve(args.identifier).metadata
+    return get_client().get_identifier(args.identifier).data
+
+
+@subcommand([
+    argument(
+        "--identifier",
+        help="The id for identifier whose locations to rank",
+        required=True),
+    argument(
+        "--resolve",
+        action='store_true',
+        default=False,
+        help="Find the locations from the metadata given by the global "
+        "resolvers rather than the Identifiers service")
+],
+            parent=subparsers)
+def identifier_locations(args):
+    """
+    Display an identifier's locations, fastest expected first, with the
+    latency (seconds), throughput (bytes a second) and failure rate seen
+    from each location's host and the expected seconds to download the
+    data. Hosts not seen recently are probed first.
+    """
+    from identifiers_client import locations, metadata
+
+    normalized = metadata.normalize(_location_record(args))
+    ranked = locations.get_ranker().rank(normalized.content_urls,
+                                         normalized.size)
+    return _response({
+        'identifier': args.identifier,
+        'size': normalized.size,
+        'locations': [location._asdict() for location in ranked]
+    })
+
+
+@subcommand([
+    argument(
+        "--input",
+        help="File of identifiers to audit, or - to read standard input: "
+        "one identifier per line, or NDJSON or CSV records such as those "
+        "written by namespace-export, whose locations and checksums are "
+        "used as given"),
+    argument(
+        "--format",
+        choices=('ndjson', 'csv', 'ids'),
+        help="Format of the input. Guessed from the input when not given"),
+    argument(
+        "--namespace-id",
+        help="Audit the identifiers in this namespace, instead of reading "
+        "--input"),
+    argument(
+        "--store",
+        default=IDENTIFIER_AUDIT_FILE,
+        help="Database of audit results and runs, which lets an "
+        "interrupted audit resume (default: {})".format(IDENTIFIER_AUDIT_FILE)),
+    argument(
+        "--sample",
+        type=float,
+        default=100,
+        help="Percentage of the identifiers to audit. Each run audits the "
+        "next sample after the last, so that e.g. 15 audits every "
+        "identifier in seven runs (default: 100)"),
+    argument(
+        "--bandwidth",
+        type=float,
+        help="Most megabytes a second to read from all locations together "
+        "(default: no limit)"),
+    argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for a location to respond (default: 60)"),
+    argument(
+        "--summary",
+        action='store_true',
+        default=False,
+        help="Display the latest result counts and run from the store, "
+        "instead of auditing"),
+    argument(
+        "--concurrency",
+        type=int,
+        default=defaults.BATCH_CONCURRENCY,
+        help="Most identifiers to audit at once (default: {})".format(
+            defaults.BATCH_CONCURRENCY))
+],
+            parent=subparsers)
+def identifier_audit(args):
+    """
+    Check that the data at each location of many identifiers still matches
+    their checksums, reading every location as a stream and hashing it as it
+    arrives without saving it. Results (pass, fail, unreachable,
+    unverifiable or error) are saved to the store and printed one JSON
+    object per line in input order. Running the same command again resumes
+    an interrupted audit.
+    """
+    from identifiers_client import audit
+    from identifiers_client.batch import _export_fields, read_records
+
+    if args.summary:
+        with audit.AuditStore(args.store) as store:
+            return _response(store.summary())
+    if (args.input is None) == (args.namespace_id is None):
+        raise ValueError('Give one of --input or --namespace-id')
+    if args.bandwidth is not None and args.bandwidth <= 0:
+        raise ValueError('--bandwidth must be positive')
+    bandwidth = args.bandwidth and args.bandwidth * 1000 * 1000
+    client = get_client()
+
+    def _results():
+        with audit.AuditStore(args.store) as store:
+            if args.namespace_id is not None:
+                records = client.iter_identifiers(args.namespace_id)
+                for result in audit.audit(
+                        client, records, store, args.sample,
+                        args.concurrency, bandwidth, args.timeout):
+                    yield _audit_result_data(result)
+            else:
+                with open_input(args.input) as stream:
+                    records = read_records(stream, args.format,
+                                           fields=_export_fields)
+                    for result in audit.audit(
+                            client, records, store, args.sample,
+                            args.concurrency, bandwidth, args.timeout):
+                        yield _audit_result_data(result)
+
+    return _results()
+
+
+def _audit_result_data(result):
+    data = {
+        'index': result.index,
+        'identifier': result.identifier,
+        'status': result.status
+    }
+    if result.error is not None:
+        data['error'] = _error_data(result.error)
+    if result.locations:
+        data['locations'] = [
+            dict((key, value) for key, value in loc._asdict().items()
+                 if value is not None) for loc in result.locations
+        ]
+    return data
+
+
+@subcommand([], parent=subparsers)
+def cache_stats(args):
+    """
+    Display hit and miss counts and sizes for the response cache configured
+    in the [cache] section of the config file. Counts cover the current
+    process, or the session daemon's lifetime when it is running.
+    """
+    client = get_client()
+    if client.cache is None:
+        raise ValueError('No [cache] section in {}'.format(
+            IDENTIFIER_CONFIG_FILE))
+    return _response(client.cache.summary())
+
+
+@subcommand([
+    argument(
+        "action",
+        choices=('status', 'flush'),
+        help="Show the state of the write-behind journal, or send the "
+        "operations waiting in it"),
+    argument(
+        "--ticket",
+        type=int,
+        help="With status, show this operation and the response to it"),
+    argument(
+        "--timeout",
+        type=float,
+        help="With flush, give up after this many seconds, leaving "
+        "operations still waiting to be retried in the journal")
+],
+            parent=subparsers,
+            name='journal')
+def journal_command(args):
+    """
+    Manage the journal of creates and updates made with --write-behind.
+    The session daemon sends them in the background while it runs; flush
+    sends them now, retrying failures, and waits until none are left.
+    """
+    journal = _get_journal()
+    if args.action == 'status':
+        if args.ticket is None:
+            return _response(journal.summary())
+        entry = journal.get(args.ticket)
+        if entry is None:
+            raise ValueError('No journal ticket {}'.format(args.ticket))
+        return _response(entry)
+    from identifiers_client.journal import JournalFlusher
+
+    flusher = JournalFlusher(journal, get_client)
+    flusher.flush(args.timeout)
+    return _response(journal.summary())
+
+
+@subcommand([
+    argument(
+        "action",
+        choices=('start', 'stop', 'status'),
+        help="Start, stop or check on the session daemon"),
+    argument(
+        "--idle-timeout",
+        type=int,
+        default=daemon.DEFAULT_IDLE_TIMEOUT,
+        help="Seconds without a request after which a started daemon "
+        "exits (default: {})".format(daemon.DEFAULT_IDLE_TIMEOUT))
+],
+            parent=subparsers,
+            name='daemon')
+def daemon_command(args):
+    """
+    Manage a background daemon which keeps a logged in client and its
+    connections open. While it runs, API subcommands are passed to it
+    rather than each setting up a new client.
+    """
+    if args.action == 'start':
+        daemon.start(args.idle_timeout)
+    elif args.action == 'stop':
+        daemon.stop()
+    else:
+        daemon.status()
+
+
+def _error_data(error):
+    from identifiers_client.identifiers_api import IdentifierClientError
+    err = {'message': str(error)}
+    if isinstance(error, IdentifierClientError):
+        err['http_status'] = error.http_status
+        err['message'] = error.message
+    return err
+
+
+def _batch_result_data(result):
+    if result.error is None:
+        return {'index': result.index, 'result': result.response.data}
+    return {'index': result.index, 'error': _error_data(result.error)}
+
+
+def _update_result_data(result):
+    data = {
+        'index': result.index,
+        'identifier': result.identifier,
+        'status': result.status
+    }
+    if result.error is not None:
+        data['error'] = _error_data(result.error)
+    if result.changes:
+        data['changes'] = result.changes
+    if result.previous:
+        data['previous'] = result.previous
+    return data
+
+
+def _print_result(ret, out, fmt=None):
+    from identifiers_client import output
+    if hasattr(ret, 'data'):
+        output.write_result(ret.data, out, fmt or 'pretty')
+    else:
+        # Batch commands return an iterator of results which are printed
+        # as they become available
+        output.write_stream(ret, out, fmt or 'ndjson')
+
+
+def run(argv=None, out=None, err=None):
+    """
+    Run the command line given by argv, writing its output to the out and
+    err streams (by default stdout and stderr).
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+    args = cli.parse_args(argv)
+    if args.subcommand is None:
+        cli.print_help(file=out)
+    elif args.profile or args.metrics_file:
+        _run_instrumented(args, out, err)
+    else:
+        _run_subcommand(args, out, err)
+
+
+def _run_instrumented(args, out, err):
+    import cProfile
+    import pstats
+    from identifiers_client import metrics
+
+    hooks = [metrics.Metrics(), metrics.RequestLog()]
+    for hook in hooks:
+        metrics.add_hook(hook)
+    profile = cProfile.Profile() if args.profile else None
+    try:
+        if profile is not None:
+            profile.runcall(_run_subcommand, args, out, err)
+        else:
+            _run_subcommand(args, out, err)
+    finally:
+        for hook in hooks:
+            metrics.remove_hook(hook)
+        if args.metrics_file:
+            hooks[0].write(args.metrics_file)
+        if profile is not None:
+            stats = pstats.Stats(profile, stream=err)
+            stats.sort_stats('cumulative').print_stats(25)
+            print('HTTP requests:', file=err)
+            print(hooks[1].table(), file=err)
+
+
+def _run_subcommand(args, out, err):
     subcommand = args.subcommand
-    if subcommand is None:
-        cli.print_help()
+    try:
+        ret = args.func(args)
+        # These don't make API calls, and commands which write their results
+        # elsewhere return None:
+        if (subcommand not in ('login', 'logout', 'daemon')
+                and ret is not None):
+            _print_result(ret, out, args.output_format)
+    except ValueError as ve:
+        print(ve, file=out)
+    except Exception as e:
+        _report_client_error(e, subcommand, err)
+
+
+def _report_client_error(error, subcommand, err):
+    """
+    Print an error from the Identifiers client, or re-raise the error being
+    handled if it is something else.
+    """
+    # Only subcommands which have imported the client can raise its errors
+    from identifiers_client.identifiers_api import (IdentifierClientError,
+                                                    IdentifierNotLoggedIn)
+    if isinstance(error, IdentifierNotLoggedIn):
+        log.info(error)
+        msg = "Not logged in. Use:\n  identifier login\nto log in."
+        print(msg, file=err)
+    elif isinstance(error, IdentifierClientError):
+        print(
+            'Command {} failed with HTTP Status code {}, details:\n{}'.format(
+                subcommand, error.http_status, error.message),
+            file=err)
     else:
-        try:
-            ret = args.func(args)
-            # These two don't make API calls:
-            if subcommand not in ('login', 'logout'):
-                print(json.dumps(ret.data, indent=2))
-        except IdentifierNotLoggedIn as err:
-            log.info(err)
-            msg = "Not logged in. Use:\n  identifier login\nto log in."
-            print(msg, file=sys.stderr)
-        except IdentifierClientError as nce:
-            print(
-                'Command {} failed with HTTP Status code {}, details:\n{}'.
-                format(subcommand, nce.http_status, nce.message),
-                file=sys.stderr)
-        except ValueError as ve:
-            print(ve)
+        raise
+
+
+def main():
+    argv = sys.argv[1:]
+    if not daemon.forward(argv):
+        run(argv)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,345 @@
+import hashlib
+import json
+import logging
+import re
+from collections import namedtuple
+
+from identifiers_client.output import orjson
+from identifiers_client.resolver import parse_identifier
+
+log = logging.getLogger(__name__)
+
+# The shapes of metadata document understood, by the name given as
+# MetadataRecord.source
+DATACITE = 'datacite'
+SCHEMA_ORG = 'schema.org'
+IDENTIFIERS = 'identifiers'
+INDEXD = 'indexd'
+SOURCES = (DATACITE, SCHEMA_ORG, IDENTIFIERS, INDEXD)
+
+# Identifier property names (schema.org propertyID, DataCite
+# identifierType) naming an identifier scheme rather than a checksum
+_scheme_names = {
+    'doi': 'doi',
+    'ark': 'ark',
+    'minid': 'minid',
+    'dataguid': 'dg',
+    'dg': 'dg',
+}
+
+_size_pattern = re.compile(r'^\s*(\d+)\s*(b|bytes?)?\s*$', re.I)
+
+
+class MetadataError(ValueError):
+    pass
+
+
+class MetadataRecord(namedtuple('MetadataRecord', [
+        'identifier', 'scheme', 'source', 'name', 'size', 'checksums',
+        'content_urls', 'authors'
+])):
+    """
+    The properties common to the metadata of every identifier scheme, in a
+    compact form for holding many records in memory: the ``identifier``
+    and its ``scheme`` ('doi', 'ark', 'minid', 'dg' or None if it is not
+    known), the ``source`` shape it was converted from (one of SOURCES),
+    the ``name`` and ``size`` (bytes) of the data, its ``checksums`` as a
+    tuple of ``(algorithm, hex digest)`` pairs, named as in hashlib and
+    sorted, and tuples of ``content_urls`` and ``authors``' names. Missing
+    properties are None or empty.
+    """
+
+    __slots__ = ()
+
+    def checksum(self, algorithm):
+        """The hex digest for algorithm, or None."""
+        for name, value in self.checksums:
+            if name == algorithm:
+                return value
+        return None
+
+    def checksums_dict(self):
+        return dict(self.checksums)
+
+    def as_identifier_record(self):
+        """The record in the form taken by ``create_identifier``."""
+        record = {
+            'location': list(self.content_urls),
+            'checksums': [{
+                'function': name,
+                'value': value
+            } for name, value in self.checksums],
+            'metadata': {}
+        }
+        for key, value in (('name', self.name), ('contentSize', self.size),
+                           ('author', list(self.authors))):
+            if value:
+                record['metadata'][key] = value
+        return record
+
+
+def _no_intern(value):
+    return value
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _size(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        match = _size_pattern.match(value)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _algorithm(name):
+    """The hashlib name for a checksum function name, or None."""
+    if not isinstance(name, str):
+        return None
+    name = name.lower().replace('-', '')
+    return name if name in hashlib.algorithms_available else None
+
+
+def _checksums(pairs, intern):
+    found = {}
+    for name, value in pairs:
+        algorithm = _algorithm(name)
+        if algorithm and value and isinstance(value, str):
+            found[intern(algorithm)] = value
+    return tuple(sorted(found.items()))
+
+
+def split_identifier(value):
+    """
+    Return ``(scheme, identifier)`` for an identifier, or a resolver URL
+    containing one, with the identifier as ``resolver.parse_identifier``
+    gives it; the scheme is None if it is not recognized.
+    """
+    if not isinstance(value, str) or not value:
+        return None, None
+    try:
+        return parse_identifier(value)
+    except ValueError:
+        pass
+    # A resolver URL such as https://n2t.net/ark:/57799/b91... or
+    # https://dataguids.org/index/dg.4503/33ce...
+    lowered = value.lower()
+    for marker in ('ark:', 'minid:', 'dg.'):
+        start = lowered.find(marker)
+        if start > 0 and lowered[start - 1] == '/':
+            try:
+                return parse_identifier(value[start:])
+            except ValueError:
+                break
+    return None, value
+
+
+def _person(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        name = value.get('name')
+        if not name:
+            name = ' '.join(
+                v for v in (value.get('givenName'), value.get('familyName'))
+                if v)
+        return name or None
+    return None
+
+
+def _authors(values, intern):
+    names = (_person(v) for v in _as_list(values))
+    return tuple(intern(name) for name in names if name)
+
+
+def _record(identifier, source, name, size, checksums, content_urls,
+            authors, intern, scheme=None):
+    if scheme is None:
+        scheme, identifier = split_identifier(identifier)
+    return MetadataRecord(
+        identifier, scheme and intern(scheme), source, name, _size(size),
+        checksums, tuple(u for u in _as_list(content_urls) if u), authors)
+
+
+def from_schema_org(doc, intern=_no_intern):
+    """Convert a schema.org JSON-LD Dataset, as returned by resolvers."""
+    identifier = scheme = None
+    pairs = []
+    for ident in _as_list(doc.get('identifier')):
+        if isinstance(ident, dict):
+            property_id = (ident.get('propertyID') or '').lower()
+            value = ident.get('value')
+            if property_id in _scheme_names:
+                if identifier is None and value:
+                    scheme, identifier = split_identifier(value)
+                    scheme = scheme or _scheme_names[property_id]
+            else:
+                pairs.append((property_id, value))
+        elif identifier is None and ident:
+            scheme, identifier = split_identifier(ident)
+            if scheme is None:
+                identifier = None
+    if doc.get('@id'):
+        # The document's own id is the identifier resolved, if it names one
+        id_scheme, id_value = split_identifier(doc['@id'])
+        if id_scheme is not None:
+            scheme, identifier = id_scheme, id_value
+        elif identifier is None:
+            identifier = doc['@id']
+    return _record(identifier, SCHEMA_ORG, doc.get('name'),
+                   doc.get('contentSize'), _checksums(pairs, intern),
+                   doc.get('contentUrl'),
+                   _authors(doc.get('author') or doc.get('creator'), intern),
+                   intern, scheme=scheme or None)
+
+
+def from_datacite(doc, intern=_no_intern):
+    """
+    Convert DataCite JSON: either the ``application/vnd.datacite.datacite+
+    json`` representation or a response of the DataCite REST API (whose
+    ``data.attributes`` hold the same properties).
+    """
+    if isinstance(doc.get('data'), dict):
+        doc = dict(doc['data'].get('attributes') or {},
+                   id=doc['data'].get('id'))
+    identifier = doc.get('doi') or doc.get('id')
+    pairs = []
+    for ident in _as_list(doc.get('identifiers')) + _as_list(
+            doc.get('alternateIdentifiers')):
+        if not isinstance(ident, dict):
+            continue
+        kind = (ident.get('identifierType')
+                or ident.get('alternateIdentifierType') or '')
+        value = ident.get('identifier') or ident.get('alternateIdentifier')
+        if kind.lower() == 'doi' and not identifier:
+            identifier = value
+        else:
+            pairs.append((kind, value))
+    name = None
+    for title in _as_list(doc.get('titles')):
+        name = title.get('title') if isinstance(title, dict) else title
+        if name:
+            break
+    size = None
+    for value in _as_list(doc.get('sizes')):
+        size = _size(value)
+        if size is not None:
+            break
+    scheme = 'doi' if identifier else None
+    if identifier:
+        identifier = split_identifier(identifier)[1]
+    return _record(identifier, DATACITE, name, size,
+                   _checksums(pairs, intern), doc.get('contentUrl'),
+                   _authors(doc.get('creators') or doc.get('creator'),
+                            intern), intern, scheme=scheme)
+
+
+def from_identifiers_service(doc, intern=_no_intern):
+    """Convert an identifier record from the Identifiers service."""
+    metadata = doc.get('metadata')
+    if not isinstance(metadata, dict):
+        metadata = {}
+    checksums = _checksums(
+        ((c.get('function'), c.get('value'))
+         for c in _as_list(doc.get('checksums')) if isinstance(c, dict)),
+        intern)
+    return _record(doc.get('identifier'), IDENTIFIERS,
+                   metadata.get('name') or metadata.get('title'),
+                   metadata.get('contentSize') or metadata.get('size'),
+                   checksums, doc.get('location'),
+                   _authors(metadata.get('author')
+                            or metadata.get('creators'), intern), intern)
+
+
+def from_indexd(doc, intern=_no_intern):
+    """Convert an indexd record, as returned by dataguids.org and other
+    Gen3 index services."""
+    hashes = doc.get('hashes')
+    if not isinstance(hashes, dict):
+        hashes = {}
+    return _record(doc.get('did'), INDEXD, doc.get('file_name'),
+                   doc.get('size'), _checksums(hashes.items(), intern),
+                   doc.get('urls'), (), intern)
+
+
+_converters = {
+    DATACITE: from_datacite,
+    SCHEMA_ORG: from_schema_org,
+    IDENTIFIERS: from_identifiers_service,
+    INDEXD: from_indexd,
+}
+
+
+def detect_source(doc):
+    """The name of the shape of doc (one of SOURCES)."""
+    if not isinstance(doc, dict):
+        raise MetadataError('Metadata must be a JSON object, not {}'.format(
+            type(doc).__name__))
+    if 'did' in doc or 'hashes' in doc:
+        return INDEXD
+    if ('@context' in doc or '@type' in doc
+            or ('contentUrl' in doc and 'titles' not in doc)):
+        return SCHEMA_ORG
+    if isinstance(doc.get('data'), dict) or 'titles' in doc or (
+            'creators' in doc and 'doi' in doc):
+        return DATACITE
+    if 'location' in doc or 'checksums' in doc or 'identifier' in doc:
+        return IDENTIFIERS
+    raise MetadataError('Unrecognized metadata document')
+
+
+def normalize(doc, source=None):
+    """Convert doc, of the shape source (by default, detected) to a
+    MetadataRecord."""
+    source = source or detect_source(doc)
+    if source not in _converters:
+        raise MetadataError('Unknown metadata source: {}'.format(source))
+    return _converters[source](doc)
+
+
+def _loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return json.loads(text)
+
+
+def normalize_many(docs, source=None, skip_invalid=False):
+    """
+    Convert each of docs (dicts, or JSON text such as the lines of an NDJSON
+    file) to a MetadataRecord, yielding them in order. Strings repeated
+    across records, such as authors' names, are shared rather than copied.
+
+    With ``source`` every document is taken to have that shape. With
+    ``skip_invalid``, documents which can't be converted are logged and
+    skipped rather than raising MetadataError.
+    """
+    strings = {}
+
+    def intern(value):
+        return strings.setdefault(value, value)
+
+    fixed = _converters.get(source) if source else None
+    if source and fixed is None:
+        raise MetadataError('Unknown metadata source: {}'.format(source))
+    for index, doc in enumerate(docs):
+        try:
+            if isinstance(doc, (bytes, str)):
+                if not doc.strip():
+                    continue
+                doc = _loads(doc)
+            convert = fixed or _converters[detect_source(doc)]
+            yield convert(doc, intern)
+        except (ValueError, AttributeError, TypeError) as err:
+            if not skip_invalid:
+                if isinstance(err, MetadataError):
+                    raise
+                raise MetadataError('Document {}: {}'.format(index, err))
+            log.debug('skipping metadata document %s: %s', index, err)
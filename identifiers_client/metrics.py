@@ -0,0 +1,300 @@
+import json
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+# Phases of an HTTP request which are timed: waiting in the request
+# scheduler, from sending to the response headers (connecting, TLS and the
+# service's own time) and reading the response body
+PHASES = ('queue', 'ttfb', 'transfer', 'total')
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """
+    Call ``hook(event, fields)`` for every instrumentation event. Events
+    are:
+
+    ``http_request``
+      One attempt at an HTTP request to the Identifiers service, with
+      ``method``, ``url``, ``endpoint``, ``status`` (None if it failed
+      with ``error``), ``attempt`` (0 for the first), ``queue``, ``ttfb``,
+      ``transfer`` and ``total`` (seconds), and ``sent`` and ``received``
+      (body bytes; received is None for a streamed response)
+    ``retry``
+      A request about to be retried, with ``method``, ``url``,
+      ``endpoint``, ``attempt``, ``reason`` and ``delay``
+    ``token_refresh``
+      An access token refresh, with ``seconds``, ``ok`` and
+      ``background``
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+
+
+def enabled():
+    """Whether anything is listening, so events are worth building."""
+    return bool(_hooks)
+
+
+def emit(event, **fields):
+    for hook in list(_hooks):
+        try:
+            hook(event, fields)
+        except Exception:
+            log.exception('metrics hook %r failed', hook)
+
+
+# Path segments which are names in the API; anything else is an id
+_endpoint_words = frozenset(['namespace', 'identifier'])
+_identifier_path = re.compile(r'^/?(ark:|minid:|doi:|10\.|dg\.)', re.I)
+
+
+def endpoint_for(path):
+    """
+    The API endpoint for a request path, with ids replaced by placeholders
+    so that requests for different resources are counted together.
+    """
+    if _identifier_path.match(path):
+        return '/{identifier}'
+    parts = [
+        p if p in _endpoint_words else '{id}'
+        for p in path.strip('/').split('/') if p
+    ]
+    return '/' + '/'.join(parts)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """``(upper bound, count)`` pairs in the Prometheus style, ending
+        with '+Inf'."""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _labels(names, values):
+    return '{' + ','.join('{}="{}"'.format(
+        n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for n, v in zip(names, values)) + '}'
+
+
+class Metrics(object):
+    """
+    A hook which aggregates events into per endpoint latency histograms
+    (for each of PHASES), request, byte and retry counters and token
+    refresh counts, exported with ``prometheus()`` or ``as_dict()``.
+
+        metrics = Metrics()
+        add_hook(metrics)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.latency = {}
+        self.requests = {}
+        self.bytes = {}
+        self.retries = {}
+        self.token_refreshes = {}
+        self.token_refresh_latency = Histogram(buckets)
+        self._lock = threading.Lock()
+
+    def _add(self, counter, key, amount=1):
+        counter[key] = counter.get(key, 0) + amount
+
+    def _observe(self, key, value):
+        if key not in self.latency:
+            self.latency[key] = Histogram(self.buckets)
+        self.latency[key].observe(value)
+
+    def __call__(self, event, fields):
+        with self._lock:
+            if event == 'http_request':
+                method, endpoint = fields['method'], fields['endpoint']
+                status = fields['status'] or 'error'
+                self._add(self.requests, (method, endpoint, str(status)))
+                for phase in PHASES:
+                    if fields.get(phase) is not None:
+                        self._observe((method, endpoint, phase),
+                                      fields[phase])
+                self._add(self.bytes, (method, endpoint, 'sent'),
+                          fields.get('sent') or 0)
+                self._add(self.bytes, (method, endpoint, 'received'),
+                          fields.get('received') or 0)
+            elif event == 'retry':
+                self._add(self.retries, (fields['method'], fields['endpoint'],
+                                         fields['reason']))
+            elif event == 'token_refresh':
+                self._add(self.token_refreshes,
+                          ('ok' if fields['ok'] else 'failed',
+                           'background' if fields['background'] else
+                           'blocking'))
+                self.token_refresh_latency.observe(fields['seconds'])
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def _counter(name, help_text, counter, label_names):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} counter'.format(name))
+            for key, value in sorted(counter.items()):
+                lines.append('{}{} {}'.format(name, _labels(label_names, key),
+                                              value))
+
+        def _histogram(name, label_names, key, histogram):
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(label_names + ('le', ), key + (bound, )),
+                    count))
+            lines.append('{}_sum{} {}'.format(
+                name, _labels(label_names, key), histogram.sum))
+            lines.append('{}_count{} {}'.format(
+                name, _labels(label_names, key), histogram.count))
+
+        with self._lock:
+            _counter('identifiers_client_requests_total',
+                     'HTTP requests to the Identifiers service',
+                     self.requests, ('method', 'endpoint', 'status'))
+            name = 'identifiers_client_request_seconds'
+            lines.append('# HELP {} Time spent in each phase of HTTP '
+                         'requests'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, histogram in sorted(self.latency.items()):
+                _histogram(name, ('method', 'endpoint', 'phase'), key,
+                           histogram)
+            _counter('identifiers_client_bytes_total',
+                     'Request and response body bytes', self.bytes,
+                     ('method', 'endpoint', 'direction'))
+            _counter('identifiers_client_retries_total', 'Requests retried',
+                     self.retries, ('method', 'endpoint', 'reason'))
+            _counter('identifiers_client_token_refreshes_total',
+                     'Access token refreshes', self.token_refreshes,
+                     ('outcome', 'mode'))
+            name = 'identifiers_client_token_refresh_seconds'
+            lines.append('# HELP {} Time taken to refresh access '
+                         'tokens'.format(name))
+            lines.append('# TYPE {} histogram'.format(name))
+            _histogram(name, (), (), self.token_refresh_latency)
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        """The metrics as a JSON serializable dict."""
+
+        def _histogram(histogram):
+            return {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'buckets': [[b, c] for b, c in histogram.cumulative()]
+            }
+
+        with self._lock:
+            return {
+                'requests': [
+                    dict(method=m, endpoint=e, status=s, count=c)
+                    for (m, e, s), c in sorted(self.requests.items())
+                ],
+                'latency': [
+                    dict(method=m, endpoint=e, phase=p, **_histogram(h))
+                    for (m, e, p), h in sorted(self.latency.items())
+                ],
+                'bytes': [
+                    dict(method=m, endpoint=e, direction=d, bytes=c)
+                    for (m, e, d), c in sorted(self.bytes.items())
+                ],
+                'retries': [
+                    dict(method=m, endpoint=e, reason=r, count=c)
+                    for (m, e, r), c in sorted(self.retries.items())
+                ],
+                'token_refreshes': [
+                    dict(outcome=o, mode=m, count=c)
+                    for (o, m), c in sorted(self.token_refreshes.items())
+                ],
+                'token_refresh_latency': _histogram(
+                    self.token_refresh_latency)
+            }
+
+    def write(self, path):
+        """
+        Write the metrics to path, replacing it atomically as the
+        Prometheus node exporter's textfile collector expects: as JSON if
+        path ends in .json, and otherwise in the Prometheus text format.
+        """
+        if path.endswith('.json'):
+            text = json.dumps(self.as_dict(), indent=2)
+        else:
+            text = self.prometheus()
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, path)
+
+
+class RequestLog(object):
+    """A hook which keeps every ``http_request`` event, for reporting the
+    requests made by one command."""
+
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event, fields):
+        if event == 'http_request':
+            with self._lock:
+                self.requests.append(fields)
+
+    def table(self):
+        """The requests as a text table, one row per attempt."""
+
+        def _ms(seconds):
+            return '' if seconds is None else '{:.1f}'.format(seconds * 1000)
+
+        header = ('method', 'status', 'queue ms', 'ttfb ms', 'transfer ms',
+                  'total ms', 'sent', 'received', 'url')
+        rows = [header]
+        for r in self.requests:
+            rows.append((r['method'], str(r['status'] or r.get('error')),
+                         _ms(r['queue']), _ms(r['ttfb']), _ms(r['transfer']),
+                         _ms(r['total']), str(r['sent']),
+                         '' if r['received'] is None else str(r['received']),
+                         r['url']))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(header) - 1)]
+        return '\n'.join('  '.join(
+            [cell.ljust(width)
+             for cell, width in zip(row, widths)] + [row[-1]])
+                         for row in rows)
@@ -0,0 +1,222 @@
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import namedtuple
+
+from identifiers_client.batch import (DEFAULT_CONCURRENCY, bounded_map,
+                                      size_connection_pool)
+from identifiers_client.identifiers_api import (_changed_properties,
+                                                _json_parse_args)
+
+log = logging.getLogger(__name__)
+
+# Properties of an identifier which a batch update may change
+_update_fields = ['location', 'checksums', 'metadata', 'visible_to']
+
+# The checkpoint file is synced to disk after this many identifiers
+_SYNC_EVERY = 1000
+
+UpdateResult = namedtuple(
+    'UpdateResult',
+    ['index', 'identifier', 'status', 'changes', 'previous', 'error'])
+
+
+class LocationRewrite(object):
+    """Replaces the prefix ``old_prefix`` of location URLs with
+    ``new_prefix``."""
+
+    def __init__(self, old_prefix, new_prefix):
+        if not old_prefix:
+            raise ValueError('The location prefix to rewrite is empty')
+        self.old_prefix = old_prefix
+        self.new_prefix = new_prefix
+
+    def matches(self, locations):
+        return any(url.startswith(self.old_prefix) for url in locations)
+
+    def apply(self, locations):
+        return [
+            self.new_prefix + url[len(self.old_prefix):]
+            if url.startswith(self.old_prefix) else url for url in locations
+        ]
+
+
+class Checkpoint(object):
+    """
+    The identifiers a batch update has finished with, kept one per line in
+    the file at path so that a run which is interrupted can be started
+    again and skip them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with io.open(path) as f:
+                self.done.update(line.strip() for line in f if line.strip())
+        # Opened on the first record, so a dry run leaves no file behind
+        self._file = None
+        self._unsynced = 0
+
+    def __contains__(self, identifier):
+        return identifier in self.done
+
+    def record(self, identifier):
+        self.done.add(identifier)
+        if self._file is None:
+            self._file = io.open(self.path, 'a')
+        self._file.write(identifier + u'\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= _SYNC_EVERY:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _digest(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).digest()[:16]
+
+
+class Baseline(object):
+    """
+    The last known state of identifiers, such as an earlier
+    ``namespace-export``, against which updates are compared so that only
+    the properties which changed are sent without getting each identifier
+    first. Only a digest of each property is kept, so a baseline of
+    millions of identifiers with large metadata fits in memory.
+    """
+
+    def __init__(self, records):
+        self._digests = {}
+        for record in records:
+            if not isinstance(record, dict) or not record.get('identifier'):
+                continue
+            record = _json_parse_args(dict(record), _update_fields)
+            self._digests[record['identifier']] = tuple(
+                _digest(record.get(name)) for name in _update_fields)
+
+    def __contains__(self, identifier):
+        return identifier in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+    def changes(self, identifier, changes):
+        """The properties of changes which differ from the identifier's in
+        the baseline."""
+        digests = dict(zip(_update_fields, self._digests[identifier]))
+        return dict((name, value) for name, value in changes.items()
+                    if digests.get(name) != _digest(value))
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def select(records, rewrite):
+    """
+    Filter records (e.g. from ``iter_identifiers``) to those with a
+    location which rewrite would change.
+    """
+    for record in records:
+        if rewrite.matches(_as_list(record.get('location'))):
+            yield record
+
+
+def update_identifiers(client, records, rewrite=None, dry_run=False,
+                       checkpoint=None, concurrency=DEFAULT_CONCURRENCY,
+                       minimal=False, baseline=None):
+    """
+    Update the identifiers given by records, running up to ``concurrency``
+    requests at once, and yield an UpdateResult for each in input order.
+
+    Each record names an ``identifier``. Without rewrite, its other
+    properties (location, checksums, metadata, visible_to) are the new
+    values to set. With a LocationRewrite, the record's location, or if it
+    has none the identifier's current location, is rewritten instead.
+
+    With ``minimal``, only the properties which differ from the
+    identifier's current ones are sent, and an identifier with none is left
+    alone. Current values come from the Baseline, if given and it has the
+    identifier, or else from getting the identifier.
+
+    The status of a result is 'updated', 'unchanged' (nothing to change),
+    'planned' (with ``dry_run``, which makes no changes), 'done' (already
+    in the checkpoint) or 'error'. Unless this is a dry run, identifiers
+    which are updated or unchanged are added to the Checkpoint, if one is
+    given.
+    """
+    size_connection_pool(client, concurrency)
+
+    def _update(record):
+        identifier = record.get('identifier')
+        if not identifier:
+            raise ValueError('Record has no identifier')
+        if checkpoint is not None and identifier in checkpoint:
+            return 'done', None, None
+        # Values read from CSV are JSON encoded
+        record = _json_parse_args(dict(record), _update_fields)
+        previous = None
+        if rewrite is None:
+            changes = dict((name, record[name]) for name in _update_fields
+                           if record.get(name) is not None)
+            if minimal and changes:
+                if baseline is not None and identifier in baseline:
+                    changes = baseline.changes(identifier, changes)
+                else:
+                    current = client.get_identifier(identifier).data
+                    changes = _changed_properties(changes, current)
+                    previous = dict((name, current.get(name))
+                                    for name in changes) or None
+        else:
+            current = record.get('location')
+            if current is None:
+                current = client.get_identifier(identifier).data.get(
+                    'location')
+            current = _as_list(current)
+            changes = {}
+            rewritten = rewrite.apply(current)
+            if rewritten != current:
+                changes['location'] = rewritten
+                previous = {'location': current}
+        if not changes:
+            return 'unchanged', None, None
+        if dry_run:
+            return 'planned', changes, previous
+        client.update_identifier(identifier, **changes)
+        return 'updated', changes, previous
+
+    for index, record, result, error in bounded_map(_update, records,
+                                                    concurrency):
+        identifier = record.get('identifier') if isinstance(record,
+                                                            dict) else None
+        if error is not None:
+            yield UpdateResult(index, identifier, 'error', None, None, error)
+            continue
+        status, changes, previous = result
+        if (checkpoint is not None and not dry_run
+                and status in ('updated', 'unchanged')):
+            checkpoint.record(identifier)
+        yield UpdateResult(index, identifier, status, changes, previous,
+                           None)
@@ -0,0 +1,71 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pretty: indented JSON
+# json: a single compact JSON document; a stream of results is one array
+# ndjson: one compact JSON document per line, a line per result of a stream
+FORMATS = ('pretty', 'json', 'ndjson')
+
+_compact = (',', ':')
+
+
+def dumps(data):
+    """
+    Encode data as compact JSON text, with orjson when it is installed and
+    can encode it (it refuses some things json accepts, such as integers
+    wider than 64 bits and keys which are not strings).
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(data, separators=_compact)
+
+
+def dumps_pretty(data):
+    # Always the json module, so the default output doesn't depend on which
+    # encoder is installed
+    return json.dumps(data, indent=2)
+
+
+def write_result(data, out, fmt):
+    """Write the data of one response to out in the format fmt."""
+    if fmt == 'pretty':
+        out.write(dumps_pretty(data))
+        out.write('\n')
+    elif fmt == 'ndjson' and isinstance(data, list):
+        for item in data:
+            out.write(dumps(item))
+            out.write('\n')
+    else:
+        out.write(dumps(data))
+        out.write('\n')
+
+
+def write_stream(items, out, fmt):
+    """
+    Write each item of the iterator items to out in the format fmt as soon
+    as it is produced, flushing after each so that readers at the other end
+    of a pipe see results as they arrive. In the json format, the items are
+    written as the elements of one array.
+    """
+    if fmt == 'json':
+        out.write('[')
+        separator = '\n'
+        for item in items:
+            out.write(separator)
+            out.write(dumps(item))
+            out.flush()
+            separator = ',\n'
+        out.write('\n]\n' if separator != '\n' else ']\n')
+        return
+    encode = dumps_pretty if fmt == 'pretty' else dumps
+    for item in items:
+        out.write(encode(item))
+        out.write('\n')
+        out.flush()
@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                wait)
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from identifiers_client import defaults
+
+log = logging.getLogger(__name__)
+
+SCHEMAORG_JSONLD = 'application/vnd.schemaorg.ld+json'
+
+DEFAULT_HEDGE_AFTER = defaults.RESOLVER_HEDGE_AFTER
+DEFAULT_TIMEOUT = defaults.RESOLVER_TIMEOUT
+
+# Resolvers for each identifier scheme, in order of preference. When a
+# scheme has several, later ones are tried (hedged) if the earlier ones are
+# slow or fail.
+_scheme_resolvers = {
+    'doi': [
+        'https://doi.org/{id}',
+        'https://data.crosscite.org/' + SCHEMAORG_JSONLD + '/{id}',
+    ],
+    'ark': ['https://n2t.net/{id}'],
+    'minid': ['https://identifiers.org/{id}', 'https://n2t.net/{id}'],
+    'dg': ['https://dataguids.org/index/{id}'],
+}
+
+_scheme_accept = {
+    'dg': 'application/json',
+}
+
+ResolvedIdentifier = namedtuple(
+    'ResolvedIdentifier', ['identifier', 'scheme', 'resolver', 'metadata'])
+
+
+class ResolutionError(ValueError):
+    def __init__(self, identifier, failures):
+        self.identifier = identifier
+        self.failures = failures
+        details = '; '.join('{}: {}'.format(url, err)
+                            for url, err in failures)
+        super(ResolutionError, self).__init__('Could not resolve {}: {}'.format(
+            identifier, details or 'no resolver available'))
+
+
+def parse_identifier(identifier):
+    """
+    Return ``(scheme, identifier)`` for a DOI, ARK, minid or dataguid,
+    with the identifier in the form its resolvers expect.
+    """
+    ident = identifier.strip()
+    lowered = ident.lower()
+    for prefix in ('https://doi.org/', 'http://doi.org/',
+                   'https://dx.doi.org/', 'http://dx.doi.org/'):
+        if lowered.startswith(prefix):
+            return 'doi', ident[len(prefix):]
+    if lowered.startswith('doi:'):
+        return 'doi', ident[4:].lstrip('/')
+    if lowered.startswith('10.') and '/' in ident:
+        return 'doi', ident
+    if lowered.startswith('ark:'):
+        return 'ark', 'ark:/' + ident[4:].lstrip('/')
+    if lowered.startswith('minid:'):
+        return 'minid', ident
+    if lowered.startswith('dg.'):
+        return 'dg', ident
+    raise ValueError('Unrecognized identifier scheme: {}'.format(identifier))
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a host after ``failure_threshold`` consecutive
+    failures. After ``reset_after`` seconds a single trial request is let
+    through; its success closes the breaker again.
+    """
+
+    def __init__(self, failure_threshold=3, reset_after=30):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_after:
+                # Half open: allow one trial, and hold the breaker open for
+                # everyone else until it reports back
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.time()
+
+
+class Resolver(object):
+    """
+    Resolves identifiers to their schema.org JSON-LD metadata through the
+    global resolvers for their scheme.
+
+    The first resolver for a scheme is asked straight away. If it has not
+    answered within ``hedge_after`` seconds, or fails, the next is asked as
+    well, and the first good answer wins. With ``race=True`` all resolvers
+    are asked at once. Hosts which keep failing are skipped for a while.
+
+    With a LocationRanker, a scheme's resolvers are asked in order of their
+    hosts' latency as recorded in its history, which is kept up to date
+    with each answer, rather than in the fixed order of preference.
+    """
+
+    def __init__(self, hedge_after=DEFAULT_HEDGE_AFTER, race=False,
+                 timeout=DEFAULT_TIMEOUT, max_workers=16, session=None,
+                 ranker=None):
+        self.hedge_after = hedge_after
+        self.race = race
+        self.timeout = timeout
+        self.ranker = ranker
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self._session = session
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def breaker(self, url):
+        host = urlparse(url).netloc
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker()
+            return self._breakers[host]
+
+    def _fetch(self, url, accept, timeout):
+        breaker = self.breaker(url)
+        started = time.time()
+        try:
+            r = self._session.get(url, headers={'Accept': accept},
+                                  timeout=timeout)
+        except requests.RequestException:
+            breaker.record(False)
+            if self.ranker is not None:
+                self.ranker.history.record(url, ok=False)
+            raise
+        # A server error counts against the host, a 404 does not
+        breaker.record(r.status_code < 500)
+        if self.ranker is not None:
+            self.ranker.history.record(url, time.time() - started,
+                                       ok=r.status_code < 500)
+        if r.status_code != 200:
+            raise ValueError('HTTP status {}'.format(r.status_code))
+        return r.json()
+
+    def resolve(self, identifier, hedge_after=None, race=None, timeout=None):
+        """
+        Resolve identifier, returning a ``ResolvedIdentifier`` with the
+        metadata document from the first resolver to answer successfully.
+        Raises ResolutionError if none did. ``hedge_after``, ``race`` and
+        ``timeout`` override the resolver's settings for this call.
+        """
+        hedge_after = self.hedge_after if hedge_after is None else hedge_after
+        race = self.race if race is None else race
+        timeout = self.timeout if timeout is None else timeout
+        scheme, ident = parse_identifier(identifier)
+        accept = _scheme_accept.get(scheme, SCHEMAORG_JSONLD)
+        urls = [
+            tmpl.format(id=ident) for tmpl in _scheme_resolvers[scheme]
+        ]
+        if self.ranker is not None:
+            # Metadata documents are small, so latency is what matters
+            urls = self.ranker.order(urls, size=0, probe=False)
+        # Lazily, so a half open breaker's trial is only used if launched
+        candidates = (u for u in urls if self.breaker(u).allow())
+        failures = []
+        pending = {}
+
+        def _launch():
+            url = next(candidates, None)
+            if url is not None:
+                log.debug('resolving %s via %s', identifier, url)
+                pending[self._pool.submit(self._fetch, url, accept,
+                                          timeout)] = url
+            return url is not None
+
+        _launch()
+        more = True
+        if race:
+            while _launch():
+                pass
+            more = False
+        deadline = time.time() + timeout
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                failures.extend((url, 'timed out')
+                                for url in pending.values())
+                break
+            wait_for = min(hedge_after, remaining) if more else remaining
+            done, _ = wait(list(pending), timeout=wait_for,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    metadata = future.result()
+                except (requests.RequestException, ValueError) as err:
+                    failures.append((url, str(err)))
+                    continue
+                return ResolvedIdentifier(identifier, scheme, url, metadata)
+            # Hedge: nothing good yet, either because the outstanding
+            # requests are slow or because they failed
+            if more:
+                more = _launch()
+                if not pending:
+                    break
+        raise ResolutionError(identifier, failures)
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_resolver():
+    """Return a Resolver shared by the process, keeping its connections
+    and circuit breaker state between calls, and ranking resolvers with
+    the shared LocationRanker."""
+    from identifiers_client.locations import get_ranker
+
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = Resolver(ranker=get_ranker())
+        return _default_resolver
+
+
+def resolve(identifier, **kwargs):
+    """
+    Resolve a DOI, ARK, minid or dataguid to its metadata with the shared
+    Resolver. See ``Resolver.resolve`` for the keyword arguments.
+    """
+    return get_resolver().resolve(identifier, **kwargs)
@@ -0,0 +1,22 @@
+import json
+
+
+class BufferedResponse(object):
+    """
+    A fully read HTTP response exposing the parts of the requests response
+    interface used by GlobusHTTPResponse and GlobusAPIError, for responses
+    which did not come from a requests session (aiohttp, the cache).
+    """
+
+    def __init__(self, status_code, headers, content, url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
@@ -0,0 +1,392 @@
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+from urllib.parse import urlparse
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (ChunkedEncodingError, ConnectTimeout,
+                                 RequestException, Timeout)
+from urllib3.exceptions import NewConnectionError
+
+from identifiers_client import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RATE = 100
+DEFAULT_BURST = 100
+DEFAULT_INITIAL_CONCURRENCY = 8
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 0.25
+BACKOFF_MAX = 30
+# Longest Retry-After honoured, in seconds
+RETRY_AFTER_MAX = 300
+
+# Responses which show the service is overloaded. A 429 means the request
+# was not processed, so it is retried whatever the method.
+_congestion_statuses = frozenset([429, 500, 502, 503, 504])
+_idempotent_methods = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# Socket errors which show the service dropped the connection
+_reset_errnos = frozenset([errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE])
+
+# Latency counts as healthy, and concurrency may grow, while it is within
+# this factor of the lowest latency seen recently
+_LATENCY_TOLERANCE = 2.0
+# How quickly the lowest latency drifts up towards the latencies seen, so
+# that a service which has become slower for good is not held to its best
+_BASELINE_DRIFT = 0.01
+
+
+class TokenBucket(object):
+    """Allows ``rate`` requests a second on average, in bursts of up to
+    ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token, returning the seconds to wait before using it."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens may go negative: each waiter reserves the next one
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class AdaptiveLimit(object):
+    """
+    Limits the requests in flight with additive increase, multiplicative
+    decrease. Each healthy response (latency close to the best seen) grows
+    the limit by about one per round trip; a sign of congestion halves it,
+    once for the requests sent before the last decrease.
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_CONCURRENCY, minimum=1,
+                 maximum=DEFAULT_MAX_CONCURRENCY):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.baseline_latency = None
+        self._decreased_at = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for room under the limit; returns the request start time."""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, started, congested=False):
+        with self._cond:
+            self.in_flight -= 1
+            now = time.time()
+            if congested:
+                if started >= self._decreased_at:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+                    log.debug('congestion: concurrency limit now %.1f',
+                              self.limit)
+            else:
+                latency = now - started
+                if self.baseline_latency is None:
+                    self.baseline_latency = latency
+                else:
+                    self.baseline_latency = min(
+                        latency, self.baseline_latency +
+                        (latency - self.baseline_latency) * _BASELINE_DRIFT)
+                if latency <= self.baseline_latency * _LATENCY_TOLERANCE:
+                    self.limit = min(self.maximum,
+                                     self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class _Host(object):
+    def __init__(self, scheduler):
+        self.bucket = TokenBucket(scheduler.rate, scheduler.burst)
+        self.limit = AdaptiveLimit(scheduler.initial_concurrency,
+                                   maximum=scheduler.max_concurrency)
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def wait_turn(self):
+        # Sleep out any Retry-After pause first, so the token taken next is
+        # used straight away
+        while True:
+            delay = self.paused_until - time.time()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+        delay = self.bucket.take()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _retry_after(response):
+    """The delay asked for by a Retry-After header in seconds, or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        delay = mktime_tz(parsed) - time.time()
+    return max(0, min(delay, RETRY_AFTER_MAX))
+
+
+def _causes(error):
+    """error and the exceptions it wraps, as requests and urllib3 nest them
+    (in ``reason``, ``args`` or ``__cause__``)."""
+    causes = []
+    pending = [error]
+    while pending:
+        error = pending.pop(0)
+        if any(error is cause for cause in causes):
+            continue
+        causes.append(error)
+        reason = getattr(error, 'reason', None)
+        if isinstance(reason, BaseException):
+            pending.append(reason)
+        pending.extend(arg for arg in error.args
+                       if isinstance(arg, BaseException))
+        if getattr(error, '__cause__', None) is not None:
+            pending.append(error.__cause__)
+    return causes
+
+
+def _is_congestion(error):
+    """Whether a failed request suggests the service is overloaded: it timed
+    out or the connection was reset. Other failures, such as a name which
+    doesn't resolve or a bad certificate, say nothing about load."""
+    if isinstance(error, (Timeout, ChunkedEncodingError)):
+        return True
+    return any(
+        isinstance(cause, socket.timeout)
+        or (isinstance(cause, EnvironmentError)
+            and cause.errno in _reset_errnos) for cause in _causes(error))
+
+
+def _not_sent(error):
+    """Whether a failed request never reached the service, so may be
+    retried even if it is not idempotent: connecting timed out, was
+    refused or the name didn't resolve."""
+    return isinstance(error, ConnectTimeout) or any(
+        isinstance(cause, NewConnectionError) for cause in _causes(error))
+
+
+class RequestScheduler(object):
+    """
+    Coordinates the requests made by every thread to each host: a token
+    bucket limits their rate, an AdaptiveLimit their concurrency, and
+    requests which fail because the service is overloaded are retried with
+    exponential backoff and jitter, or after the delay the service gives in
+    Retry-After (which pauses all requests to that host). Requests which are
+    not idempotent are only retried after a 429 or a failure to connect
+    (a timeout, refused connection or unresolved name), when the service
+    can't have received them. Only timeouts, connection resets and
+    congestion statuses reduce the concurrency limit.
+
+    ``stats`` counts requests, retries and congestion responses.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.rate = rate
+        self.burst = burst
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.stats = dict(requests=0, retries=0, congested=0)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the scheduler described by the optional ``[scheduler]``
+        section of config (options ``rate``, ``burst``,
+        ``initial_concurrency``, ``max_concurrency`` and ``max_retries``),
+        or return None when there is no such section.
+        """
+        if not config.has_section('scheduler'):
+            return None
+        kwargs = {}
+        for name, convert in (('rate', float), ('burst', float),
+                              ('initial_concurrency', int),
+                              ('max_concurrency', int), ('max_retries', int)):
+            if config.has_option('scheduler', name):
+                kwargs[name] = convert(config.get('scheduler', name))
+        return cls(**kwargs)
+
+    def host(self, url):
+        netloc = urlparse(url).netloc
+        with self._lock:
+            if netloc not in self._hosts:
+                self._hosts[netloc] = _Host(self)
+            return self._hosts[netloc]
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _backoff(self, attempt):
+        # "Full jitter": spreads the retries of many threads apart
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+    def send(self, request, send, stream=False):
+        """
+        Make the prepared request by calling send(), which returns its
+        response, scheduling it and retrying it as described above. Unless
+        ``stream`` is set the response body is read before the request
+        counts as finished, so the time to transfer it is part of its
+        latency.
+        """
+        host = self.host(request.url)
+        idempotent = request.method in _idempotent_methods
+        attempt = 0
+        while True:
+            queued = time.time()
+            host.wait_turn()
+            started = host.limit.acquire()
+            self._count('requests')
+            response = headers_at = error = None
+            congested = False
+            # The slot is given back however the request ends, or a host
+            # would be left with fewer slots after every unexpected error
+            try:
+                response = send()
+                headers_at = time.time()
+                if not stream:
+                    response.content
+                congested = response.status_code in _congestion_statuses
+            except RequestException as err:
+                error = err
+                congested = _is_congestion(err)
+            finally:
+                host.limit.release(started, congested)
+            if error is not None:
+                self._emit_request(request, attempt, queued, started,
+                                   headers_at, response, error, stream)
+                if (attempt >= self.max_retries
+                        or not (idempotent or _not_sent(error))):
+                    raise error
+                retry_after = None
+                delay = self._backoff(attempt)
+                reason = type(error).__name__
+                detail = str(error)
+            else:
+                self._emit_request(request, attempt, queued, started,
+                                   headers_at, response, None, stream)
+                if not congested:
+                    return response
+                self._count('congested')
+                if (attempt >= self.max_retries
+                        or not (idempotent or response.status_code == 429)):
+                    return response
+                retry_after = _retry_after(response)
+                if retry_after is not None:
+                    host.pause(retry_after)
+                    delay = retry_after
+                else:
+                    delay = self._backoff(attempt)
+                reason = str(response.status_code)
+                detail = 'HTTP status ' + reason
+                response.close()
+            attempt += 1
+            self._count('retries')
+            log.debug('retrying %s %s (%s), attempt %s', request.method,
+                      request.url, detail, attempt)
+            if metrics.enabled():
+                metrics.emit('retry', method=request.method, url=request.url,
+                             endpoint=metrics.endpoint_for(
+                                 urlparse(request.url).path),
+                             attempt=attempt, reason=reason, delay=delay)
+            if delay and retry_after is None:
+                time.sleep(delay)
+
+    def _emit_request(self, request, attempt, queued, started, headers_at,
+                      response, error, stream):
+        if not metrics.enabled():
+            return
+        finished = time.time()
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        received = None
+        if response is not None and not stream and error is None:
+            received = len(response.content)
+        metrics.emit(
+            'http_request',
+            method=request.method,
+            url=request.url,
+            endpoint=metrics.endpoint_for(urlparse(request.url).path),
+            status=None if error is not None else response.status_code,
+            error=None if error is None else type(error).__name__,
+            attempt=attempt,
+            queue=started - queued,
+            ttfb=None if headers_at is None else headers_at - started,
+            transfer=(None if headers_at is None or stream
+                      or error is not None else finished - headers_at),
+            total=finished - queued,
+            sent=len(body) if body else 0,
+            received=received)
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """An HTTPAdapter which sends its requests through a
+    RequestScheduler."""
+
+    def __init__(self, scheduler, *args, **kwargs):
+        self.scheduler = scheduler
+        super(ScheduledAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        return self.scheduler.send(
+            request,
+            lambda: super(ScheduledAdapter, self).send(request, **kwargs),
+            stream=kwargs.get('stream', False))
+
+
+def mount(session, scheduler, **adapter_kwargs):
+    """Send all of session's HTTP(S) requests through scheduler."""
+    adapter = ScheduledAdapter(scheduler, **adapter_kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return a RequestScheduler shared by the process."""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
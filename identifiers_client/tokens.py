@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+
+from globus_sdk import NativeAppAuthClient, RefreshTokenAuthorizer
+
+from identifiers_client import metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds for which a refresh token introspection result is trusted
+DEFAULT_INTROSPECT_INTERVAL = 3600
+# Access tokens are refreshed in the background this many seconds before
+# they expire
+DEFAULT_REFRESH_MARGIN = 300
+
+_auth_clients = {}
+_auth_clients_lock = threading.Lock()
+
+
+def auth_client(client_id, app_name):
+    """Return a NativeAppAuthClient for client_id, shared by the process."""
+    with _auth_clients_lock:
+        key = (client_id, app_name)
+        if key not in _auth_clients:
+            _auth_clients[key] = NativeAppAuthClient(
+                client_id, app_name=app_name)
+        return _auth_clients[key]
+
+
+class TokenState(object):
+    """
+    Decides whether the tokens held in config are usable, locally where
+    possible. An unexpired access token is taken as proof of a valid login.
+    Otherwise the refresh token is introspected with Globus Auth, and the
+    result is kept in config for ``introspect_interval`` seconds (the
+    ``introspect_interval`` option of the [client] section, if set).
+    """
+
+    def __init__(self, config, introspect_interval=None):
+        self.config = config
+        if introspect_interval is None:
+            if config.has_option('client', 'introspect_interval'):
+                introspect_interval = float(
+                    config.get('client', 'introspect_interval'))
+            else:
+                introspect_interval = DEFAULT_INTROSPECT_INTERVAL
+        self.introspect_interval = introspect_interval
+
+    def _get(self, name, default=''):
+        if self.config.has_option('tokens', name):
+            return self.config.get('tokens', name)
+        return default
+
+    def has_tokens(self):
+        return bool(self._get('refresh_token') and self._get('access_token'))
+
+    def access_token_valid(self):
+        return time.time() < int(self._get('access_token_expires', '0'))
+
+    def cached_introspection(self):
+        """The cached refresh token state, or None if unknown or too old."""
+        checked_at = float(self._get('introspected_at', '0'))
+        if time.time() - checked_at > self.introspect_interval:
+            return None
+        return self._get('refresh_token_active') == 'true'
+
+    def record_introspection(self, active, save=True):
+        self.config.set('tokens', 'introspected_at', str(int(time.time())))
+        self.config.set('tokens', 'refresh_token_active',
+                        'true' if active else 'false')
+        if save:
+            self.config.save()
+
+    def invalidate(self):
+        """Forget the cached introspection, e.g. after a 401."""
+        if self.config.has_option('tokens', 'introspected_at'):
+            self.config.set('tokens', 'introspected_at', '0')
+            self.config.save()
+
+    def is_logged_in(self, native_client):
+        """
+        Return whether the tokens in config can be used, introspecting the
+        refresh token with native_client only if it cannot be decided
+        locally.
+        """
+        if not self.has_tokens():
+            return False
+        if self.access_token_valid():
+            return True
+        active = self.cached_introspection()
+        if active is None:
+            log.debug('introspecting refresh token')
+            res = native_client.oauth2_validate_token(
+                self._get('refresh_token'))
+            active = bool(res['active'])
+            self.record_introspection(active)
+        return active
+
+
+class ManagedRefreshTokenAuthorizer(RefreshTokenAuthorizer):
+    """
+    A thread-safe RefreshTokenAuthorizer. Concurrent callers wait on a
+    single refresh rather than each making one, and once the access token
+    is within ``refresh_margin`` seconds of expiry a new one is fetched in
+    the background while the current one stays in use. ``on_unauthorized``
+    is called when the service rejects the access token with a 401.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.refresh_margin = kwargs.pop('refresh_margin',
+                                         DEFAULT_REFRESH_MARGIN)
+        self.on_unauthorized = kwargs.pop('on_unauthorized', None)
+        self._refresh_lock = threading.Lock()
+        self._background = None
+        super(ManagedRefreshTokenAuthorizer, self).__init__(*args, **kwargs)
+
+    def _expiring_soon(self):
+        return (self.expires_at is not None
+                and time.time() > self.expires_at - self.refresh_margin)
+
+    def _background_refresh(self):
+        try:
+            with self._refresh_lock:
+                # Someone may have refreshed while we waited
+                if self._expiring_soon():
+                    self._get_new_access_token()
+        except Exception:
+            log.exception('background token refresh failed')
+        finally:
+            self._background = None
+
+    def check_expiration_time(self):
+        if (self._expiring_soon() and self._background is None
+                and time.time() <= self.expires_at):
+            self._background = threading.Thread(
+                target=self._background_refresh)
+            self._background.daemon = True
+            self._background.start()
+        if (self.access_token is not None and self.expires_at is not None
+                and time.time() <= self.expires_at):
+            # Still valid: use it without waiting on any refresh under way
+            return
+        with self._refresh_lock:
+            super(ManagedRefreshTokenAuthorizer, self).check_expiration_time()
+
+    def _get_new_access_token(self):
+        started = time.time()
+        ok = False
+        try:
+            super(ManagedRefreshTokenAuthorizer, self)._get_new_access_token()
+            ok = True
+        finally:
+            if metrics.enabled():
+                metrics.emit(
+                    'token_refresh',
+                    seconds=time.time() - started,
+                    ok=ok,
+                    background=threading.current_thread() is self._background)
+
+    def handle_missing_authorization(self, *args, **kwargs):
+        if callable(self.on_unauthorized):
+            self.on_unauthorized()
+        return super(ManagedRefreshTokenAuthorizer,
+                     self).handle_missing_authorization(*args, **kwargs)
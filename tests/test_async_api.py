@@ -0,0 +1,99 @@
+import asyncio
+import json
+import threading
+from http import server as http_server
+
+import pytest
+
+from identifiers_client import metrics
+
+aiohttp = pytest.importorskip('aiohttp')
+
+from identifiers_client.async_api import AsyncIdentifierClient  # noqa: E402
+
+
+class _Handler(http_server.BaseHTTPRequestHandler):
+    """Answers every request with its path, refusing compressed bodies."""
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if self.headers.get('Content-Encoding'):
+            status, body = 415, b'{}'
+        else:
+            status, body = 200, json.dumps({'path': self.path}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    server = http_server.HTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def events():
+    events = []
+
+    def _hook(event, fields):
+        events.append((event, fields))
+
+    metrics.add_hook(_hook)
+    yield events
+    metrics.remove_hook(_hook)
+
+
+def _run(base_url, call, **kwargs):
+    async def _call():
+        async with AsyncIdentifierClient(base_url, **kwargs) as client:
+            return await call(client)
+    return asyncio.run(_call())
+
+
+def test_requests_emit_metrics(base_url, events):
+    response = _run(base_url,
+                    lambda client: client.get_identifier('ark:/99999/fk4'))
+    assert response.data == {'path': '/ark:/99999/fk4'}
+    (event, fields), = events
+    assert event == 'http_request'
+    assert fields['method'] == 'GET'
+    assert fields['endpoint'] == '/{identifier}'
+    assert fields['status'] == 200
+    assert fields['attempt'] == 0
+    assert fields['received'] == len(json.dumps(response.data))
+    assert fields['ttfb'] is not None and fields['total'] >= fields['ttfb']
+
+
+def test_resend_uncompressed_emits_retry(base_url, events):
+    _run(base_url,
+         lambda client: client.update_identifier('ark:/99999/fk4',
+                                                 metadata={'a': 'b' * 1000}),
+         compress_min_size=0)
+    assert [(event, fields.get('status'), fields['attempt'])
+            for event, fields in events] == [('http_request', 415, 0),
+                                             ('retry', None, 1),
+                                             ('http_request', 200, 1)]
+    assert events[1][1]['reason'] == '415'
+
+
+def test_connection_error_emitted(events):
+    with pytest.raises(Exception):
+        _run('http://127.0.0.1:1/',
+             lambda client: client.get_identifier('ark:/99999/fk4'))
+    (event, fields), = events
+    assert fields['status'] is None
+    assert fields['error'] is not None
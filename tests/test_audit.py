@@ -0,0 +1,159 @@
+import functools
+import hashlib
+import io
+import json
+import threading
+from http import server as http_server
+
+import pytest
+import requests
+
+from identifiers_client import audit
+from identifiers_client.batch import (_export_fields, read_records,
+                                      write_records)
+
+
+class _Handler(http_server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def served(tmp_path):
+    """A directory of files served over HTTP; yields (directory, base
+    URL)."""
+    handler = functools.partial(_Handler, directory=str(tmp_path))
+    server = http_server.HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    thread.daemon = True
+    thread.start()
+    yield tmp_path, 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+class _Response(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class _Client(object):
+    """Serves identifier records from a dict, as get_identifier does."""
+
+    def __init__(self, records):
+        self._session = requests.Session()
+        self.records = dict((r['identifier'], r) for r in records)
+        self.gets = 0
+
+    def get_identifier(self, identifier):
+        self.gets += 1
+        return _Response(self.records[identifier])
+
+
+def _records(served):
+    directory, base_url = served
+    records = []
+    for name, data in (('good', b'good data'), ('bad', b'bad data')):
+        (directory / name).write_bytes(data)
+        records.append({
+            'identifier': 'ark:/99999/' + name,
+            'namespace': 'ns',
+            'location': [base_url + name],
+            'checksums': [{
+                'function': 'sha256',
+                'value': hashlib.sha256(b'good data').hexdigest()
+            }],
+            'metadata': {'contentSize': len(data)},
+            'visible_to': ['public']
+        })
+    records.append({
+        'identifier': 'ark:/99999/gone',
+        'location': [base_url + 'gone'],
+        'checksums': records[0]['checksums']
+    })
+    return records
+
+
+def _statuses(results):
+    return dict((r.identifier, r.status) for r in results)
+
+
+def _export(records, fmt):
+    stream = io.StringIO()
+    write_records(records, stream, fmt)
+    stream.seek(0)
+    return list(read_records(stream, fmt, fields=_export_fields))
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_audit_exported_records(served, tmp_path, fmt):
+    records = _records(served)
+    client = _Client(records)
+    with audit.AuditStore(str(tmp_path / 'audit')) as store:
+        results = list(audit.audit(client, _export(records, fmt), store,
+                                   concurrency=2))
+        assert _statuses(results) == {
+            'ark:/99999/good': audit.PASS,
+            'ark:/99999/bad': audit.FAIL,
+            'ark:/99999/gone': audit.UNREACHABLE,
+        }
+        # Exported records are checked as given
+        assert client.gets == 0
+        assert store.summary()['results'] == {'pass': 1, 'fail': 1,
+                                              'unreachable': 1}
+
+
+def test_audit_gets_records_given_by_identifier(served, tmp_path):
+    records = _records(served)
+    client = _Client(records)
+    ids = [{'identifier': r['identifier']} for r in records]
+    with audit.AuditStore(str(tmp_path / 'audit')) as store:
+        results = list(audit.audit(client, ids, store, concurrency=2))
+    assert _statuses(results)['ark:/99999/good'] == audit.PASS
+    assert client.gets == 3
+
+
+def test_interrupted_audit_resumes(served, tmp_path):
+    records = _records(served)
+    client = _Client(records)
+    path = str(tmp_path / 'audit')
+    with audit.AuditStore(path) as store:
+        results = audit.audit(client, records, store, concurrency=1)
+        first = next(results)
+        results.close()
+        assert store.summary()['last_run']['finished_at'] is None
+    with audit.AuditStore(path) as store:
+        results = list(audit.audit(client, records, store, concurrency=1))
+        assert results[0].identifier == first.identifier
+        assert results[0].status == audit.DONE
+        assert [r.status for r in results[1:]] == [audit.FAIL,
+                                                   audit.UNREACHABLE]
+        assert store.summary()['last_run']['finished_at'] is not None
+
+
+def test_samples_cover_every_identifier(tmp_path):
+    identifiers = ['ark:/99999/{}'.format(i) for i in range(1000)]
+    with audit.AuditStore(str(tmp_path / 'audit')) as store:
+        covered = []
+        for _ in range(4):
+            run = store.start_run(25)
+            covered.extend(
+                i for i in identifiers
+                if audit.in_sample(i, run.sample_start, run.sample_percent))
+            store.finish_run(run)
+    assert sorted(covered) == sorted(identifiers)
+
+
+def test_unverifiable_without_checksums():
+    auditor = audit.Auditor()
+    assert auditor.check({'identifier': 'ark:/99999/x',
+                          'location': ['http://127.0.0.1:1/x']}) == (
+                              audit.UNVERIFIABLE, [])
+
+
+def test_record_is_json_round_trip(served, tmp_path):
+    records = _records(served)
+    with audit.AuditStore(str(tmp_path / 'audit')) as store:
+        list(audit.audit(_Client(records), records[:1], store))
+        stored = store._db.execute('SELECT locations FROM results').fetchone()
+    assert json.loads(stored[0])[0]['status'] == audit.PASS
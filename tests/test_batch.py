@@ -0,0 +1,146 @@
+import io
+import itertools
+import json
+import threading
+import time
+
+import pytest
+
+from identifiers_client.batch import (_export_fields, bounded_map,
+                                      read_records, write_records)
+
+
+def _slow_square(n):
+    # Later items finish first
+    time.sleep(0.01 * (5 - n))
+    return n * n
+
+
+def test_results_in_input_order():
+    results = list(bounded_map(_slow_square, range(5), concurrency=5))
+    assert [(i, item, result, error)
+            for i, item, result, error in results] == [
+                (n, n, n * n, None) for n in range(5)]
+
+
+def test_unordered_results_as_completed():
+    results = list(bounded_map(_slow_square, range(5), concurrency=5,
+                               ordered=False))
+    assert sorted(results) == [(n, n, n * n, None) for n in range(5)]
+    assert results[0][0] == 4
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_errors_returned_for_their_item(ordered):
+    called = []
+
+    def _func(n):
+        called.append(n)
+        if n == 1:
+            raise RuntimeError('failed')
+        return n
+
+    unreadable = ValueError('line 3: bad JSON')
+    results = sorted(bounded_map(_func, [0, 1, unreadable, 3],
+                                 concurrency=2, ordered=ordered),
+                     key=lambda r: r[0])
+    assert [r[2] for r in results] == [0, None, None, 3]
+    assert [type(r[3]) for r in results] == [type(None), RuntimeError,
+                                             ValueError, type(None)]
+    assert results[2][3] is unreadable
+    # An unreadable item is never passed to func
+    assert sorted(called) == [0, 1, 3]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_concurrency_bounded(ordered):
+    lock = threading.Lock()
+    running = [0]
+    most = [0]
+
+    def _func(n):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.005)
+        with lock:
+            running[0] -= 1
+        return n
+
+    results = list(bounded_map(_func, range(40), concurrency=3,
+                               ordered=ordered))
+    assert len(results) == 40
+    assert 1 <= most[0] <= 3
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_lazy_input_read_ahead_bounded(ordered):
+    consumed = [0]
+
+    def _items():
+        for n in itertools.count():
+            consumed[0] += 1
+            yield n
+
+    results = bounded_map(lambda n: n, _items(), concurrency=2,
+                          ordered=ordered)
+    next(results)
+    assert consumed[0] <= 2 * 2 + 1
+    results.close()
+
+
+def _read(text, fmt=None, fields=None):
+    kwargs = {} if fields is None else {'fields': fields}
+    return list(read_records(io.StringIO(text), fmt, **kwargs))
+
+
+def test_read_ndjson():
+    records = _read(u'\n{"namespace": "ns", "location": ["a"]}\n\n'
+                    u'{not json}\n{"namespace": "other"}\n')
+    assert records[0] == {'namespace': 'ns', 'location': ['a']}
+    assert isinstance(records[1], ValueError)
+    assert str(records[1]).startswith('line 4: ')
+    assert records[2] == {'namespace': 'other'}
+
+
+def test_read_csv_keeps_known_non_empty_fields():
+    records = _read(u'namespace,location,colour,metadata\n'
+                    u'ns,"[""http://a""]",red,\n')
+    # Values are left as read, JSON encoded
+    assert records == [{'namespace': 'ns', 'location': '["http://a"]'}]
+
+
+def test_read_ids_guessed_when_identifier_is_a_field():
+    records = _read(u'ark:/99999/1\n\nark:/99999/2\n',
+                    fields=_export_fields)
+    assert records == [{'identifier': 'ark:/99999/1'},
+                       {'identifier': 'ark:/99999/2'}]
+    # Without an identifier field, the same lines are a CSV header
+    assert _read(u'ark:/99999/1\nark:/99999/2\n') == [{}]
+
+
+def test_read_unknown_format():
+    with pytest.raises(ValueError):
+        _read(u'{}\n', fmt='xml')
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_write_then_read(fmt):
+    records = [{
+        'identifier': 'ark:/99999/1',
+        'namespace': 'ns',
+        'location': ['http://a', 'http://b'],
+        'checksums': [{'function': 'sha256', 'value': 'ab'}],
+        'metadata': {'name': 'one', 'contentSize': 3},
+    }, {
+        'identifier': 'ark:/99999/2',
+        'namespace': 'ns',
+    }]
+    stream = io.StringIO()
+    assert write_records(iter(records), stream, fmt) == 2
+    stream.seek(0)
+    read = _read(stream.getvalue(), fields=_export_fields)
+    if fmt == 'csv':
+        read = [dict((k, json.loads(v) if v[:1] in '[{' else v)
+                     for k, v in record.items()) for record in read]
+    assert read == records
@@ -0,0 +1,151 @@
+import json
+import threading
+from http import server as http_server
+
+import pytest
+
+from identifiers_client.cache import (CacheEntry, MemoryStore, ResponseCache,
+                                      SQLiteStore)
+from identifiers_client.identifiers_api import (IdentifierClient,
+                                                IdentifierClientError)
+from identifiers_client.scheduler import RequestScheduler
+
+
+class _Service(http_server.BaseHTTPRequestHandler):
+    """
+    Serves records from ``server.records`` with an ETag of their version,
+    answering a matching If-None-Match with 304, and records each request
+    in ``server.requests``.
+    """
+
+    def _send(self, status, record=None):
+        body = b'' if record is None else json.dumps(record).encode()
+        self.send_response(status)
+        if record is not None:
+            self.send_header('ETag', '"{}"'.format(record['version']))
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        record = self.server.records.get(self.path)
+        if record is None:
+            self.server.requests.append(('GET', self.path, 404))
+            return self._send(404, {'version': 0})
+        etag = '"{}"'.format(record['version'])
+        status = 304 if self.headers.get('If-None-Match') == etag else 200
+        self.server.requests.append(('GET', self.path, status))
+        self._send(status, record if status == 200 else None)
+
+    def do_PUT(self):
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        record = self.server.records[self.path]
+        record.update(body, version=record['version'] + 1)
+        self.server.requests.append(('PUT', self.path, 200))
+        self._send(200, record)
+
+    def do_DELETE(self):
+        self.server.records.pop(self.path)
+        self.server.requests.append(('DELETE', self.path, 200))
+        self._send(200, {'version': 0})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def service():
+    server = http_server.HTTPServer(('127.0.0.1', 0), _Service)
+    server.records = {
+        '/ark:/99999/1': {'identifier': 'ark:/99999/1', 'version': 1},
+        '/namespace/ns': {'id': 'ns', 'version': 1},
+    }
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(service, ttl):
+    cache = ResponseCache([MemoryStore()], ttl=ttl)
+    return IdentifierClient('identifier', base_url=service.url, cache=cache,
+                            scheduler=RequestScheduler())
+
+
+def test_fresh_entry_served_without_request(service):
+    client = _client(service, ttl=300)
+    first = client.get_identifier('ark:/99999/1').data
+    assert client.get_identifier('ark:/99999/1').data == first
+    assert service.requests == [('GET', '/ark:/99999/1', 200)]
+    assert client.cache.stats['hits'] == 1
+
+
+def test_stale_entry_revalidated_with_etag(service):
+    client = _client(service, ttl=0)
+    first = client.get_identifier('ark:/99999/1').data
+    assert client.get_identifier('ark:/99999/1').data == first
+    assert service.requests == [('GET', '/ark:/99999/1', 200),
+                                ('GET', '/ark:/99999/1', 304)]
+    assert client.cache.stats['revalidated'] == 1
+
+
+def test_update_invalidates_identifier(service):
+    client = _client(service, ttl=300)
+    client.get_identifier('ark:/99999/1')
+    client.update_identifier('ark:/99999/1', location=['http://new'])
+    record = client.get_identifier('ark:/99999/1').data
+    assert record['location'] == ['http://new']
+    assert record['version'] == 2
+    assert [r[0] for r in service.requests] == ['GET', 'PUT', 'GET']
+
+
+def test_delete_invalidates_namespace(service):
+    client = _client(service, ttl=300)
+    client.get_namespace('ns')
+    client.delete_namespace('ns')
+    with pytest.raises(IdentifierClientError):
+        client.get_namespace('ns')
+    assert service.requests[-1] == ('GET', '/namespace/ns', 404)
+    assert client.cache.stats['invalidated'] == 1
+
+
+def test_invalidate_drops_entries_with_query():
+    store = MemoryStore()
+    entry = CacheEntry(0, {}, b'{}')
+    for key in ('http://s/ns', 'http://s/ns?x=1', 'http://s/ns2'):
+        store.set(key, entry)
+    store.delete_prefix('http://s/ns')
+    assert store.get('http://s/ns2') is not None
+    assert len(store) == 1
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemoryStore(max_entries=2)
+    entry = CacheEntry(0, {}, b'{}')
+    store.set('a', entry)
+    store.set('b', entry)
+    store.get('a')
+    store.set('c', entry)
+    assert store.get('b') is None
+    assert store.get('a') is not None
+
+
+def test_sqlite_entries_promoted_to_memory(tmp_path):
+    path = str(tmp_path / 'cache')
+    entry = CacheEntry(0, {'ETag': '"1"'}, b'{"a": 1}')
+    disk = SQLiteStore(path)
+    disk.set('http://s/x', entry)
+    disk.close()
+
+    memory = MemoryStore()
+    cache = ResponseCache([memory, SQLiteStore(path)], ttl=0)
+    found, fresh = cache.lookup('http://s/x')
+    assert found == entry and not fresh
+    assert memory.get('http://s/x') == entry
+    assert cache.conditional_headers(found) == {'If-None-Match': '"1"'}
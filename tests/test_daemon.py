@@ -0,0 +1,38 @@
+import pytest
+
+from identifiers_client import daemon
+
+
+@pytest.fixture
+def listening(monkeypatch):
+    """Pretend a daemon is listening, recording the requests sent to it."""
+    sent = []
+    monkeypatch.setattr(daemon.os.path, 'exists', lambda path: True)
+    monkeypatch.setattr(daemon, '_connect', lambda: object())
+    monkeypatch.setattr(
+        daemon, '_exchange', lambda sock, request: sent.append(request) or {
+            'stdout': '',
+            'stderr': '',
+            'status': 0
+        })
+    return sent
+
+
+def test_service_commands_are_forwarded(listening):
+    assert daemon.forward(['identifier-display', '--identifier', 'ark:/1'])
+    assert listening == [{
+        'argv': ['identifier-display', '--identifier', 'ark:/1']
+    }]
+
+
+@pytest.mark.parametrize('argv', [
+    ['identifier-create', '--namespace', 'ns', '--file', 'data.bin'],
+    ['identifier-create', '--namespace', 'ns', '--file=data.bin'],
+    ['identifier-display', '--input', 'ids.txt'],
+    ['identifier-display', '--input', '-'],
+    ['identifier-batch-create', '--input', 'records.ndjson'],
+    ['identifier-create', '--help'],
+])
+def test_commands_reading_local_input_run_in_process(listening, argv):
+    assert not daemon.forward(argv)
+    assert listening == []
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+from identifiers_client.download import DownloadError, Downloader
+
+DATA = bytes(bytearray(i % 251 for i in range(1000)))
+URL = 'http://data.test/file'
+
+
+class _Response(object):
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class _Session(object):
+    """
+    Serves DATA with range support. ``statuses`` maps a part's offset to
+    the statuses (or exceptions) to answer its first requests with;
+    ``delays`` to seconds to wait before answering.
+    """
+
+    def __init__(self, statuses=None, delays=None):
+        self.statuses = dict((k, list(v))
+                             for k, v in (statuses or {}).items())
+        self.delays = delays or {}
+        self.ranges = []
+        self._lock = threading.Lock()
+
+    def head(self, url, **kwargs):
+        return _Response(200, headers={'Content-Length': str(len(DATA)),
+                                       'Accept-Ranges': 'bytes'})
+
+    def get(self, url, headers=None, **kwargs):
+        start, end = (int(n) for n in
+                      headers['Range'].split('=')[1].split('-'))
+        with self._lock:
+            self.ranges.append(start)
+            pending = self.statuses.get(start)
+            status = pending.pop(0) if pending else 206
+        time.sleep(self.delays.get(start, 0))
+        if isinstance(status, Exception):
+            raise status
+        if status != 206:
+            return _Response(status)
+        return _Response(206, DATA[start:end + 1])
+
+
+def _downloader(session, **kwargs):
+    downloader = Downloader(connections=3, part_size=100, session=session,
+                            **kwargs)
+    downloader.backoffs = []
+
+    def _backoff(attempt):
+        downloader.backoffs.append(attempt)
+        return 0
+
+    downloader._backoff = _backoff
+    return downloader
+
+
+def _sha256(data=DATA):
+    return {'sha256': hashlib.sha256(data).hexdigest()}
+
+
+def test_ranged_fetch_verifies_checksum(tmp_path):
+    dest = str(tmp_path / 'file')
+    result = _downloader(_Session()).fetch(URL, dest, _sha256())
+    assert result.verified
+    assert result.size == len(DATA)
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
+    assert sorted(os.listdir(str(tmp_path))) == ['file']
+
+
+def test_parts_hashed_in_order_when_fetched_out_of_order(tmp_path):
+    # The first parts arrive last
+    session = _Session(delays={0: 0.05, 100: 0.03})
+    result = _downloader(session).fetch(URL, str(tmp_path / 'file'),
+                                        _sha256())
+    assert result.verified
+
+
+def test_checksum_mismatch_leaves_nothing(tmp_path):
+    with pytest.raises(DownloadError):
+        _downloader(_Session()).fetch(URL, str(tmp_path / 'file'),
+                                      _sha256(b'other'))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_interrupted_fetch_resumes(tmp_path):
+    dest = str(tmp_path / 'file')
+    with pytest.raises(DownloadError):
+        _downloader(_Session(statuses={900: [404]})).fetch(
+            URL, dest, _sha256())
+    with open(dest + '.part.state') as f:
+        assert json.load(f)['completed'] == list(range(9))
+
+    session = _Session()
+    result = _downloader(session).fetch(URL, dest, _sha256())
+    # Only the missing part is fetched; the rest are read back and hashed
+    assert session.ranges == [900]
+    assert result.verified
+    with open(dest, 'rb') as f:
+        assert f.read() == DATA
+
+
+def test_state_for_another_part_size_ignored(tmp_path):
+    dest = str(tmp_path / 'file')
+    with open(dest + '.part.state', 'w') as f:
+        json.dump({'size': len(DATA), 'part_size': 50,
+                   'completed': [0, 1]}, f)
+    session = _Session()
+    assert _downloader(session).fetch(URL, dest, _sha256()).verified
+    assert sorted(session.ranges) == list(range(0, 1000, 100))
+
+
+@pytest.mark.parametrize('failure', [
+    503, 429, 500,
+    requests.ConnectionError('connection reset'),
+])
+def test_part_retried_after_backoff(tmp_path, failure):
+    session = _Session(statuses={300: [failure, failure]})
+    downloader = _downloader(session)
+    assert downloader.fetch(URL, str(tmp_path / 'file'), _sha256()).verified
+    assert session.ranges.count(300) == 3
+    assert downloader.backoffs == [0, 1]
+
+
+@pytest.mark.parametrize('status', [404, 416, 403])
+def test_client_errors_not_retried(tmp_path, status):
+    session = _Session(statuses={300: [status]})
+    downloader = _downloader(session)
+    with pytest.raises(DownloadError) as excinfo:
+        downloader.fetch(URL, str(tmp_path / 'file'), _sha256())
+    assert 'HTTP status {}'.format(status) in str(excinfo.value)
+    assert session.ranges.count(300) == 1
+    assert downloader.backoffs == []
+
+
+def test_part_fails_after_retries(tmp_path):
+    session = _Session(statuses={300: [503] * 5})
+    downloader = _downloader(session)
+    with pytest.raises(DownloadError):
+        downloader.fetch(URL, str(tmp_path / 'file'), _sha256())
+    assert session.ranges.count(300) == 3
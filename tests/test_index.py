@@ -0,0 +1,125 @@
+import hashlib
+from configparser import ConfigParser
+
+import pytest
+
+from identifiers_client.index import MintedIndex
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _record(identifier, data, namespace='ns', location=None):
+    return {
+        'identifier': identifier,
+        'namespace': namespace,
+        'location': location or ['http://example.org/' + identifier],
+        'checksums': [{'function': 'sha256', 'value': _sha256(data)}],
+        'metadata': {'name': identifier}
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'index')
+
+
+def test_find_by_checksum(path):
+    index = MintedIndex(path)
+    index.add(_record('ark:/1', b'one'))
+    found = index.find('SHA256', _sha256(b'one'))
+    assert found.identifier == 'ark:/1'
+    assert found.checksums == [{'function': 'sha256',
+                                'value': _sha256(b'one')}]
+    assert index.find('sha256', _sha256(b'two')) is None
+    assert index.find('sha256', _sha256(b'one'), namespace='other') is None
+    index.close()
+
+
+def test_find_sees_identifiers_added_by_another_instance(path):
+    long_lived = MintedIndex(path)
+    long_lived.add(_record('ark:/1', b'one'))
+    assert long_lived.find('sha256', _sha256(b'two')) is None
+
+    other = MintedIndex(path)
+    other.add(_record('ark:/2', b'two'))
+    other.close()
+
+    assert long_lived.find('sha256', _sha256(b'two')).identifier == 'ark:/2'
+    long_lived.close()
+
+
+def test_find_sees_checksums_updated_by_another_instance(path):
+    first = MintedIndex(path)
+    first.add(_record('ark:/1', b'one'))
+    first.add(_record('ark:/2', b'two'))
+    first.close()
+
+    long_lived = MintedIndex(path)
+    assert long_lived.find('sha256', _sha256(b'new')) is None
+
+    other = MintedIndex(path)
+    other.add(_record('ark:/1', b'new'))
+    other.close()
+
+    found = long_lived.find('sha256', _sha256(b'new'))
+    assert found.identifier == 'ark:/1'
+    assert long_lived.find('sha256', _sha256(b'one')) is None
+    long_lived.close()
+
+
+def test_saved_filter_covers_updates(path):
+    first = MintedIndex(path)
+    first.add(_record('ark:/1', b'one'))
+    first.add(_record('ark:/2', b'two'))
+    first.close()
+
+    # A stale instance saving its filter last must not hide the update
+    stale = MintedIndex(path)
+    stale.find('sha256', _sha256(b'one'))
+    other = MintedIndex(path)
+    other.add(_record('ark:/1', b'new'))
+    other.close()
+    stale.add(_record('ark:/3', b'three'))
+    stale.close()
+
+    reopened = MintedIndex(path)
+    assert reopened.find('sha256', _sha256(b'new')).identifier == 'ark:/1'
+    reopened.close()
+
+
+def test_earliest_identifier_found_first(path):
+    index = MintedIndex(path)
+    index.add(_record('ark:/1', b'same'))
+    index.add(_record('ark:/2', b'same'))
+    # Recording the first again doesn't make it any later
+    index.add(_record('ark:/1', b'same', location=['http://mirror/1']))
+    found = index.find('sha256', _sha256(b'same'))
+    assert found.identifier == 'ark:/1'
+    assert found.location == ['http://mirror/1']
+    assert len(index) == 2
+    index.close()
+
+
+def _config(**options):
+    config = ConfigParser()
+    if options:
+        config.add_section('index')
+        for name, value in options.items():
+            config.set('index', name, value)
+    return config
+
+
+def test_index_off_without_config_section(tmp_path):
+    assert MintedIndex.from_config(_config()) is None
+    assert MintedIndex.from_config(
+        _config(enabled='false', path=str(tmp_path / 'index'))) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_index_from_config_section(path):
+    index = MintedIndex.from_config(_config(path=path))
+    index.add(_record('ark:/1', b'one'))
+    assert index.find('sha256', _sha256(b'one')).identifier == 'ark:/1'
+    index.close()
@@ -0,0 +1,138 @@
+import pytest
+import requests
+from globus_sdk.exc import NetworkError
+
+from identifiers_client import journal
+from identifiers_client.journal import Journal, JournalFlusher, _merge
+
+
+class _Response(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class _Client(object):
+    """Records the calls made to it; fails the first ``failures`` calls
+    with a network error."""
+
+    def __init__(self, failures=0, index=True):
+        self._session = requests.Session()
+        self.index = object() if index else None
+        self.failures = failures
+        self.calls = []
+
+    def _call(self, name, identifier, kwargs):
+        self.calls.append((name, identifier, dict(kwargs)))
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError('read timed out', Exception('timeout'))
+        return _Response(dict(kwargs, identifier=identifier or 'ark:/new'))
+
+    def create_identifier(self, **kwargs):
+        return self._call('create', None, kwargs)
+
+    def update_identifier(self, identifier_id, **kwargs):
+        return self._call('update', identifier_id, kwargs)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = Journal(str(tmp_path / 'journal'))
+    yield store
+    store.close()
+
+
+def _due_now(store):
+    store._db.execute('UPDATE operations SET next_attempt_at = 0')
+
+
+def test_claim_leases_operations_once(store, tmp_path):
+    tickets = [store.create_identifier(namespace='ns') for _ in range(3)]
+    claimed = store.claim(10)
+    assert [e.ticket for e in claimed] == tickets
+    assert store.claim(10) == []
+    # Another process sees them in flight and leaves them alone
+    other = Journal(str(tmp_path / 'journal'))
+    other._owner = 'elsewhere:1'
+    assert other.claim(10) == []
+    other.close()
+    store.release()
+    assert [e.ticket for e in store.claim(10)] == tickets
+
+
+def test_claim_recovers_operations_of_exited_process(store, tmp_path):
+    ticket = store.create_identifier(namespace='ns')
+    store._owner = journal._owner().rsplit(':', 1)[0] + ':999999999'
+    store.claim(10)
+    store._owner = journal._owner()
+    entries = store.claim(10)
+    assert [(e.ticket, e.recovered) for e in entries] == [(ticket, True)]
+
+
+def test_updates_to_an_identifier_are_merged_in_order(store):
+    first = store.update_identifier('ark:/1', location=['a'])
+    store.create_identifier(namespace='ns')
+    second = store.update_identifier('ark:/1', location=['b'],
+                                     metadata={'x': 1})
+    store.update_identifier('ark:/2', location=['c'])
+    merged = _merge(store.claim(10))
+    assert [(r[1], r[2]) for r in merged] == [
+        ('update', 'ark:/1'), ('create', None), ('update', 'ark:/2')]
+    entries, _, _, args = merged[0]
+    assert [e.ticket for e in entries] == [first, second]
+    assert args == {'location': ['b'], 'metadata': {'x': 1}}
+
+
+def test_update_waits_for_earlier_update_being_retried(store):
+    store.update_identifier('ark:/1', location=['a'])
+    entry, = store.claim(10)
+    store.retry([entry.ticket], 'timed out', 1)
+    later = store.update_identifier('ark:/1', location=['b'])
+    assert store.claim(10) == []
+    _due_now(store)
+    assert [e.ticket for e in store.claim(10)] == [entry.ticket, later]
+
+
+def test_flush_retries_network_errors(store):
+    ticket = store.update_identifier('ark:/1', location=['a'])
+    client = _Client(failures=2)
+    flusher = JournalFlusher(store, lambda: client, concurrency=1)
+    for _ in range(3):
+        _due_now(store)
+        flusher.flush_once()
+    state = store.get(ticket)
+    assert state['state'] == journal.DONE
+    assert state['attempts'] == 2
+    assert len(client.calls) == 3
+
+
+def test_flush_gives_up_after_max_attempts(store):
+    ticket = store.update_identifier('ark:/1', location=['a'])
+    flusher = JournalFlusher(store, lambda: _Client(failures=5),
+                             concurrency=1, max_attempts=2)
+    for _ in range(2):
+        _due_now(store)
+        flusher.flush_once()
+    state = store.get(ticket)
+    assert state['state'] == journal.FAILED
+    assert 'read timed out' in state['error']
+
+
+def test_retried_create_is_deduplicated(store):
+    store.create_identifier(namespace='ns')
+    client = _Client(failures=1)
+    flusher = JournalFlusher(store, lambda: client, concurrency=1)
+    flusher.flush_once()
+    _due_now(store)
+    flusher.flush_once()
+    assert [call[2].get('dedupe') for call in client.calls] == [None, True]
+
+
+def test_retried_create_without_index_is_sent_as_is(store):
+    store.create_identifier(namespace='ns')
+    client = _Client(failures=1, index=False)
+    flusher = JournalFlusher(store, lambda: client, concurrency=1)
+    flusher.flush_once()
+    _due_now(store)
+    flusher.flush_once()
+    assert [call[2].get('dedupe') for call in client.calls] == [None, None]
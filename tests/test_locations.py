@@ -0,0 +1,71 @@
+import functools
+import threading
+from http import server as http_server
+
+import pytest
+
+from identifiers_client.locations import (HostEstimate, HostHistory,
+                                          LocationRanker, expected_seconds)
+
+
+class _Handler(http_server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Serve a directory over HTTP; returns the base URL."""
+    servers = []
+
+    def _serve(directory):
+        handler = functools.partial(_Handler, directory=str(directory))
+        server = http_server.HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return 'http://127.0.0.1:{}/'.format(server.server_address[1])
+
+    yield _serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = HostHistory(str(tmp_path / 'hosts'))
+    yield history
+    history.close()
+
+
+def test_expected_seconds_allows_for_failures():
+    estimate = HostEstimate('http://a', 0.1, 1000.0, 0.0, 0)
+    assert expected_seconds(estimate, 1000) == pytest.approx(1.1)
+    failing = estimate._replace(failure_rate=0.5)
+    assert expected_seconds(failing, 1000) == pytest.approx(2.2)
+    assert expected_seconds(None) is None
+
+
+def test_fastest_known_host_first(history):
+    history.record('http://slow/x', latency=1.0, throughput=1000.0)
+    history.record('http://fast/x', latency=0.1, throughput=1e6)
+    ranker = LocationRanker(history)
+    assert ranker.order(['http://slow/x', 'gs://bucket/x', 'http://fast/x'],
+                        probe=False) == [
+                            'http://fast/x', 'http://slow/x', 'gs://bucket/x']
+
+
+def test_failing_host_ranked_after_unprobeable(serve, tmp_path, history):
+    (tmp_path / 'good').mkdir()
+    (tmp_path / 'good' / 'data').write_bytes(b'x' * 100)
+    (tmp_path / 'empty').mkdir()
+    good = serve(tmp_path / 'good') + 'data'
+    missing = serve(tmp_path / 'empty') + 'data'
+    ranker = LocationRanker(history, timeout=2)
+    locations = [missing, 's3://bucket/data', good]
+    assert ranker.order(locations) == [good, 's3://bucket/data', missing]
+    # The 404 was timed, but is ranked as failing
+    assert history.estimate(missing).latency is not None
+    assert history.estimate(missing).failure_rate == 1.0
@@ -0,0 +1,59 @@
+import io
+import json
+import sys
+
+import pytest
+
+import identifiers_client.main  # noqa: F401
+
+# The package exports the main() function under the module's name
+main = sys.modules['identifiers_client.main']
+
+RECORDS = [{'identifier': 'ark:/99999/{}'.format(i), 'namespace': 'ns'}
+           for i in range(3)]
+
+
+class _Client(object):
+    def iter_identifiers(self, namespace_id, page_size=None):
+        return iter(RECORDS)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, 'get_client', _Client)
+
+
+def _export(capsys, global_args=(), *argv):
+    """Run namespace-export; returns what it wrote to standard output and
+    what it printed as its result."""
+    out = io.StringIO()
+    main.run(list(global_args) + ['namespace-export', '--namespace-id', 'ns']
+             + list(argv), out=out)
+    return capsys.readouterr().out, out.getvalue()
+
+
+def test_export_ndjson_by_default(client, capsys):
+    stdout, _ = _export(capsys)
+    assert [json.loads(line) for line in stdout.splitlines()] == RECORDS
+
+
+def test_export_in_global_output_format(client, capsys):
+    stdout, _ = _export(capsys, ['--output', 'json'])
+    assert json.loads(stdout) == RECORDS
+
+
+def test_export_csv_rejects_global_output_format(client, capsys):
+    stdout, message = _export(capsys, ['--output', 'json'], '--format',
+                              'csv')
+    assert stdout == ''
+    assert '--output json' in message
+
+
+def test_export_to_file_reports_count(client, capsys, tmp_path):
+    path = str(tmp_path / 'export.json')
+    stdout, reported = _export(capsys, ['--output', 'json'],
+                               '--output-file', path)
+    assert stdout == ''
+    assert json.loads(reported) == {'namespace': 'ns', 'exported': 3}
+    with open(path) as f:
+        assert json.loads(f.read()) == RECORDS
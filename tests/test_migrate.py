@@ -0,0 +1,191 @@
+import pytest
+import requests
+
+from identifiers_client.identifiers_api import IdentifierClient
+from identifiers_client.migrate import (Baseline, Checkpoint, LocationRewrite,
+                                        select, update_identifiers)
+from identifiers_client.scheduler import RequestScheduler
+
+
+class _Response(object):
+    def __init__(self, data):
+        self.data = data
+
+
+class _Client(object):
+    """Holds identifier records, applying updates to them; updates of the
+    identifiers in ``failing`` raise."""
+
+    def __init__(self, records, failing=()):
+        self._session = requests.Session()
+        self.records = dict((r['identifier'], dict(r)) for r in records)
+        self.failing = set(failing)
+        self.gets = []
+        self.updates = []
+
+    def get_identifier(self, identifier):
+        self.gets.append(identifier)
+        return _Response(dict(self.records[identifier]))
+
+    def update_identifier(self, identifier, **changes):
+        self.updates.append((identifier, changes))
+        if identifier in self.failing:
+            raise RuntimeError('update failed')
+        self.records[identifier].update(changes)
+        return _Response(self.records[identifier])
+
+
+def _records(count=4):
+    return [{'identifier': 'ark:/99999/{}'.format(i),
+             'location': ['http://old.example/{}'.format(i)],
+             'metadata': {'name': str(i)}} for i in range(count)]
+
+
+def _statuses(results):
+    return [(r.identifier, r.status) for r in results]
+
+
+def test_rewrite_locations():
+    rewrite = LocationRewrite('http://old.example/', 'https://new.example/')
+    assert rewrite.apply(['http://old.example/a', 'gs://b/a']) == [
+        'https://new.example/a', 'gs://b/a']
+    records = _records(2) + [{'identifier': 'ark:/99999/x',
+                              'location': ['gs://b/x']}]
+    assert [r['identifier'] for r in select(records, rewrite)] == [
+        'ark:/99999/0', 'ark:/99999/1']
+    with pytest.raises(ValueError):
+        LocationRewrite('', 'https://new.example/')
+
+
+def test_update_with_rewrite_reads_current_location():
+    client = _Client(_records(2))
+    rewrite = LocationRewrite('http://old.example/', 'https://new.example/')
+    ids = [{'identifier': 'ark:/99999/0'}, {'identifier': 'ark:/99999/1'}]
+    results = list(update_identifiers(client, ids, rewrite=rewrite))
+    assert [r.status for r in results] == ['updated', 'updated']
+    assert results[0].previous == {'location': ['http://old.example/0']}
+    assert client.records['ark:/99999/0']['location'] == [
+        'https://new.example/0']
+    # Already moved: nothing more to change
+    results = list(update_identifiers(client, ids, rewrite=rewrite))
+    assert [r.status for r in results] == ['unchanged', 'unchanged']
+
+
+def test_dry_run_changes_nothing(tmp_path):
+    client = _Client(_records(2))
+    path = str(tmp_path / 'checkpoint')
+    with Checkpoint(path) as checkpoint:
+        results = list(update_identifiers(
+            client, [{'identifier': 'ark:/99999/0', 'location': ['x']}],
+            dry_run=True, checkpoint=checkpoint))
+    assert results[0].status == 'planned'
+    assert results[0].changes == {'location': ['x']}
+    assert client.updates == []
+    assert not tmp_path.joinpath('checkpoint').exists()
+
+
+def test_interrupted_update_resumes_from_checkpoint(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    updates = [{'identifier': r['identifier'], 'location': ['http://new']}
+               for r in _records()]
+    client = _Client(_records(), failing=['ark:/99999/2'])
+    with Checkpoint(path) as checkpoint:
+        results = list(update_identifiers(client, updates,
+                                          checkpoint=checkpoint,
+                                          concurrency=2))
+    assert [r.status for r in results] == [
+        'updated', 'updated', 'error', 'updated']
+    assert isinstance(results[2].error, RuntimeError)
+
+    client.failing.clear()
+    client.updates = []
+    with Checkpoint(path) as checkpoint:
+        assert 'ark:/99999/1' in checkpoint
+        results = list(update_identifiers(client, updates,
+                                          checkpoint=checkpoint))
+    assert [r.status for r in results] == ['done', 'done', 'updated', 'done']
+    assert [u[0] for u in client.updates] == ['ark:/99999/2']
+    with open(path) as f:
+        assert sorted(f.read().split()) == [r['identifier']
+                                            for r in _records()]
+
+
+def test_record_without_identifier_is_an_error():
+    results = list(update_identifiers(_Client([]), [{'location': ['x']}]))
+    assert results[0].status == 'error'
+    assert isinstance(results[0].error, ValueError)
+
+
+def test_csv_values_decoded():
+    client = _Client(_records(1))
+    list(update_identifiers(client, [{'identifier': 'ark:/99999/0',
+                                      'metadata': '{"name": "new"}'}]))
+    assert client.updates == [('ark:/99999/0',
+                               {'metadata': {'name': 'new'}})]
+
+
+def test_baseline_finds_changed_properties():
+    baseline = Baseline(_records(2) + [{'location': ['no identifier']}])
+    assert len(baseline) == 2 and 'ark:/99999/0' in baseline
+    assert baseline.changes('ark:/99999/0', {
+        'location': ['http://old.example/0'],
+        'metadata': {'name': 'new'},
+        'visible_to': ['public'],
+    }) == {'metadata': {'name': 'new'}, 'visible_to': ['public']}
+    # Key order and CSV encoding don't count as changes
+    csv_record = {'identifier': 'ark:/99999/x',
+                  'metadata': '{"b": 2, "a": 1}'}
+    assert Baseline([csv_record]).changes(
+        'ark:/99999/x', {'metadata': {'a': 1, 'b': 2}}) == {}
+
+
+def test_minimal_update_with_baseline_skips_unchanged():
+    records = _records(3)
+    client = _Client(records)
+    updates = [dict(r) for r in records]
+    updates[1]['metadata'] = {'name': 'renamed'}
+    updates.append({'identifier': 'ark:/99999/new', 'metadata': {}})
+    client.records['ark:/99999/new'] = {'identifier': 'ark:/99999/new',
+                                        'metadata': {}}
+    results = list(update_identifiers(client, updates, minimal=True,
+                                      baseline=Baseline(records)))
+    assert _statuses(results) == [
+        ('ark:/99999/0', 'unchanged'), ('ark:/99999/1', 'updated'),
+        ('ark:/99999/2', 'unchanged'), ('ark:/99999/new', 'unchanged')]
+    assert client.updates == [('ark:/99999/1',
+                               {'metadata': {'name': 'renamed'}})]
+    # Only the identifier missing from the baseline was got
+    assert client.gets == ['ark:/99999/new']
+
+
+def test_minimal_update_without_baseline_gets_current():
+    client = _Client(_records(1))
+    results = list(update_identifiers(client, [{
+        'identifier': 'ark:/99999/0',
+        'location': ['http://old.example/0'],
+        'metadata': {'name': 'renamed'}
+    }], minimal=True))
+    assert results[0].changes == {'metadata': {'name': 'renamed'}}
+    assert results[0].previous == {'metadata': {'name': '0'}}
+    assert client.gets == ['ark:/99999/0']
+
+
+def test_client_minimal_update_sends_only_changes(monkeypatch):
+    client = IdentifierClient('identifier', base_url='http://s.test/',
+                              scheduler=RequestScheduler())
+    current = _records(1)[0]
+    sent = []
+    monkeypatch.setattr(client, 'get_identifier',
+                        lambda identifier: _Response(dict(current)))
+    monkeypatch.setattr(client, 'put', lambda path, body, params=None:
+                        sent.append(body) or _Response(dict(current, **body)))
+
+    response = client.update_identifier(
+        'ark:/99999/0', minimal=True, location=current['location'])
+    assert response.data['unchanged'] is True
+    assert sent == []
+
+    client.update_identifier('ark:/99999/0', minimal=True,
+                             location=current['location'],
+                             metadata={'name': 'renamed'})
+    assert sent == [{'metadata': {'name': 'renamed'}}]
@@ -0,0 +1,158 @@
+import errno
+import socket
+import threading
+
+import pytest
+import requests
+from requests.exceptions import (ChunkedEncodingError, ConnectionError,
+                                 ContentDecodingError, ReadTimeout, SSLError)
+from urllib3.exceptions import (MaxRetryError, NameResolutionError,
+                                NewConnectionError, ProtocolError)
+
+from identifiers_client.scheduler import RequestScheduler
+
+URL = 'http://identifiers.test/ark:/99999/fk4'
+
+
+class _Response(object):
+    def __init__(self, status_code=200, error=None):
+        self.status_code = status_code
+        self.headers = {}
+        self._error = error
+
+    @property
+    def content(self):
+        if self._error is not None:
+            raise self._error
+        return b'{}'
+
+    def close(self):
+        pass
+
+
+def _request(method='GET'):
+    return requests.Request(method, URL).prepare()
+
+
+def _scheduler(**kwargs):
+    kwargs.setdefault('rate', 1000)
+    kwargs.setdefault('burst', 1000)
+    kwargs.setdefault('initial_concurrency', 2)
+    kwargs.setdefault('max_retries', 0)
+    return RequestScheduler(**kwargs)
+
+
+def _refused():
+    reason = NewConnectionError(None, 'Connection refused')
+    return ConnectionError(MaxRetryError(None, URL, reason))
+
+
+def _unresolved():
+    reason = NameResolutionError('identifiers.test', None,
+                                 socket.gaierror(-2, 'Name unknown'))
+    return ConnectionError(MaxRetryError(None, URL, reason))
+
+
+def _reset():
+    reset = socket.error(errno.ECONNRESET, 'Connection reset by peer')
+    return ConnectionError(ProtocolError('Connection aborted.', reset))
+
+
+def _failing(error):
+    def _send():
+        raise error
+    return _send
+
+
+@pytest.mark.parametrize('error, congested', [
+    (ChunkedEncodingError('truncated body'), True),
+    (ContentDecodingError('bad gzip'), False),
+])
+def test_body_errors_release_the_slot(error, congested):
+    scheduler = _scheduler()
+    for _ in range(5):
+        with pytest.raises(type(error)):
+            scheduler.send(_request(), lambda: _Response(error=error))
+    limit = scheduler.host(URL).limit
+    assert limit.in_flight == 0
+    # Only congestion brings the limit down
+    assert (limit.limit == 1) == congested
+
+
+@pytest.mark.parametrize('error, congested', [
+    (ReadTimeout('read timed out'), True),
+    (_reset(), True),
+    (_refused(), False),
+    (_unresolved(), False),
+    (SSLError('certificate verify failed'), False),
+])
+def test_only_timeouts_and_resets_are_congestion(error, congested):
+    scheduler = _scheduler(initial_concurrency=4)
+    with pytest.raises(type(error)):
+        scheduler.send(_request(), _failing(error))
+    limit = scheduler.host(URL).limit
+    assert limit.in_flight == 0
+    assert (limit.limit == 2) == congested
+
+
+@pytest.mark.parametrize('error, retried', [
+    (_refused(), True),
+    (_unresolved(), True),
+    (_reset(), False),
+    (ReadTimeout('read timed out'), False),
+])
+def test_post_retried_only_when_never_sent(error, retried):
+    scheduler = _scheduler(max_retries=1)
+    scheduler._backoff = lambda attempt: 0
+    with pytest.raises(type(error)):
+        scheduler.send(_request('POST'), _failing(error))
+    assert scheduler.stats['requests'] == (2 if retried else 1)
+
+
+def test_unexpected_errors_release_the_slot():
+    scheduler = _scheduler()
+
+    def _send():
+        raise RuntimeError('hook failed')
+
+    for _ in range(5):
+        with pytest.raises(RuntimeError):
+            scheduler.send(_request(), _send)
+    limit = scheduler.host(URL).limit
+    assert limit.in_flight == 0
+    assert limit.limit >= 2
+
+
+def test_request_after_errors_is_not_blocked():
+    scheduler = _scheduler()
+    for _ in range(3):
+        with pytest.raises(ChunkedEncodingError):
+            scheduler.send(_request(), lambda: _Response(
+                error=ChunkedEncodingError('truncated body')))
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        scheduler.send(_request(), _Response)))
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert results and results[0].status_code == 200
+
+
+def test_idempotent_request_retried_after_body_error():
+    scheduler = _scheduler(max_retries=2)
+    scheduler._backoff = lambda attempt: 0
+    responses = [_Response(error=ChunkedEncodingError('truncated body')),
+                 _Response()]
+    response = scheduler.send(_request(), lambda: responses.pop(0))
+    assert response.status_code == 200
+    assert scheduler.stats['retries'] == 1
+    assert scheduler.host(URL).limit.in_flight == 0
+
+
+def test_congestion_status_retried_then_returned():
+    scheduler = _scheduler(max_retries=1)
+    scheduler._backoff = lambda attempt: 0
+    response = scheduler.send(_request(), lambda: _Response(503))
+    assert response.status_code == 503
+    assert scheduler.stats == dict(requests=2, retries=1, congested=2)
+    assert scheduler.host(URL).limit.in_flight == 0